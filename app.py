@@ -1,50 +1,149 @@
 # app.py
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager
+from flask import Flask, Request, request, g, current_app
 from config import Config
-from models import Base, User, ImageUpload
-from utils import FileUtils
-from controllers import HealthController, AuthController, ImageController
+from extensions import db, jwt, celery, init_celery
+from models import ensure_schema
+from models.engine import configure_engine, engine_options, settings_from_config
+from utils import ImageUtils
+from services.metrics import init_metrics, get_metrics
+from services.pipeline import OUTPUT_FORMATS
+from services.status_notifier import create_status_notifier
+from services.storage import create_storage, storage_settings
 import os
+import time
+import atexit
 
-def create_app(config_class=Config):
+def create_core_app(config_class=Config):
+    """Flask app with what the API and Celery workers both need: config,
+    the shared extensions and database engine settings, metrics, storage,
+    Pillow plugins and a checked schema
+    """
     app = Flask(__name__)
     app.config.from_object(config_class)
-    
-    # Initialize extensions
-    db = SQLAlchemy(model_class=Base)
+    # Pool and SQLite settings from DB_* / SQLITE_*; explicit SQLALCHEMY_ENGINE_OPTIONS win
+    database_settings = settings_from_config(app.config)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(app.config['SQLALCHEMY_DATABASE_URI'], database_settings),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+    }
     db.init_app(app)
-    jwt = JWTManager(app)
+    init_celery(app)
+    init_metrics(app.config.get('METRICS_ENABLED', False))
+    
+    # Uploads are only ever decoded as an allowed format; results are written as an output format
+    ImageUtils.register_plugins(
+        set(app.config['ALLOWED_EXTENSIONS']) | {extension for _, extension, _ in OUTPUT_FORMATS.values()})
+    settings = storage_settings(app.config)
+    app.extensions['upload_storage'] = create_storage(settings, 'uploads')
+    app.extensions['result_storage'] = create_storage(settings, 'processed')
+    app.extensions['status_notifier'] = create_status_notifier(app.config.get('STATUS_NOTIFIER_URL'))
+    
+    with app.app_context():
+        configure_engine(db.engine, database_settings)
+        if ensure_schema(db.engine):
+            app.logger.info("Database schema created or extended")
+    return app
+
+def create_app(config_class=Config, start_dispatcher=True):
+    # API-only modules; Celery workers build create_core_app without importing them
+    from controllers import HealthController, AuthController, ImageController
+    from services import TaskDispatcher, RenditionCache, PasswordHasher
+    
+    app = create_core_app(config_class)
+    app.request_class = UploadRequest
+    if app.config.get('SENDFILE_MODE') == 'x-sendfile':
+        app.config['USE_X_SENDFILE'] = True
+    jwt.init_app(app)
     
-    # Create directories
-    FileUtils.create_directories(app.config['UPLOAD_FOLDER'], app.config['PROCESSED_FOLDER'])
+    metrics = get_metrics()
+    if metrics.enabled:
+        register_request_metrics(app, metrics)
+    
+    # Initialize background processing
+    task_dispatcher = TaskDispatcher(
+        app, db, celery,
+        max_workers=app.config.get('PROCESSING_EXECUTOR_WORKERS', 4),
+        batch_size=app.config.get('PROCESSING_BATCH_SIZE', 1),
+        batch_max_wait=app.config.get('PROCESSING_BATCH_MAX_WAIT', 0.05)
+    )
+    app.extensions['task_dispatcher'] = task_dispatcher
+    
+    rendition_cache = RenditionCache(
+        app.config.get('RENDITION_FOLDER') or os.path.join(app.config['PROCESSED_FOLDER'], 'renditions'),
+        max_memory_bytes=app.config.get('RENDITION_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+        max_disk_bytes=app.config.get('RENDITION_DISK_MAX_BYTES', 1024 * 1024 * 1024)
+    )
+    app.extensions['rendition_cache'] = rendition_cache
+    
+    password_hasher = PasswordHasher.from_config(app.config)
+    app.extensions['password_hasher'] = password_hasher
     
     # Initialize controllers
     health_controller = HealthController(db)
-    auth_controller = AuthController(db)
+    auth_controller = AuthController(db, password_hasher)
     image_controller = ImageController(
         db,
-        app.config['UPLOAD_FOLDER'],
-        app.config['PROCESSED_FOLDER'],
-        app.config['ALLOWED_EXTENSIONS']
+        app.extensions['upload_storage'],
+        app.extensions['result_storage'],
+        app.config['ALLOWED_EXTENSIONS'],
+        task_dispatcher,
+        rendition_cache,
+        app.extensions['status_notifier']
     )
     
     # Register routes
     app.add_url_rule("/health", view_func=health_controller.health_check, methods=["GET"])
+    if metrics.enabled:
+        app.add_url_rule("/metrics", view_func=health_controller.metrics, methods=["GET"])
     app.add_url_rule("/api/register", view_func=auth_controller.register, methods=["POST"])
     app.add_url_rule("/api/login", view_func=auth_controller.login, methods=["POST"])
     app.add_url_rule("/api/upload", view_func=image_controller.upload_image, methods=["POST"])
+    app.add_url_rule("/api/uploads/batch", view_func=image_controller.upload_images_batch, methods=["POST"])
     app.add_url_rule("/api/images/<int:image_id>", view_func=image_controller.get_image_status, methods=["GET"])
     app.add_url_rule("/api/images/<int:image_id>/result", view_func=image_controller.get_processed_image, methods=["GET"])
     app.add_url_rule("/api/images", view_func=image_controller.list_images, methods=["GET"])
-        
-    # Create tables
-    with app.app_context():
-        db.create_all()
+    app.add_url_rule("/api/images/<int:image_id>/wait", view_func=image_controller.wait_image_status, methods=["GET"])
+    app.add_url_rule("/api/images/<int:image_id>/events", view_func=image_controller.stream_image_events, methods=["GET"])
+    app.add_url_rule("/api/images/wait", view_func=image_controller.wait_user_images, methods=["GET"])
+    app.add_url_rule("/api/images/events", view_func=image_controller.stream_user_events, methods=["GET"])
+    
+    # serve.py preloads the app in the gunicorn master and starts this in one worker instead
+    if start_dispatcher:
+        task_dispatcher.start()
+    atexit.register(task_dispatcher.shutdown)
+    atexit.register(password_hasher.shutdown)
     
     return app
 
+class UploadRequest(Request):
+    """Parses uploaded files straight into the upload storage's spool.
+
+    werkzeug would spool each file to a temp file (or memory) of its own,
+    for ImageService to copy into storage. Here the spool is the storage's:
+    the bytes are hashed on the way in and the file is renamed into place,
+    so an upload is written once.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        storage = current_app.extensions.get('upload_storage')
+        if storage is None or not filename:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return storage.spool()
+
+def register_request_metrics(app, metrics):
+    """Time every request, labelled by route template so ids don't explode cardinality"""
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+    
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.observe_request(endpoint, request.method, response.status_code, time.perf_counter() - started)
+        return response
+
 if __name__ == '__main__':
     app = create_app()
     port = int(os.environ.get('PORT', 5000))
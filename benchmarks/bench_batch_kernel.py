@@ -0,0 +1,93 @@
+# benchmarks/bench_batch_kernel.py
+"""Compare Pillow's per-image transforms with the NumPy batch kernel.
+
+    python benchmarks/bench_batch_kernel.py --count 32 --size 1000x750
+    python benchmarks/bench_batch_kernel.py --pipeline '[{"op": "resize", "width": 400}, {"op": "gamma", "gamma": 2.2}]'
+
+Both paths start from the same decoded images, so only the transform is
+timed. Reports milliseconds per image for each, the speedup, and how far
+the kernel's pixels are from Pillow's. Needs numpy.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+# Resize to the default 800x600 box, in color, with a point operation
+DEFAULT_SPEC = [
+    {'op': 'resize', 'width': 800, 'height': 600},
+    {'op': 'contrast', 'factor': 1.2},
+    {'op': 'format', 'format': 'jpeg'},
+]
+
+def generate_images(count, size, mode):
+    """Noisy gradients, so no two images (or rows) are alike"""
+    images = []
+    for index in range(count):
+        img = Image.merge('RGB', (
+            Image.effect_noise(size, 32 + index % 16),
+            Image.linear_gradient('L').resize(size),
+            Image.radial_gradient('L').resize(size),
+        ))
+        images.append(img if mode == 'RGB' else img.convert(mode))
+    return images
+
+def run(count=16, size=(1000, 750), mode='RGB', pipeline_spec=None, repeat=3):
+    import numpy as np
+    from services import batch_kernel
+    from services.pipeline import Pipeline
+
+    pipeline = Pipeline.from_spec(pipeline_spec or DEFAULT_SPEC)
+    if not batch_kernel.supports(pipeline, mode):
+        raise ValueError("The batch kernel doesn't support this pipeline or mode")
+    images = generate_images(count, size, mode)
+
+    pillow_times, kernel_times = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        expected = [pipeline.apply(img, size) for img in images]
+        pillow_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        actual = batch_kernel.transform_batch(images, pipeline, size)
+        kernel_times.append(time.perf_counter() - started)
+
+    diffs = [np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16))
+             for a, b in zip(expected, actual)]
+    pillow_ms = statistics.median(pillow_times) * 1000 / count
+    kernel_ms = statistics.median(kernel_times) * 1000 / count
+    return {
+        'count': count,
+        'size': list(size),
+        'mode': mode,
+        'pillow_ms_per_image': round(pillow_ms, 3),
+        'kernel_ms_per_image': round(kernel_ms, 3),
+        'speedup': round(pillow_ms / kernel_ms, 2),
+        'max_diff': int(max(diff.max() for diff in diffs)),
+        'mean_diff': round(float(statistics.fmean(diff.mean() for diff in diffs)), 4),
+        'cpus': os.cpu_count(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=16)
+    parser.add_argument('--size', default='1000x750', help="WIDTHxHEIGHT of every input")
+    parser.add_argument('--mode', choices=['L', 'RGB'], default='RGB')
+    parser.add_argument('--pipeline', help="pipeline JSON (default: 800x600 fit, contrast 1.2)")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    report = run(args.count, (width, height), args.mode,
+                 json.loads(args.pipeline) if args.pipeline else None, args.repeat)
+    for key, value in report.items():
+        print(f"{key:<22}{value}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# benchmarks/bench_ingest.py
+"""Compare upload ingestion through werkzeug's spool and through the storage's spool.
+
+    python benchmarks/bench_ingest.py --count 20 --size 3000x2000
+    python benchmarks/bench_ingest.py --output ingest.json
+
+Multipart uploads of a JPEG are posted to a minimal app that stores them
+as ImageService does. 'copy' parses with Flask's own request class:
+werkzeug spools each file and the storage copies it in. 'spool' parses
+with UploadRequest: the file is written once into the storage and
+renamed into place. Bytes written and read by the process (from
+/proc/self/io, on Linux) are reported per upload, with the time.
+
+It then decodes the stored file by path and through the storage's
+memory-mapped buffer, as the processor does.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, Request, request, jsonify
+from PIL import Image
+from werkzeug.test import EnvironBuilder
+from app import UploadRequest
+from services.image_service import ImageService
+from services.storage import LocalStorage
+
+MODES = {'copy': Request, 'spool': UploadRequest}
+DECODE_REPEAT = 9
+
+def io_counters():
+    """Bytes this process has written and read through system calls, or None off Linux"""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['wchar']), int(counters['rchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def make_image(size):
+    # Noise, so the JPEG is about as large as a photo of this size
+    output = BytesIO()
+    Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)).save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+def make_app(mode, storage):
+    app = Flask(__name__)
+    app.request_class = MODES[mode]
+    app.extensions['upload_storage'] = storage
+
+    @app.post('/ingest')
+    def ingest():
+        key, content_hash = storage.save_stream(request.files['file'].stream, 'jpg', check=ImageService._check_header)
+        return jsonify({'key': key, 'content_hash': content_hash})
+
+    return app
+
+def run_mode(mode, data, count):
+    root = tempfile.mkdtemp(prefix='bench-ingest-')
+    try:
+        storage = LocalStorage(root)
+        client = make_app(mode, storage).test_client()
+        timings, written, read = [], [], []
+        for index in range(count):
+            # A different trailer each time, so no upload is deduplicated
+            payload = data + index.to_bytes(4, 'big')
+            # Encoded before counting: the test client spools the request body too
+            environ = EnvironBuilder(path='/ingest', method='POST', data={'file': (BytesIO(payload), 'upload.jpg')},
+                                     content_type='multipart/form-data').get_environ()
+            before = io_counters()
+            started = time.perf_counter()
+            response = client.open(environ)
+            timings.append(time.perf_counter() - started)
+            after = io_counters()
+            assert response.status_code == 200, response.get_data(as_text=True)
+            if before and after:
+                written.append(after[0] - before[0])
+                read.append(after[1] - before[1])
+        key = response.get_json()['key']
+
+        # Interleaved, so both see the same machine load
+        decode = {'path': [], 'buffer': []}
+        for _ in range(DECODE_REPEAT):
+            started = time.perf_counter()
+            with Image.open(key) as img:
+                img.load()
+            decode['path'].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            with storage.open_buffer(key) as buffer, Image.open(buffer) as img:
+                img.load()
+            decode['buffer'].append(time.perf_counter() - started)
+
+        return {
+            'upload_ms': round(statistics.median(timings) * 1000, 2),
+            'written_per_upload': round(statistics.median(written) / len(payload), 2) if written else None,
+            'read_per_upload': round(statistics.median(read) / len(payload), 2) if read else None,
+            'decode_path_ms': round(statistics.median(decode['path']) * 1000, 2),
+            'decode_buffer_ms': round(statistics.median(decode['buffer']) * 1000, 2),
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def run(count=20, size=(3000, 2000)):
+    data = make_image(size)
+    report = {'upload_bytes': len(data)}
+    for mode in MODES:
+        report[mode] = run_mode(mode, data, count)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20, help="uploads per mode (default 20)")
+    parser.add_argument('--size', default='3000x2000', help="JPEG dimensions, WIDTHxHEIGHT (default 3000x2000)")
+    parser.add_argument('--output', metavar='PATH', help="also write the report as JSON")
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.size.lower().split('x'))
+    report = run(args.count, (width, height))
+    print(f"upload size: {report['upload_bytes'] / 2 ** 20:.1f} MB")
+    columns = ('upload_ms', 'written_per_upload', 'read_per_upload', 'decode_path_ms', 'decode_buffer_ms')
+    print(f"{'mode':<8}" + ''.join(f"{column:>20}" for column in columns))
+    for mode in MODES:
+        print(f"{mode:<8}" + ''.join(f"{str(report[mode][column]):>20}" for column in columns))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+# benchmarks/bench_load.py
+"""Drive the whole request path (routes, Celery, result download) under load.
+
+    python benchmarks/bench_load.py --clients 16 --duration 30 --workers 4
+    python benchmarks/bench_load.py --mix upload=1,status=8,list=1,download=2 --output run.json
+
+The app runs with Celery's in-memory broker and an in-process worker on a
+thread pool, so no Redis is needed. Many virtual clients register, log in
+and then pick operations by the --mix weights until --duration runs out.
+Per endpoint throughput and p50/p95/p99 latency are reported, with the
+time tasks waited in the queue and ran in the worker. --output writes the
+same numbers, plus the run settings, as JSON for comparing runs.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from celery.contrib.testing.worker import start_worker
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from PIL import Image
+from config import Config
+from app import create_app
+from celery_app import create_celery_app
+
+OPERATIONS = ('upload', 'status', 'list', 'download', 'login')
+DEFAULT_MIX = 'upload=2,status=6,list=1,download=2,login=1'
+
+class Recorder:
+    """Thread-safe latency samples per endpoint, plus Celery queue timings"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.queue_wait = []
+        self.task_run = []
+        self._published = {}
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok=True):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def connect_signals(self):
+        before_task_publish.connect(self._on_publish, weak=False)
+        task_prerun.connect(self._on_prerun, weak=False)
+        task_postrun.connect(self._on_postrun, weak=False)
+
+    def disconnect_signals(self):
+        before_task_publish.disconnect(self._on_publish)
+        task_prerun.disconnect(self._on_prerun)
+        task_postrun.disconnect(self._on_postrun)
+
+    def wait_idle(self, timeout):
+        """Wait for published tasks to finish, so none outlives the run's database"""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            with self._lock:
+                if not self._published and not self._started:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def _on_publish(self, headers=None, **kwargs):
+        with self._lock:
+            self._published[headers['id']] = time.perf_counter()
+
+    def _on_prerun(self, task_id=None, **kwargs):
+        now = time.perf_counter()
+        with self._lock:
+            self._started[task_id] = now
+            published = self._published.pop(task_id, None)
+            if published is not None:
+                self.queue_wait.append(now - published)
+
+    def _on_postrun(self, task_id=None, **kwargs):
+        now = time.perf_counter()
+        with self._lock:
+            started = self._started.pop(task_id, None)
+            if started is not None:
+                self.task_run.append(now - started)
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))] * 1000
+    return {
+        'count': len(ordered),
+        'p50_ms': round(pick(0.50), 2),
+        'p95_ms': round(pick(0.95), 2),
+        'p99_ms': round(pick(0.99), 2),
+    }
+
+class VirtualClient:
+    def __init__(self, app, index, image_bytes, recorder, rng):
+        self.client = app.test_client()
+        self.name = f"load-user-{index}"
+        self.password = 'load-password'
+        self.image_bytes = image_bytes
+        self.recorder = recorder
+        self.rng = rng
+        self.headers = {}
+        self.pending = []
+        self.completed = []
+        self.uploads = 0
+
+    def request(self, name, method, url, ok_statuses, **kwargs):
+        started = time.perf_counter()
+        response = self.client.open(url, method=method, headers=self.headers, **kwargs)
+        self.recorder.record(name, time.perf_counter() - started, response.status_code in ok_statuses)
+        return response
+
+    def run(self, weights, deadline):
+        self.request('register', 'POST', '/api/register', (201,),
+                     json={'name': self.name, 'password': self.password})
+        self.login()
+        while time.perf_counter() < deadline:
+            getattr(self, self.choose(weights))()
+
+    def choose(self, weights):
+        available = {op: weight for op, weight in weights.items() if weight and self.can(op)}
+        return self.rng.choices(list(available), weights=list(available.values()))[0]
+
+    def can(self, op):
+        if op == 'status':
+            return bool(self.pending)
+        if op == 'download':
+            return bool(self.completed)
+        return True
+
+    def login(self):
+        response = self.request('login', 'POST', '/api/login', (200,),
+                                json={'name': self.name, 'password': self.password})
+        if response.status_code == 200:
+            self.headers = {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+    def upload(self):
+        # Bytes after the JPEG end marker are ignored by decoders but make every
+        # upload unique, so deduplication doesn't skip the worker
+        self.uploads += 1
+        data = self.image_bytes + f"{self.name}-{self.uploads}".encode()
+        response = self.request('upload', 'POST', '/api/upload', (200, 202),
+                                data={'file': (BytesIO(data), 'load.jpg')},
+                                content_type='multipart/form-data')
+        data = response.get_json() or {}
+        if response.status_code == 202:
+            self.pending.append(data['image_id'])
+        elif response.status_code == 200:
+            self.completed.append(data['image_id'])
+
+    def status(self):
+        image_id = self.rng.choice(self.pending)
+        response = self.request('status', 'GET', f'/api/images/{image_id}', (200,))
+        status = (response.get_json() or {}).get('status')
+        if status in ('completed', 'failed'):
+            self.pending.remove(image_id)
+            if status == 'completed':
+                self.completed.append(image_id)
+
+    def list(self):
+        self.request('list', 'GET', '/api/images?limit=20', (200,))
+
+    def download(self):
+        image_id = self.rng.choice(self.completed)
+        self.request('download', 'GET', f'/api/images/{image_id}/result', (200,))
+
+def parse_mix(mix):
+    weights = {op: 0 for op in OPERATIONS}
+    for part in mix.split(','):
+        op, _, weight = part.partition('=')
+        if op not in weights:
+            raise SystemExit(f"Unknown operation in --mix: {op}")
+        weights[op] = float(weight or 1)
+    return weights
+
+def build_configs(args, workdir):
+    class LoadConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database_url or f"sqlite:///{os.path.join(workdir, 'load.db')}"
+        UPLOAD_FOLDER = os.path.join(workdir, 'uploads')
+        PROCESSED_FOLDER = os.path.join(workdir, 'processed')
+        ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+        CELERY_BROKER_URL = 'memory://'
+        CELERY_RESULT_BACKEND = 'cache+memory://'
+        PROCESSING_MODE = 'async'
+        # Go through Celery even though the broker is in-memory
+        PROCESSING_BACKEND = 'celery'
+        PROCESSING_BATCH_SIZE = args.batch_size
+        PASSWORD_PBKDF2_ITERATIONS = args.password_iterations
+    return LoadConfig
+
+def make_image(size):
+    img = Image.effect_noise(size, 48).convert('RGB')
+    output = BytesIO()
+    img.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+def run(args):
+    weights = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix='bench-load-')
+    recorder = Recorder()
+    recorder.connect_signals()
+    app = None
+    try:
+        config = build_configs(args, workdir)
+        app = create_app(config)
+        worker_celery = create_celery_app(config)
+        # The in-memory transport polls; the default 1s interval would dominate queue wait
+        worker_celery.conf.broker_transport_options = {'polling_interval': 0.005}
+        # It also has no event loop, so the worker's blocking loop acks finished tasks only
+        # between 2s waits for new messages. With a prefetch window, a backed-up queue would
+        # then drain one window every 2s; without one, every queued task reaches the pool at once
+        worker_celery.conf.worker_prefetch_multiplier = 0
+        size = tuple(int(v) for v in args.image_size.split('x'))
+        rng = random.Random(args.seed)
+
+        with start_worker(worker_celery, pool='threads', concurrency=args.workers,
+                          perform_ping_check=False, loglevel='WARNING'):
+            image_bytes = make_image(size)
+            clients = [VirtualClient(app, i, image_bytes, recorder,
+                                     random.Random(rng.random())) for i in range(args.clients)]
+            started = time.perf_counter()
+            deadline = started + args.duration
+            threads = [threading.Thread(target=client.run, args=(weights, deadline)) for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            if not recorder.wait_idle(args.drain_timeout):
+                print(f"Tasks still queued after {args.drain_timeout}s; queue timings are incomplete")
+
+        endpoints = {}
+        for name, samples in sorted(recorder.samples.items()):
+            endpoints[name] = {
+                **percentiles(samples),
+                'errors': recorder.errors.get(name, 0),
+                'rps': round(len(samples) / elapsed, 2),
+            }
+        return {
+            'meta': {
+                'clients': args.clients,
+                'workers': args.workers,
+                'duration': args.duration,
+                'mix': weights,
+                'image_size': args.image_size,
+                'batch_size': args.batch_size,
+                'database': 'custom' if args.database_url else 'sqlite',
+                'elapsed': round(elapsed, 2),
+            },
+            'endpoints': endpoints,
+            'queue_wait': percentiles(recorder.queue_wait),
+            'task_run': percentiles(recorder.task_run),
+        }
+    finally:
+        recorder.disconnect_signals()
+        if app:
+            app.extensions['task_dispatcher'].shutdown()
+            app.extensions['password_hasher'].shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_report(report):
+    meta = report['meta']
+    print(f"{meta['clients']} clients, {meta['workers']} workers, {meta['elapsed']}s")
+    print(f"{'endpoint':<12}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = list(report['endpoints'].items()) + [('queue wait', report['queue_wait']), ('task run', report['task_run'])]
+    for name, stats in rows:
+        if not stats['count']:
+            continue
+        print(f"{name:<12}{stats['count']:>8}{stats.get('errors', ''):>8}{stats.get('rps', ''):>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4, help="Celery worker threads")
+    parser.add_argument('--duration', type=float, default=20, help="seconds of load")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument('--image-size', default='1280x800')
+    parser.add_argument('--batch-size', type=int, default=1, help="PROCESSING_BATCH_SIZE")
+    parser.add_argument('--password-iterations', type=int, default=Config.PASSWORD_PBKDF2_ITERATIONS)
+    parser.add_argument('--database-url', help="defaults to a temporary SQLite file")
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help="seconds to wait for queued tasks after the load stops")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the operation mix")
+    parser.add_argument('--output', help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved report to {args.output}")
+
+if __name__ == '__main__':
+    main()
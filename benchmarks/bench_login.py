@@ -0,0 +1,84 @@
+# benchmarks/bench_login.py
+"""Measure login throughput and latency through the Flask app.
+
+    python benchmarks/bench_login.py --method scrypt --concurrency 16 --requests 400
+
+Each run uses a temporary SQLite database and folders. Compare runs with
+different --method/--cost/--workers/--executor values to size the hasher.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from app import create_app
+
+def build_app(args, workdir):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        UPLOAD_FOLDER = os.path.join(workdir, 'uploads')
+        PROCESSED_FOLDER = os.path.join(workdir, 'processed')
+        ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+        CELERY_BROKER_URL = 'memory://'
+        CELERY_RESULT_BACKEND = 'cache+memory://'
+        PASSWORD_HASH_METHOD = args.method
+        PASSWORD_HASH_WORKERS = args.workers
+        PASSWORD_HASH_EXECUTOR = args.executor
+        if args.cost:
+            PASSWORD_PBKDF2_ITERATIONS = args.cost
+            PASSWORD_SCRYPT_N = args.cost
+    return create_app(BenchConfig)
+
+def login(client, name, password):
+    started = time.perf_counter()
+    response = client.post('/api/login', json={'name': name, 'password': password})
+    if response.status_code != 200:
+        raise RuntimeError(f"Login failed with {response.status_code}: {response.get_json()}")
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', choices=['pbkdf2', 'scrypt'], default='pbkdf2')
+    parser.add_argument('--cost', type=int, help="pbkdf2 iterations or scrypt N (default: config)")
+    parser.add_argument('--workers', type=int, default=2, help="concurrent hashes (PASSWORD_HASH_WORKERS)")
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--concurrency', type=int, default=8, help="simultaneous clients")
+    parser.add_argument('--requests', type=int, default=100, help="total logins")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-login-')
+    try:
+        app = build_app(args, workdir)
+        setup = app.test_client()
+        setup.post('/api/register', json={'name': 'bench', 'password': 'bench-password'})
+        login(setup, 'bench', 'bench-password')  # start the hashing pool before timing
+
+        clients = [app.test_client() for _ in range(args.concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            latencies = list(executor.map(
+                lambda i: login(clients[i % args.concurrency], 'bench', 'bench-password'),
+                range(args.requests)
+            ))
+        elapsed = time.perf_counter() - started
+        app.extensions['password_hasher'].shutdown()
+
+        latencies.sort()
+        print(f"method={app.extensions['password_hasher'].method} workers={args.workers} "
+              f"executor={args.executor} concurrency={args.concurrency}")
+        print(f"{args.requests} logins in {elapsed:.2f}s: {args.requests / elapsed:.1f} logins/s")
+        print(f"latency p50={statistics.median(latencies) * 1000:.1f}ms "
+              f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms "
+              f"max={latencies[-1] * 1000:.1f}ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
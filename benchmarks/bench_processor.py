@@ -0,0 +1,211 @@
+# benchmarks/bench_processor.py
+"""Time each ImageProcessor stage on synthetic images and guard against regressions.
+
+    python benchmarks/bench_processor.py --save benchmarks/baseline.json
+    python benchmarks/bench_processor.py --compare benchmarks/baseline.json
+
+Inputs (JPEG, CMYK JPEG, PNG, palette PNG and GIF, thumbnail to 40 MP) are
+generated into a temporary folder. Each case runs in a fresh process. Stage
+times are those process_image reports to its metrics, the median of
+--repeat runs. Peak RSS, which includes Pillow's pixel buffers, comes from a
+separate untimed run first. With --compare, the exit status is 1 when
+throughput drops or peak RSS grows by more than the thresholds.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PIL
+from PIL import Image
+from services.metrics import NullMetrics
+
+SIZES = {
+    'thumb': (160, 120),
+    '1mp': (1280, 800),
+    '12mp': (4000, 3000),
+    '40mp': (7744, 5163),
+}
+# name -> (format, extension, mode)
+VARIANTS = {
+    'jpeg': ('JPEG', 'jpg', 'RGB'),
+    'jpeg-cmyk': ('JPEG', 'jpg', 'CMYK'),
+    'png': ('PNG', 'png', 'RGB'),
+    'png-palette': ('PNG', 'png', 'P'),
+    'gif': ('GIF', 'gif', 'P'),
+}
+# process_image validates while it decodes, so there is no separate validate stage
+STAGES = ('decode', 'transform', 'encode', 'commit')
+
+def generate_input(folder, variant, size_name):
+    """Write a noisy gradient image, which compresses like a photo rather than a flat fill"""
+    image_format, extension, mode = VARIANTS[variant]
+    size = SIZES[size_name]
+    img = Image.merge('RGB', (
+        Image.effect_noise(size, 48),
+        Image.linear_gradient('L').resize(size),
+        Image.radial_gradient('L').resize(size),
+    ))
+    if mode == 'P':
+        img = img.quantize(256)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    path = os.path.join(folder, f"{variant}-{size_name}.{extension}")
+    img.save(path, image_format)
+    return path
+
+class StageRecorder(NullMetrics):
+    """Metrics that keep the duration of every stage process_image times"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    @contextmanager
+    def time_stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - started
+
+def run_case(path, pipeline_spec, repeat):
+    """Run in a child process: one untimed run for peak RSS, then repeat timed runs"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from models import Base, ImageUpload
+    from services.image_processor import ImageProcessor
+    from services.metrics import set_metrics
+    from services.pipeline import Pipeline
+    from utils.memory_utils import MemoryUtils
+
+    processor = ImageProcessor(os.path.dirname(path))
+    logger = logging.getLogger('bench_processor')
+    engine = create_engine(f"sqlite:///{path}.db")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        image = ImageUpload(user_id=1, original_filename=os.path.basename(path), upload_path=path,
+                            pipeline=Pipeline.from_spec(pipeline_spec).to_json() if pipeline_spec else None)
+        session.add(image)
+        session.commit()
+
+        MemoryUtils.reset_peak_rss()
+        result = processor.process_image(image, session, logger)
+        peak_rss = MemoryUtils.peak_rss_bytes()
+        if result['status'] != 'completed':
+            raise RuntimeError(f"{os.path.basename(path)}: {result.get('error')}")
+
+        timings, totals = {stage: [] for stage in STAGES}, []
+        for _ in range(repeat):
+            recorder = StageRecorder()
+            previous = set_metrics(recorder)
+            try:
+                started = time.perf_counter()
+                processor.process_image(image, session, logger)
+                totals.append(time.perf_counter() - started)
+            finally:
+                set_metrics(previous)
+            for stage in STAGES:
+                timings[stage].append(recorder.seconds[stage])
+    engine.dispose()
+
+    with Image.open(path) as img:
+        megapixels = img.width * img.height / 1e6
+    total_ms = statistics.median(totals) * 1000
+    return {
+        'megapixels': round(megapixels, 3),
+        'stages_ms': {stage: round(statistics.median(values) * 1000, 3) for stage, values in timings.items()},
+        'total_ms': round(total_ms, 3),
+        'throughput_mps': round(megapixels / (total_ms / 1000), 3),
+        'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+    }
+
+def run_benchmarks(variants, sizes, repeat=3, pipeline_spec=None):
+    workdir = tempfile.mkdtemp(prefix='bench-processor-')
+    try:
+        cases = {}
+        context = multiprocessing.get_context('spawn')
+        for size_name in sizes:
+            for variant in variants:
+                path = generate_input(workdir, variant, size_name)
+                # A fresh process per case keeps peak RSS attributable to that case
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    cases[f"{variant}-{size_name}"] = executor.submit(run_case, path, pipeline_spec, repeat).result()
+                os.remove(path)
+        return {
+            'meta': {
+                'python': platform.python_version(),
+                'pillow': PIL.__version__,
+                'machine': platform.machine(),
+                'repeat': repeat,
+                'pipeline': pipeline_spec,
+            },
+            'cases': cases,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(results, baseline, throughput_threshold=0.10, rss_threshold=0.10):
+    """Return a list of regression messages for cases present in both runs"""
+    regressions = []
+    for name, current in results['cases'].items():
+        previous = baseline['cases'].get(name)
+        if not previous:
+            continue
+        if current['throughput_mps'] < previous['throughput_mps'] * (1 - throughput_threshold):
+            regressions.append(f"{name}: throughput {current['throughput_mps']} MP/s "
+                               f"< baseline {previous['throughput_mps']} MP/s")
+        if current['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + rss_threshold):
+            regressions.append(f"{name}: peak RSS {current['peak_rss_mb']} MB "
+                               f"> baseline {previous['peak_rss_mb']} MB")
+    return regressions
+
+def print_table(results):
+    header = f"{'case':<22}" + ''.join(f"{stage:>11}" for stage in STAGES) + f"{'total':>11}{'MP/s':>10}{'RSS MB':>9}"
+    print(header)
+    for name, case in results['cases'].items():
+        print(f"{name:<22}" + ''.join(f"{case['stages_ms'][stage]:>11.2f}" for stage in STAGES)
+              + f"{case['total_ms']:>11.2f}{case['throughput_mps']:>10.2f}{case['peak_rss_mb']:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', nargs='+', choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--pipeline', help="pipeline JSON (default: grayscale, 800x600, JPEG)")
+    parser.add_argument('--save', metavar='PATH', help="write results as a JSON baseline")
+    parser.add_argument('--compare', metavar='PATH', help="fail on regressions against this baseline")
+    parser.add_argument('--throughput-threshold', type=float, default=0.10,
+                        help="allowed throughput drop as a fraction (default 0.10)")
+    parser.add_argument('--rss-threshold', type=float, default=0.10,
+                        help="allowed peak RSS growth as a fraction (default 0.10)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.variants, args.sizes, args.repeat, args.pipeline)
+    print_table(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.throughput_threshold, args.rss_threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+if __name__ == '__main__':
+    main()
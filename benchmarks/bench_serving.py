@@ -0,0 +1,139 @@
+# benchmarks/bench_serving.py
+"""Compare request throughput of the development server and serve.py.
+
+    python benchmarks/bench_serving.py --clients 16 --duration 20
+    python benchmarks/bench_serving.py --servers serve --workload io --workers 4 --output serving.json
+
+Each server runs as its own process on a fresh SQLite database: `python
+app.py` (Flask's development server, one process) and `python serve.py`
+(gunicorn, with the app preloaded). Once /health answers, a user
+registers and many client threads then request the image list and
+/health over HTTP until --duration runs out. Throughput and p50/p99
+latency are reported per server.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = ('dev', 'serve')
+READY_TIMEOUT = 60
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def request(url, data=None, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f"Bearer {token}"
+    body = json.dumps(data).encode() if data is not None else None
+    with urllib.request.urlopen(urllib.request.Request(url, body, headers), timeout=30) as response:
+        return response.status, response.read()
+
+def start_server(name, port, workdir, workload, workers):
+    env = dict(os.environ, PYTHONPATH=ROOT, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'serving.db')}",
+               PORT=str(port), SERVE_BIND=f"127.0.0.1:{port}", SERVE_WORKLOAD=workload)
+    if workers:
+        env['SERVE_WORKERS'] = str(workers)
+    script = 'app.py' if name == 'dev' else 'serve.py'
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, script)], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} server exited with status {process.returncode}")
+        try:
+            request(f"http://127.0.0.1:{port}/health")
+            return process
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{name} server not ready after {READY_TIMEOUT}s")
+
+def drive(base_url, clients, duration):
+    _, body = request(f"{base_url}/api/register", {'name': 'bench', 'password': 'bench-password'})
+    token = json.loads(body)['access_token']
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(index):
+        paths = ('/api/images', '/health')
+        count = 0
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                request(f"{base_url}{paths[(index + count) % len(paths)]}", token=token)
+                ok = True
+            except (urllib.error.URLError, ConnectionError):
+                ok = False
+            elapsed = time.perf_counter() - started
+            count += 1
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1) if latencies else None,
+    }
+
+def run(servers=SERVERS, clients=16, duration=10, workload='auto', workers=None):
+    report = {}
+    for name in servers:
+        workdir = tempfile.mkdtemp(prefix='bench-serving-')
+        port = free_port()
+        process = start_server(name, port, workdir, workload, workers)
+        try:
+            report[name] = drive(f"http://127.0.0.1:{port}", clients, duration)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=list(SERVERS))
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help="seconds per server (default 10)")
+    parser.add_argument('--workload', choices=('auto', 'cpu', 'io'), default='auto', help="SERVE_WORKLOAD for serve.py")
+    parser.add_argument('--workers', type=int, help="SERVE_WORKERS for serve.py (default: from the core count)")
+    parser.add_argument('--output', metavar='PATH', help="also write the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args.servers, args.clients, args.duration, args.workload, args.workers)
+    columns = ('requests', 'errors', 'rps', 'p50_ms', 'p99_ms')
+    print(f"{'server':<8}" + ''.join(f"{column:>12}" for column in columns))
+    for name, summary in report.items():
+        print(f"{name:<8}" + ''.join(f"{str(summary[column]):>12}" for column in columns))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
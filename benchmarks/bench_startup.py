@@ -0,0 +1,104 @@
+# benchmarks/bench_startup.py
+"""Measure cold start of the API and Celery worker processes.
+
+    python benchmarks/bench_startup.py --repeat 10
+    python benchmarks/bench_startup.py --targets worker --output startup.json
+
+Every run is a fresh interpreter, as an autoscaled worker would be. It
+reports the time to import the entry module, build the app, and encode
+a first image, plus the whole process wall time and how many modules
+and Pillow plugins were loaded. The first run creates the database
+schema; the following runs only check its version, as restarts do.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child; prints one JSON line of timings
+CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+if sys.argv[1] == 'api':
+    from app import create_app as factory
+else:
+    from celery_app import create_celery_app as factory
+imported = time.perf_counter()
+factory()
+created = time.perf_counter()
+
+from io import BytesIO
+from PIL import Image
+# WebP isn't one of the formats Pillow preloads, so this is where it would load every plugin
+output = BytesIO()
+Image.new('RGB', (64, 64)).save(output, 'WEBP')
+Image.open(output).load()
+first_image = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_ms': (created - imported) * 1000,
+    'first_image_ms': (first_image - created) * 1000,
+    'modules': len(sys.modules),
+    'pillow_plugins': sum(name.endswith('ImagePlugin') for name in sys.modules),
+    'celery_loaded': 'celery.app.base' in sys.modules,
+}))
+"""
+
+TARGETS = ('api', 'worker')
+
+def run_once(target, workdir):
+    env = dict(os.environ, PYTHONPATH=ROOT, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+               PROCESSING_BACKEND='thread', CELERY_BROKER_URL='memory://', CELERY_RESULT_BACKEND='cache+memory://')
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD, target], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+def run(targets=TARGETS, repeat=5):
+    report = {}
+    for target in targets:
+        workdir = tempfile.mkdtemp(prefix='bench-startup-')
+        try:
+            first = run_once(target, workdir)
+            warm = [run_once(target, workdir) for _ in range(repeat)]
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        summary = {key: round(statistics.median(run[key] for run in warm), 1)
+                   for key in ('import_ms', 'create_ms', 'first_image_ms', 'process_ms')}
+        summary.update(
+            first_boot_create_ms=round(first['create_ms'], 1),
+            modules=warm[-1]['modules'],
+            pillow_plugins=warm[-1]['pillow_plugins'],
+            celery_loaded=warm[-1]['celery_loaded'],
+        )
+        report[target] = summary
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=5, help="warm restarts per target (default 5)")
+    parser.add_argument('--output', metavar='PATH', help="also write the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args.targets, args.repeat)
+    columns = ('import_ms', 'create_ms', 'first_image_ms', 'process_ms', 'first_boot_create_ms',
+               'modules', 'pillow_plugins', 'celery_loaded')
+    print(f"{'target':<8}" + ''.join(f"{column:>22}" for column in columns))
+    for target, summary in report.items():
+        print(f"{target:<8}" + ''.join(f"{str(summary[column]):>22}" for column in columns))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,23 @@
 # celery_app.py
-from celery import Celery
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from config import Config
-from models import Base, ImageUpload
-from services import ImageProcessor, CleanupService
+from extensions import celery as shared_celery
 
-def create_celery_app():
-    # Create Flask app for Celery worker context
-    app = Flask(__name__)
-    app.config.from_object(Config)
-    
-    # Initialize database
-    db = SQLAlchemy(model_class=Base)
-    db.init_app(app)
-    
-    # Create Celery instance with proper configuration
-    celery = Celery(
-        app.import_name,
-        broker=app.config['CELERY_BROKER_URL'],
-        backend=app.config['CELERY_RESULT_BACKEND']
-    )
-    
-    # Update Celery configuration
-    celery.conf.update(
-        task_serializer='json',
-        accept_content=['json'],
-        result_serializer='json',
-        timezone='UTC',
-        enable_utc=True,
-    )
-    
-    # Define tasks properly
-    @celery.task(name="tasks.process_image")
-    def process_image_task(image_id):
-        with app.app_context():
-            try:
-                # Re-initialize database session for Celery worker
-                image = db.session.get(ImageUpload, image_id)
-                if not image:
-                    app.logger.error(f"Image {image_id} not found")
-                    return {"error": "Image not found"}
+def create_celery_app(config_class=Config):
+    """Build the worker's Flask app and return the shared Celery app, with its tasks, bound to it"""
+    from app import create_core_app
+    import tasks.image_tasks  # noqa: F401 - registers the tasks
 
-                app.logger.info(f"Processing image {image_id}")
-                
-                processor = ImageProcessor(app.config['PROCESSED_FOLDER'])
-                result = processor.process_image(image, db.session, app.logger)
-                
-                app.logger.info(f"Image processing completed: {result}")
-                return result
-                
-            except Exception as e:
-                app.logger.error(f"Error processing image {image_id}: {str(e)}")
-                return {"error": str(e)}
+    create_core_app(config_class)
+    return shared_celery._get_current_object()
 
-    @celery.task(name="tasks.cleanup_old_files")
-    def cleanup_old_files_task():
-        with app.app_context():
-            try:
-                app.logger.info("Starting cleanup task")
-                cleanup_service = CleanupService()
-                result = cleanup_service.cleanup_old_files(db.session, app.logger)
-                app.logger.info(f"Cleanup completed: {result} files removed")
-                return {"status": "completed", "files_removed": result}
-                
-            except Exception as e:
-                app.logger.error(f"Error in cleanup task: {str(e)}")
-                return {"error": str(e)}
-    
-    return celery
-
-# Create the Celery app instance
-celery = create_celery_app()
+def __getattr__(name):
+    # Built on first access (celery -A celery_app.celery), so importing this
+    # module for create_celery_app doesn't also build an app from Config
+    if name == 'celery':
+        global celery
+        celery = create_celery_app()
+        return celery
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
-    celery.start()
\ No newline at end of file
+    create_celery_app().start()
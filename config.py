@@ -6,15 +6,125 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key'
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'your-jwt-secret-key'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
+    
+    # Password hashing ('pbkdf2' or 'scrypt'); stored hashes are upgraded on login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2'
+    PASSWORD_PBKDF2_ITERATIONS = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', 600000))
+    PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 15))
+    PASSWORD_SCRYPT_R = 8
+    PASSWORD_SCRYPT_P = 1
+    # Concurrent hashes per web process, on a 'thread' or 'process' pool
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_EXECUTOR = os.environ.get('PASSWORD_HASH_EXECUTOR') or 'thread'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///image_processor.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Engine pool for server databases (PostgreSQL, MySQL); pre-ping and recycle
+    # replace connections the server or a proxy dropped while idle
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    # SQLite runs in WAL mode so readers don't block the writer; writers wait up to
+    # SQLITE_BUSY_TIMEOUT seconds for the lock, and status commits that still
+    # conflict are retried DB_COMMIT_RETRIES times with backoff
+    SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 30))
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    DB_COMMIT_RETRIES = int(os.environ.get('DB_COMMIT_RETRIES', 5))
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
     
     # Celery Configuration (consistent old format)
     CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL') or 'redis://localhost:6379/0'
     CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND') or 'redis://localhost:6379/0'
     
+    # Cleanup Configuration (tasks.cleanup_old_files runs on the Celery beat schedule)
+    CLEANUP_RETENTION_DAYS = float(os.environ.get('CLEANUP_RETENTION_DAYS', 1))
+    CLEANUP_INTERVAL_SECONDS = int(os.environ.get('CLEANUP_INTERVAL_SECONDS', 3600))
+    CLEANUP_CHUNK_SIZE = 500
+    CLEANUP_TIME_BUDGET_SECONDS = 60
+    CLEANUP_DELETE_WORKERS = 8
+    
+    # Processed result delivery: None streams through Flask, 'x-sendfile' (Apache,
+    # lighttpd) or 'x-accel' (nginx, internal location at SENDFILE_ACCEL_PREFIX)
+    # lets the proxy send the bytes once the request is authorized
+    SENDFILE_MODE = os.environ.get('SENDFILE_MODE') or None
+    SENDFILE_ACCEL_PREFIX = os.environ.get('SENDFILE_ACCEL_PREFIX') or '/protected-results/'
+    RESULT_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+    
+    # Status notifications: Redis pub/sub URL, or in-process only when unset
+    STATUS_NOTIFIER_URL = os.environ.get('STATUS_NOTIFIER_URL') or None
+    STATUS_WAIT_TIMEOUT = 25  # longest long-poll, in seconds
+    STATUS_STREAM_TIMEOUT = 300  # longest SSE stream, in seconds
+    STATUS_RECHECK_INTERVAL = 5  # re-read the database (and send SSE keepalives) this often
+    
+    # Prometheus metrics on /metrics. Under gunicorn or with local worker
+    # processes, also set PROMETHEUS_MULTIPROC_DIR to an empty directory
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+    
+    # Processing Configuration ('sync' processes inside the request, 'async' enqueues it)
+    PROCESSING_MODE = os.environ.get('PROCESSING_MODE') or 'sync'
+    PROCESSING_EXECUTOR_WORKERS = int(os.environ.get('PROCESSING_EXECUTOR_WORKERS', 4))
+    # Coalesce queued ids into tasks.process_images_batch when greater than 1
+    PROCESSING_BATCH_SIZE = int(os.environ.get('PROCESSING_BATCH_SIZE', 1))
+    PROCESSING_BATCH_MAX_WAIT = float(os.environ.get('PROCESSING_BATCH_MAX_WAIT', 0.05))
+    # 'auto', 'celery', 'thread' or 'process' (local process pool, no broker needed)
+    PROCESSING_BACKEND = os.environ.get('PROCESSING_BACKEND') or 'auto'
+    PROCESSING_POOL_WORKERS = int(os.environ['PROCESSING_POOL_WORKERS']) if os.environ.get('PROCESSING_POOL_WORKERS') else None
+    PROCESSING_QUEUE_SIZE = int(os.environ['PROCESSING_QUEUE_SIZE']) if os.environ.get('PROCESSING_QUEUE_SIZE') else None
+    PROCESSING_SUBMIT_TIMEOUT = float(os.environ.get('PROCESSING_SUBMIT_TIMEOUT', 30))
+    PROCESSING_RECONCILE_ON_START = True
+    # Decode limits, checked from the image header before any pixel data is read.
+    # Larger images fail; decodes over the memory budget are downscaled strip by
+    # strip (non-interlaced PNG) or fail. Pillow itself refuses anything over ~179 MP
+    PROCESSING_MAX_PIXELS = int(os.environ.get('PROCESSING_MAX_PIXELS', 100_000_000))
+    PROCESSING_MEMORY_BUDGET = int(os.environ.get('PROCESSING_MEMORY_BUDGET', 512 * 1024 * 1024))
+    # Animated GIF/WebP inputs keep their frames when the output is gif, webp or auto
+    PROCESSING_MAX_FRAMES = int(os.environ.get('PROCESSING_MAX_FRAMES', 1000))
+    PROCESSING_MAX_ANIMATION_PIXELS = int(os.environ.get('PROCESSING_MAX_ANIMATION_PIXELS', 1_000_000_000))
+    PROCESSING_FRAME_WORKERS = int(os.environ.get('PROCESSING_FRAME_WORKERS', 4))
+    # Batches sharing a pipeline and image size are transformed as one NumPy array
+    # (needs numpy). Off by default: it pays off with a multi-threaded BLAS on
+    # several cores, and on one core Pillow's resampler is faster
+    PROCESSING_BATCH_KERNEL = os.environ.get('PROCESSING_BATCH_KERNEL', 'false').lower() == 'true'
+    
+    # serve.py (gunicorn). SERVE_WORKLOAD is 'cpu' (a few gthread threads per
+    # worker, for inline processing), 'io' (eventlet green threads) or 'auto' (from
+    # PROCESSING_MODE and the backend); SERVE_WORKERS overrides the per-core worker count
+    SERVE_BIND = os.environ.get('SERVE_BIND') or '0.0.0.0:5000'
+    SERVE_WORKLOAD = os.environ.get('SERVE_WORKLOAD') or 'auto'
+    SERVE_WORKERS = int(os.environ['SERVE_WORKERS']) if os.environ.get('SERVE_WORKERS') else None
+    SERVE_MAX_REQUESTS = int(os.environ.get('SERVE_MAX_REQUESTS', 1000))
+    SERVE_MAX_REQUESTS_JITTER = int(os.environ.get('SERVE_MAX_REQUESTS_JITTER', 100))
+    SERVE_TIMEOUT = int(os.environ.get('SERVE_TIMEOUT', 120))
+    SERVE_READY_TIMEOUT = float(os.environ.get('SERVE_READY_TIMEOUT', 30))
+    
     # File Upload Configuration
     UPLOAD_FOLDER = 'uploads/originals'
     PROCESSED_FOLDER = 'uploads/processed'
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
\ No newline at end of file
+    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    BATCH_MAX_FILES = 100
+    
+    # Where originals and results are kept: 'local' (the two folders above, in
+    # hash-prefixed subdirectories STORAGE_SHARD_DEPTH levels deep) or 's3' (any
+    # S3-compatible store; credentials from the usual AWS_* variables)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'local'
+    STORAGE_SHARD_DEPTH = int(os.environ.get('STORAGE_SHARD_DEPTH', 2))
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # None for AWS itself
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_UPLOAD_PREFIX = os.environ.get('S3_UPLOAD_PREFIX') or 'originals/'
+    S3_PROCESSED_PREFIX = os.environ.get('S3_PROCESSED_PREFIX') or 'processed/'
+    # GET /api/images pages only when asked to with ?limit= or ?cursor=
+    LIST_IMAGES_DEFAULT_LIMIT = 50
+    LIST_IMAGES_MAX_LIMIT = 200
+    
+    # On-the-fly renditions (GET /api/images/<id>/result?w=&h=&fmt=&q=)
+    RENDITION_FOLDER = os.path.join(PROCESSED_FOLDER, 'renditions')
+    RENDITION_CACHE_MAX_BYTES = int(os.environ.get('RENDITION_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    RENDITION_DISK_MAX_BYTES = int(os.environ.get('RENDITION_DISK_MAX_BYTES', 1024 * 1024 * 1024))
+    RENDITION_MAX_DIMENSION = 4000
+    
+    # Encoder settings overriding services/pipeline.py ENCODER_PRESETS per output
+    # variant ('jpeg', 'png', 'webp', 'webp-lossless'), e.g.
+    # {'webp': {'quality': 75, 'effort': 6}}; pipelines may still set their own
+    ENCODER_PRESETS = {}
\ No newline at end of file
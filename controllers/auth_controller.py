@@ -3,9 +3,9 @@ from services.auth_service import AuthService
 from schemas.user_schema import UserRegistrationSchema, UserLoginSchema
 
 class AuthController:
-    def __init__(self, db):
+    def __init__(self, db, password_hasher=None):
         self.db = db
-        self.auth_service = AuthService(db.session)
+        self.auth_service = AuthService(db.session, password_hasher)
         self.registration_schema = UserRegistrationSchema()
         self.login_schema = UserLoginSchema()
     
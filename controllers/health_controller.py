@@ -1,5 +1,6 @@
-from flask import jsonify
+from flask import jsonify, Response
 from sqlalchemy import select
+from services.metrics import render_metrics
 
 class HealthController:
     def __init__(self, db):
@@ -10,4 +11,8 @@ class HealthController:
             self.db.session.execute(select(1))
             return jsonify({"status": "healthy", "db": "connected"}), 200
         except Exception as e:
-            return jsonify({"status": "unhealthy", "error": str(e)}), 500
\ No newline at end of file
+            return jsonify({"status": "unhealthy", "error": str(e)}), 500
+    
+    def metrics(self):
+        body, content_type = render_metrics()
+        return Response(body, content_type=content_type)
\ No newline at end of file
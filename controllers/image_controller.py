@@ -1,18 +1,37 @@
 # controllers/image_controller.py
-from flask import request, jsonify, send_from_directory, current_app
+from flask import request, jsonify, send_file, current_app, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from services.image_service import ImageService
-from services.image_processor import ImageProcessor
-from pathlib import Path
+from services.image_service import ImageService, UNFINISHED_STATUSES
+from services.image_processor import ImageProcessor, ImageTooLargeError
+from services.execution_backends import QueueFullError
+from services.status_notifier import StatusNotifier
+from models.image import ImageStatus
+from datetime import datetime, timezone
+from io import BytesIO
+from urllib.parse import urlencode
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import wrap_file
+import json
+import mimetypes
 import os
+import time
+import uuid
+
+# Query parameters that turn a result download into an on-the-fly rendition
+RENDITION_ARGS = ('w', 'h', 'fmt', 'q')
+STREAM_CHUNK_SIZE = 64 * 1024
 
 class ImageController:
-    def __init__(self, db, upload_folder, processed_folder, allowed_extensions):
+    def __init__(self, db, upload_storage, result_storage, allowed_extensions,
+                 task_dispatcher=None, rendition_cache=None, status_notifier=None):
         self.db = db
-        self.image_service = ImageService(db.session, upload_folder, processed_folder)
-        self.upload_folder = upload_folder
-        self.processed_folder = processed_folder
+        self.image_service = ImageService(db.session, upload_storage, result_storage)
+        self.upload_storage = upload_storage
+        self.result_storage = result_storage
         self.allowed_extensions = allowed_extensions
+        self.task_dispatcher = task_dispatcher
+        self.rendition_cache = rendition_cache
+        self.status_notifier = status_notifier or StatusNotifier()
     
     @jwt_required()
     def upload_image(self):
@@ -25,11 +44,26 @@ class ImageController:
             file = request.files['file']
             
             # Upload image
-            image = self.image_service.upload_image(current_user_id, file, self.allowed_extensions)
+            image = self.image_service.upload_image(
+                current_user_id, file, self.allowed_extensions, request.form.get('pipeline'))
+            
+            # Identical bytes were already processed with the same pipeline
+            if image.status == ImageStatus.COMPLETED.value:
+                return jsonify({
+                    "message": "Image uploaded and processed successfully",
+                    "image_id": image.id,
+                    "original_filename": image.original_filename,
+                    "status": "completed",
+                    "deduplicated": True
+                }), 200
+            
+            if current_app.config.get('PROCESSING_MODE', 'sync') == 'async' and self.task_dispatcher:
+                return self._enqueue_processing(image)
             
             # Process image synchronously (for development)
             try:
-                processor = ImageProcessor(self.processed_folder)
+                processor = ImageProcessor(self.result_storage, self.status_notifier,
+                                           **ImageProcessor.options_from_config(current_app.config))
                 # Use current_app.logger or a simple print function for logging
                 result = processor.process_image(image, self.db.session, current_app.logger)
                 
@@ -59,6 +93,83 @@ class ImageController:
         except Exception as e:
             return jsonify({"error": str(e)}), 500
     
+    @jwt_required()
+    def upload_images_batch(self):
+        try:
+            current_user_id = int(get_jwt_identity())
+            
+            files = request.files.getlist('files')
+            if not files:
+                return jsonify({"error": "No files provided"}), 400
+            max_files = current_app.config.get('BATCH_MAX_FILES', 100)
+            if len(files) > max_files:
+                return jsonify({"error": f"Too many files, the limit is {max_files}"}), 400
+            
+            images, errors = self.image_service.upload_images(
+                current_user_id, files, self.allowed_extensions, request.form.get('pipeline'))
+            if not images:
+                return jsonify({"error": "No valid files", "errors": errors}), 400
+            
+            # Batches are always queued; the dispatcher falls back to local workers without a broker
+            try:
+                self.task_dispatcher.dispatch_many(
+                    [(image["id"], image["task_id"]) for image in images if image["task_id"]])
+            except QueueFullError as e:
+                # The rows are committed: report every id, with the dropped ones already marked failed
+                failed = set(e.image_ids)
+                for image in images:
+                    if image["id"] in failed:
+                        image["status"] = ImageStatus.FAILED.value
+                return jsonify({
+                    "error": str(e),
+                    "images": self._batch_images(images),
+                    "errors": errors
+                }), 503, {"Retry-After": "5"}
+            
+            return jsonify({
+                "message": f"{len(images)} images uploaded",
+                "images": self._batch_images(images),
+                "errors": errors
+            }), 202
+            
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    
+    @staticmethod
+    def _batch_images(images):
+        return [{
+            "image_id": image["id"],
+            "original_filename": image["original_filename"],
+            "status": image["status"],
+            "task_id": image["task_id"],
+            "status_url": f"/api/images/{image['id']}"
+        } for image in images]
+    
+    def _enqueue_processing(self, image):
+        # Store the task id before dispatching so a fast worker can't race the commit
+        task_id = str(uuid.uuid4())
+        self.image_service.assign_task(image, task_id)
+        try:
+            self.task_dispatcher.dispatch(image.id, task_id)
+        except QueueFullError as e:
+            # The dispatcher has marked the image, and any batched with it, failed
+            return jsonify({
+                "error": str(e),
+                "image_id": image.id,
+                "status": ImageStatus.FAILED.value
+            }), 503, {"Retry-After": "5"}
+        
+        return jsonify({
+            "message": "Image uploaded and queued for processing",
+            "image_id": image.id,
+            "original_filename": image.original_filename,
+            "status": image.status,
+            "task_id": task_id,
+            "status_url": f"/api/images/{image.id}"
+        }), 202
+    
     @jwt_required()
     def get_image_status(self, image_id):
         try:
@@ -75,6 +186,7 @@ class ImageController:
                 "image_id": image.id,
                 "original": image.original_filename,
                 "status": image.status,
+                "task_id": image.task_id,
                 "uploaded_at": image.uploaded_at.isoformat(),
                 "result_url": result_url
             })
@@ -84,6 +196,164 @@ class ImageController:
         except Exception as e:
             return jsonify({"error": str(e)}), 500
     
+    @jwt_required()
+    def wait_image_status(self, image_id):
+        """Long-poll: answer once the image leaves ?status=, or once it is finished"""
+        try:
+            current_user_id = int(get_jwt_identity())
+            try:
+                timeout = self._wait_timeout(request.args)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            
+            image = self.image_service.get_image_by_id(image_id)
+            self.image_service.validate_image_access(image, current_user_id)
+            
+            known = self._known_statuses({image.id: image.status}, request.args.get('status'))
+            changed = self._wait_for_change(current_user_id, known, timeout)
+            status = changed.get(image.id, image.status)
+            return jsonify({**self._status_payload(image.id, status), "changed": image.id in changed})
+            
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 404 if "not found" in str(e).lower() else 403
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    
+    @jwt_required()
+    def stream_image_events(self, image_id):
+        """Server-sent events for one image until it is finished"""
+        try:
+            current_user_id = int(get_jwt_identity())
+            image = self.image_service.get_image_by_id(image_id)
+            self.image_service.validate_image_access(image, current_user_id)
+            
+            known = self._known_statuses({image.id: image.status}, request.args.get('status'))
+            return self._event_stream(current_user_id, known)
+            
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 404 if "not found" in str(e).lower() else 403
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    
+    @jwt_required()
+    def wait_user_images(self):
+        """Long-poll over the user's unfinished images (or ?ids=), answering on the first change"""
+        try:
+            current_user_id = int(get_jwt_identity())
+            try:
+                timeout = self._wait_timeout(request.args)
+                image_ids = self._ids_arg(request.args)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            
+            known = self._known_statuses(self.image_service.get_statuses(current_user_id, image_ids))
+            changed = self._wait_for_change(current_user_id, known, timeout)
+            return jsonify({
+                "images": [self._status_payload(image_id, status) for image_id, status in changed.items()],
+                "pending": [image_id for image_id in known
+                            if changed.get(image_id, known[image_id]) in UNFINISHED_STATUSES]
+            })
+            
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    
+    @jwt_required()
+    def stream_user_events(self):
+        """Server-sent events for the user's unfinished images (or ?ids=) until all are finished"""
+        try:
+            current_user_id = int(get_jwt_identity())
+            try:
+                image_ids = self._ids_arg(request.args)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            
+            known = self._known_statuses(self.image_service.get_statuses(current_user_id, image_ids))
+            return self._event_stream(current_user_id, known)
+            
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    
+    def _event_stream(self, user_id, known):
+        timeout = current_app.config.get('STATUS_STREAM_TIMEOUT', 300)
+        
+        def generate():
+            for changed in self._watch(user_id, known, timeout):
+                if not changed:
+                    yield ": keepalive\n\n"
+                    continue
+                for image_id, status in changed.items():
+                    yield f"event: status\ndata: {json.dumps(self._status_payload(image_id, status))}\n\n"
+            yield "event: end\ndata: {}\n\n"
+        
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    def _wait_for_change(self, user_id, known, timeout):
+        for changed in self._watch(user_id, known, timeout):
+            if changed:
+                return changed
+        return {}
+    
+    def _watch(self, user_id, known, timeout):
+        """Yield {image_id: status} as watched images change, or None after a quiet interval.
+        
+        The notifier only wakes the loop; statuses are always read from the
+        database, so a missed notification delays an answer by at most
+        STATUS_RECHECK_INTERVAL seconds.
+        """
+        known = dict(known)
+        deadline = time.monotonic() + timeout
+        recheck = current_app.config.get('STATUS_RECHECK_INTERVAL', 5)
+        while known:
+            cursor = self.status_notifier.cursor()
+            statuses = self.image_service.get_statuses(user_id, list(known))
+            # End the read transaction so no pooled connection is held while waiting
+            self.db.session.commit()
+            
+            changed = {}
+            for image_id in list(known):
+                status = statuses.get(image_id)
+                if status != known[image_id]:
+                    if status:
+                        changed[image_id] = status
+                    if status in UNFINISHED_STATUSES:
+                        known[image_id] = status
+                    else:
+                        del known[image_id]
+            yield changed or None
+            
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not known:
+                return
+            self.status_notifier.wait(user_id, cursor, min(remaining, recheck))
+    
+    def _known_statuses(self, statuses, client_status=None):
+        """Statuses to wait against; a finished image the client hasn't seen is reported at once"""
+        return {
+            image_id: client_status or (status if status in UNFINISHED_STATUSES else None)
+            for image_id, status in statuses.items()
+        }
+    
+    def _status_payload(self, image_id, status):
+        result_url = f"/api/images/{image_id}/result" if status == ImageStatus.COMPLETED.value else None
+        return {"image_id": image_id, "status": status, "result_url": result_url}
+    
+    def _wait_timeout(self, args):
+        max_timeout = current_app.config.get('STATUS_WAIT_TIMEOUT', 25)
+        try:
+            timeout = float(args.get('timeout', max_timeout))
+        except ValueError:
+            raise ValueError("Invalid timeout: must be a number")
+        return min(max(timeout, 0), max_timeout)
+    
+    def _ids_arg(self, args):
+        if not args.get('ids'):
+            return None
+        try:
+            return [int(image_id) for image_id in args['ids'].split(',')]
+        except ValueError:
+            raise ValueError("Invalid ids: expected comma-separated image ids")
+    
     @jwt_required()
     def get_processed_image(self, image_id):
         try:
@@ -94,28 +364,157 @@ class ImageController:
             
             if image.status != "completed":
                 return jsonify({"error": "Image not ready", "status": image.status}), 400
+            if self.rendition_cache and any(request.args.get(arg) for arg in RENDITION_ARGS):
+                return self._send_rendition(image)
             if not image.result_path:
                 return jsonify({"error": "No result path saved"}), 500
             
-            result_path = Path(image.result_path)
-            if not result_path.exists():
-                return jsonify({"error": "Processed file was deleted or not saved"}), 500
-            
-            return send_from_directory(
-                str(result_path.parent),
-                str(result_path.name)
-            )
+            pipeline = self.image_service.get_pipeline(image)
+            if pipeline.negotiable and self.rendition_cache:
+                return self._send_negotiated(image, pipeline)
+            return self._send_result(image)
             
+        except FileNotFoundError:
+            return jsonify({"error": "Processed file was deleted or not saved"}), 500
+        except ImageTooLargeError as e:
+            return jsonify({"error": str(e)}), 413
         except ValueError as e:
             return jsonify({"error": str(e)}), 404 if "not found" in str(e).lower() else 403
         except Exception as e:
             return jsonify({"error": str(e)}), 500
     
+    def _send_rendition(self, image):
+        try:
+            pipeline = self.image_service.get_rendition_pipeline(
+                image, request.args, current_app.config.get('RENDITION_MAX_DIMENSION', 4000))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if pipeline.negotiable:
+            return self._send_negotiated(image, pipeline)
+        # The upload's own pipeline is already rendered as the stored result
+        if pipeline.cache_key == image.pipeline_key and self.result_storage.exists(image.result_path):
+            return self._send_result(image)
+        return self._send_rendered(image, pipeline)
+    
+    def _send_negotiated(self, image, pipeline):
+        """Serve an 'auto' output as WebP when the client accepts it, otherwise in the stored format"""
+        # Without WebP, 'auto' stores GIF for animations, PNG for images with alpha and JPEG for the rest
+        stored = os.path.splitext(image.result_path or '')[1]
+        has_alpha = stored == '.png'
+        if self._accepts_webp():
+            response = self._send_rendered(image, pipeline.with_format('webp', lossless=has_alpha))
+        elif pipeline.cache_key == image.pipeline_key:
+            response = self._send_result(image)
+        else:
+            response = self._send_rendered(image, pipeline.resolve(has_alpha, animated=stored == '.gif'))
+        response.vary.add('Accept')
+        return response
+    
+    def _accepts_webp(self):
+        # Only an explicit image/webp counts: */* from generic clients keeps the stored format
+        return any(value == 'image/webp' and quality > 0 for value, quality in request.accept_mimetypes)
+    
+    def _send_rendered(self, image, pipeline):
+        # A rendition is fully determined by the source bytes and the pipeline
+        stem = image.content_hash or os.path.splitext(os.path.basename(image.upload_path))[0]
+        key = f"{stem}_{pipeline.cache_key[:32]}"
+        if self._not_modified(key, None):
+            return self._cache_headers(current_app.response_class(status=304), key, None)
+        
+        processor = ImageProcessor(self.result_storage, **ImageProcessor.options_from_config(current_app.config))
+        data = self.rendition_cache.get_or_render(
+            key,
+            pipeline.extension,
+            lambda: processor.render(image.upload_path, pipeline)
+        )
+        response = send_file(BytesIO(data), mimetype=pipeline.mimetype, etag=key, conditional=True)
+        return self._cache_headers(response, key, None)
+    
+    def _send_result(self, image):
+        """Serve a stored result with validators, answering revalidation without touching the file"""
+        etag, last_modified = image.result_hash, image.processed_at
+        if etag and self._not_modified(etag, last_modified):
+            return self._cache_headers(current_app.response_class(status=304), etag, last_modified)
+        
+        path = self.result_storage.local_path(image.result_path)
+        if path is None:
+            response = self._stream_object(image.result_path, etag, last_modified)
+        elif current_app.config.get('SENDFILE_MODE') == 'x-accel':
+            # nginx serves the bytes (and any Range) from an internal location
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            relative = os.path.relpath(path, self.result_storage.root).replace(os.sep, '/')
+            prefix = current_app.config.get('SENDFILE_ACCEL_PREFIX', '/protected-results/')
+            response = current_app.response_class(mimetype=mimetypes.guess_type(path)[0])
+            response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{relative}"
+        else:
+            # Handles Range and If-Range; USE_X_SENDFILE hands the bytes to the proxy instead
+            response = send_file(path, etag=etag or True, last_modified=last_modified, conditional=True)
+        return self._cache_headers(response, etag, last_modified)
+    
+    def _stream_object(self, key, etag, last_modified):
+        """Relay an object-storage result in chunks as the client reads it, with Range and If-Range as send_file has"""
+        byte_range = size = None
+        if request.range and self._range_applies(etag, last_modified):
+            size = self.result_storage.size(key)
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                response = current_app.response_class(status=416)
+                response.headers['Content-Range'] = f"bytes */{size}"
+                response.accept_ranges = 'bytes'
+                return response
+        
+        body = self.result_storage.open(key, byte_range)
+        response = current_app.response_class(
+            wrap_file(request.environ, body, STREAM_CHUNK_SIZE),
+            mimetype=mimetypes.guess_type(key)[0], direct_passthrough=True)
+        response.accept_ranges = 'bytes'
+        if byte_range:
+            start, stop = byte_range
+            response.status_code = 206
+            response.content_range = ContentRange('bytes', start, stop, size)
+            response.content_length = stop - start
+        return response
+    
+    @staticmethod
+    def _range_applies(etag, last_modified):
+        # If-Range names the representation the client already has part of; otherwise send it whole
+        if_range = request.if_range
+        if if_range.etag:
+            return bool(etag) and if_range.etag == etag
+        if if_range.date:
+            return bool(last_modified) and last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= if_range.date
+        return True
+    
+    def _not_modified(self, etag, last_modified):
+        # If-None-Match takes precedence over If-Modified-Since
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        if request.if_modified_since and last_modified:
+            return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= request.if_modified_since
+        return False
+    
+    def _cache_headers(self, response, etag, last_modified):
+        # A result never changes for a given image id, so clients may keep it indefinitely
+        response.headers['Cache-Control'] = current_app.config.get(
+            'RESULT_CACHE_CONTROL', 'private, max-age=31536000, immutable')
+        if etag:
+            response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+        return response
+    
     @jwt_required()
     def list_images(self):
         try:
             current_user_id = int(get_jwt_identity())
-            images = self.image_service.get_user_images(current_user_id)
+            try:
+                filters = self._list_filters(request.args)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            
+            images, next_cursor = self.image_service.get_user_images(current_user_id, **filters)
             
             image_list = []
             for img in images:
@@ -131,7 +530,54 @@ class ImageController:
                     "result_url": result_url
                 })
             
-            return jsonify(image_list)
+            response = jsonify(image_list)
+            if next_cursor:
+                # The body stays a bare array; the next page is linked from the headers
+                query = urlencode([(key, value) for key, value in request.args.items(multi=True) if key != 'cursor']
+                                  + [('cursor', next_cursor)])
+                response.headers['X-Next-Cursor'] = next_cursor
+                response.headers['Link'] = f'<{request.path}?{query}>; rel="next"'
+            return response
             
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
\ No newline at end of file
+            return jsonify({"error": str(e)}), 500
+    
+    def _list_filters(self, args):
+        # Without limit or cursor the whole list comes back, as it always has
+        limit = None
+        if 'limit' in args or 'cursor' in args:
+            max_limit = current_app.config.get('LIST_IMAGES_MAX_LIMIT', 200)
+            limit = args.get('limit', current_app.config.get('LIST_IMAGES_DEFAULT_LIMIT', 50))
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise ValueError("Invalid limit: must be an integer")
+            if not 1 <= limit <= max_limit:
+                raise ValueError(f"Invalid limit: must be between 1 and {max_limit}")
+        
+        status = args.get('status')
+        if status and status not in {s.value for s in ImageStatus}:
+            raise ValueError(f"Invalid status: {status}")
+        
+        return {
+            "limit": limit,
+            "cursor": args.get('cursor'),
+            "status": status,
+            "since": self._datetime_arg(args, 'since'),
+            "until": self._datetime_arg(args, 'until')
+        }
+    
+    def _datetime_arg(self, args, name):
+        value = args.get(name)
+        if not value:
+            return None
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid {name}: expected an ISO 8601 datetime")
+        # uploaded_at is stored as naive UTC
+        if parsed.tzinfo:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
@@ -1,8 +1,46 @@
 # extensions.py
-from flask_sqlalchemy import SQLAlchemy
+from celery.local import PromiseProxy
 from flask_jwt_extended import JWTManager
-from celery import Celery
+from flask_sqlalchemy import SQLAlchemy
+from models import Base
 
-db = SQLAlchemy()
+# The one set of extensions; the API and Celery workers each bind them to their app
+db = SQLAlchemy(model_class=Base)
 jwt = JWTManager()
-celery = Celery(__name__)
\ No newline at end of file
+
+_celery_settings = {}
+_flask_app = None
+
+def _create_celery():
+    from celery import Celery
+    app = Celery('image-processing')
+    app.conf.update(_celery_settings)
+    app.flask_app = _flask_app
+    return app
+
+# Celery is imported on first use, so API processes on the thread or process
+# backend never load it. Task modules bind to this same instance
+celery = PromiseProxy(_create_celery)
+
+def init_celery(app):
+    """Configure the shared Celery app from app's config and run its tasks in app's context"""
+    global _flask_app
+    _flask_app = app
+    _celery_settings.update(
+        broker_url=app.config['CELERY_BROKER_URL'],
+        result_backend=app.config['CELERY_RESULT_BACKEND'],
+        task_serializer='json',
+        accept_content=['json'],
+        result_serializer='json',
+        timezone='UTC',
+        enable_utc=True,
+        beat_schedule={
+            'cleanup-old-files': {
+                'task': 'tasks.cleanup_old_files',
+                'schedule': app.config.get('CLEANUP_INTERVAL_SECONDS', 3600),
+            },
+        },
+    )
+    if celery.__evaluated__():
+        celery.conf.update(_celery_settings)
+        celery.flask_app = app
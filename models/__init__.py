@@ -2,5 +2,6 @@
 from .base import Base
 from .users import User
 from .image import ImageUpload, ImageStatus
+from .schema import ensure_schema
 
-__all__ = ['Base', 'User', 'ImageUpload', 'ImageStatus']
\ No newline at end of file
+__all__ = ['Base', 'User', 'ImageUpload', 'ImageStatus', 'ensure_schema']
@@ -0,0 +1,95 @@
+# models/engine.py
+import random
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+POOL_SIZE = 10
+MAX_OVERFLOW = 20
+POOL_TIMEOUT = 30
+POOL_RECYCLE = 1800  # seconds; under typical server and proxy idle timeouts
+SQLITE_BUSY_TIMEOUT = 30  # seconds a writer waits for the lock before failing
+SQLITE_SYNCHRONOUS = 'NORMAL'
+COMMIT_RETRIES = 5
+RETRY_BACKOFF = 0.05  # seconds, doubled per attempt
+MAX_BACKOFF = 2.0
+
+# Messages and SQLSTATEs of conflicts that succeed when the transaction is simply run again
+SQLITE_CONFLICTS = ('database is locked', 'database table is locked', 'database is busy')
+RETRYABLE_SQLSTATES = ('40001', '40P01')  # serialization failure, deadlock
+
+def settings_from_config(config):
+    """The engine settings from an app config, as a plain dict that can be sent to worker processes"""
+    return {
+        'pool_size': config.get('DB_POOL_SIZE', POOL_SIZE),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', MAX_OVERFLOW),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', POOL_TIMEOUT),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', POOL_RECYCLE),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        'sqlite_busy_timeout': config.get('SQLITE_BUSY_TIMEOUT', SQLITE_BUSY_TIMEOUT),
+        'sqlite_synchronous': config.get('SQLITE_SYNCHRONOUS', SQLITE_SYNCHRONOUS),
+    }
+
+def is_sqlite(database_uri):
+    return make_url(database_uri).get_backend_name() == 'sqlite'
+
+def engine_options(database_uri, settings):
+    """create_engine keyword arguments: pool tuning for server databases, the busy timeout for SQLite"""
+    if is_sqlite(database_uri):
+        # Connections are cheap and SQLite has one writer, so pool sizing doesn't apply
+        return {'connect_args': {'timeout': settings['sqlite_busy_timeout']}}
+    return {
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_recycle': settings['pool_recycle'],
+        'pool_pre_ping': settings['pool_pre_ping'],
+    }
+
+def configure_engine(engine, settings):
+    """Switch SQLite connections to WAL, so readers never block the writer or each other"""
+    if engine.dialect.name != 'sqlite':
+        return engine
+    synchronous = settings['sqlite_synchronous']
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Persistent in the database file; in-memory databases stay in 'memory' mode
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only syncs at checkpoints; a power loss can drop the last commits, never corrupt
+        cursor.execute(f'PRAGMA synchronous={synchronous}')
+        cursor.close()
+    return engine
+
+def create_configured_engine(database_uri, settings):
+    """An engine for processes without Flask-SQLAlchemy, set up like the app's"""
+    return configure_engine(create_engine(database_uri, **engine_options(database_uri, settings)), settings)
+
+def is_write_conflict(error):
+    if not isinstance(error, OperationalError):
+        return False
+    if getattr(error.orig, 'pgcode', None) in RETRYABLE_SQLSTATES:
+        return True
+    message = str(error.orig).lower()
+    return any(conflict in message for conflict in SQLITE_CONFLICTS)
+
+def commit_with_retry(session, apply, retries=COMMIT_RETRIES, backoff=RETRY_BACKOFF):
+    """Run apply() and commit, running both again after a write conflict.
+
+    A failed commit rolls the session back and expires its changes, so
+    apply must make them all again. Attempts back off exponentially with
+    jitter, so contending writers spread out instead of colliding again.
+    """
+    for attempt in range(retries + 1):
+        try:
+            result = apply()
+            session.commit()
+            return result
+        except OperationalError as e:
+            session.rollback()
+            if attempt == retries or not is_write_conflict(e):
+                raise
+            delay = min(backoff * 2 ** attempt, MAX_BACKOFF)
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
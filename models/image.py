@@ -1,6 +1,6 @@
 # models/image.py
 from datetime import datetime
-from sqlalchemy import Integer, String, DateTime, ForeignKey
+from sqlalchemy import Integer, String, Text, DateTime, ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column
 from .base import Base
 from enum import Enum
@@ -15,6 +15,10 @@ class ImageStatus(str, Enum):
 
 class ImageUpload(Base):
     __tablename__ = "image_uploads"
+    __table_args__ = (
+        Index("ix_image_uploads_content_pipeline", "content_hash", "pipeline_key"),
+        Index("ix_image_uploads_user_uploaded", "user_id", "uploaded_at", "id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(
@@ -22,11 +26,17 @@ class ImageUpload(Base):
     original_filename: Mapped[str] = mapped_column(String(200), nullable=False)
     upload_path: Mapped[str] = mapped_column(String(500), nullable=False)
     result_path: Mapped[str] = mapped_column(String(500), nullable=True)
+    # SHA-256 of the result bytes, served as the result's strong ETag
+    result_hash: Mapped[str] = mapped_column(String(64), nullable=True)
+    processed_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=True)
+    pipeline: Mapped[str] = mapped_column(Text, nullable=True)
+    pipeline_key: Mapped[str] = mapped_column(String(64), nullable=True)
     status: Mapped[str] = mapped_column(
         String(50), default=ImageStatus.PENDING.value)
     task_id: Mapped[str] = mapped_column(String(100), nullable=True)
     uploaded_at: Mapped[datetime] = mapped_column(
-        DateTime, default=datetime.utcnow)
+        DateTime, default=datetime.utcnow, index=True)
 
     def to_dict(self):
         return {
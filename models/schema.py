@@ -0,0 +1,102 @@
+# models/schema.py
+import hashlib
+from sqlalchemy import Column, MetaData, String, Table, delete, insert, inspect, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn
+from .base import Base
+
+# Outside Base.metadata, so it never changes the fingerprint it stores
+_version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', _version_metadata,
+    Column('fingerprint', String(64), nullable=False),
+)
+
+def schema_fingerprint(metadata=Base.metadata):
+    """Hash of every table, column and index the models declare"""
+    parts = []
+    for table in metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{column.name}:{column.type!r}:{column.nullable}:{column.primary_key}"
+                     for column in table.columns)
+        parts.extend(sorted(f"{index.name}:{[column.name for column in index.columns]}:{index.unique}"
+                            for index in table.indexes))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+class SchemaMismatchError(RuntimeError):
+    """Existing tables differ from the models in a way ensure_schema can't fix in place"""
+
+def ensure_schema(engine, metadata=Base.metadata):
+    """Create or extend the tables unless the database already records the models' fingerprint.
+
+    A matching fingerprint costs one single-row query, where create_all
+    inspects every table on every start. Tables that already exist get
+    any missing nullable columns and indexes, and on PostgreSQL their
+    string columns are widened. The fingerprint is only stored once the
+    tables match the models; anything else raises SchemaMismatchError.
+    Returns True when the schema was created or changed.
+    """
+    fingerprint = schema_fingerprint(metadata)
+    try:
+        with engine.connect() as connection:
+            if connection.execute(select(schema_version.c.fingerprint)).scalar() == fingerprint:
+                return False
+    except DBAPIError:
+        pass  # No version table yet
+
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        migrate_tables(connection, metadata)
+    problems = schema_differences(engine, metadata)
+    if problems:
+        raise SchemaMismatchError("Database schema doesn't match the models: " + "; ".join(problems))
+
+    _version_metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(delete(schema_version))
+        connection.execute(insert(schema_version).values(fingerprint=fingerprint))
+    return True
+
+def migrate_tables(connection, metadata=Base.metadata):
+    """Add what create_all leaves out of tables that already existed: new columns, wider strings, indexes"""
+    dialect = connection.dialect
+    inspector = inspect(connection)
+    for table in metadata.sorted_tables:
+        existing = {column['name']: column for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                if not column.nullable and column.server_default is None:
+                    raise SchemaMismatchError(
+                        f"Can't add {table.name}.{column.name}: it is NOT NULL with no server default")
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} ADD COLUMN {CreateColumn(column).compile(dialect=dialect)}"))
+            elif dialect.name == 'postgresql' and _narrower(existing[column.name]['type'], column.type):
+                column_type = column.type.compile(dialect=dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE {column_type}"))
+
+        index_names = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in index_names:
+                try:
+                    index.create(connection)
+                except DBAPIError as e:
+                    # A unique index over rows that already repeat a value
+                    raise SchemaMismatchError(f"Can't create index {index.name}: {e.orig}") from e
+
+def schema_differences(engine, metadata=Base.metadata):
+    """Columns and indexes the models declare that the database lacks"""
+    inspector = inspect(engine)
+    problems = []
+    for table in metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        problems.extend(f"missing column {table.name}.{column.name}"
+                        for column in table.columns if column.name not in columns)
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        problems.extend(f"missing index {index.name}" for index in table.indexes if index.name not in indexes)
+    return problems
+
+def _narrower(reflected, declared):
+    # SQLite ignores string lengths, so only server databases are widened
+    length = getattr(declared, 'length', None)
+    current = getattr(reflected, 'length', None)
+    return length is not None and current is not None and current < length
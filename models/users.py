@@ -1,21 +1,15 @@
 # models/user.py
 from sqlalchemy import Integer, String
 from sqlalchemy.orm import Mapped, mapped_column
-from werkzeug.security import generate_password_hash, check_password_hash
 from .base import Base  
 
 class User(Base):
     __tablename__ = "users"
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    name: Mapped[str] = mapped_column(String(1000), nullable=False)
-    password: Mapped[str] = mapped_column(String(100), nullable=False)
-    
-    def set_password(self, password):
-        self.password = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
-    
-    def check_password(self, password):
-        return check_password_hash(self.password, password)
+    name: Mapped[str] = mapped_column(String(1000), nullable=False, unique=True, index=True)
+    # Hashed by services.password_hasher.PasswordHasher; wide enough for scrypt hashes
+    password: Mapped[str] = mapped_column(String(255), nullable=False)
     
     def to_dict(self):
         return {
@@ -0,0 +1,153 @@
+# serve.py
+"""Production entry point: gunicorn with the app preloaded in the master.
+
+    python serve.py
+    SERVE_WORKLOAD=io SERVE_WORKERS=8 python serve.py
+
+The app is built once before forking, so workers share the imported
+modules and app objects copy-on-write instead of each importing them
+(except eventlet workers: those must patch the standard library before
+the app is imported, so each loads its own copy after forking).
+Workers are recycled after SERVE_MAX_REQUESTS requests (plus jitter, so
+they don't all restart at once), and each runs the health check before
+it accepts connections.
+"""
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from config import Config
+
+# Nothing from the app is imported in the master until the worker class is
+# known: eventlet must patch sockets and locks before any library creates them.
+# Hence these mirror services.task_dispatcher and services.execution_backends
+LOCAL_BROKER_URLS = {'', 'memory://'}
+READY_POLL_INTERVAL = 0.5
+CPU_WORKER_THREADS = 4
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def choose_workload(config):
+    """'cpu' when requests process images inline, 'io' when processing runs elsewhere.
+
+    Uploads are processed in the web process in sync mode, and in async
+    mode without a broker (the thread backend), so workers are CPU bound.
+    With Celery or the process backend, requests mostly wait on the
+    database, disk and broker.
+    """
+    if config.get('PROCESSING_MODE', 'sync') != 'async':
+        return 'cpu'
+    backend = config.get('PROCESSING_BACKEND', 'auto')
+    if backend == 'auto':
+        backend = 'thread' if (config.get('CELERY_BROKER_URL') or '') in LOCAL_BROKER_URLS else 'celery'
+    return 'cpu' if backend == 'thread' else 'io'
+
+def worker_settings(workload, cores, workers=None):
+    """gunicorn worker class and counts for a workload on this many cores.
+
+    CPU-bound: one worker per core plus one, to keep every core busy while
+    a worker waits on the database. Each has a few threads, not one sync
+    request: a sync worker can't heartbeat while it streams, so gunicorn
+    would kill SSE streams and long polls at SERVE_TIMEOUT, and a handful
+    of them would hold every worker. I/O-bound: one eventlet worker per
+    core, each serving many connections on green threads (or a thread
+    pool, when eventlet isn't installed).
+    """
+    if workload == 'cpu':
+        return {'worker_class': 'gthread', 'workers': workers or cores + 1, 'threads': CPU_WORKER_THREADS}
+    try:
+        import eventlet  # noqa: F401
+    except ImportError:
+        return {'worker_class': 'gthread', 'workers': workers or cores, 'threads': 8}
+    return {'worker_class': 'eventlet', 'workers': workers or cores, 'worker_connections': 1000}
+
+def serve_options(config):
+    """gunicorn settings from the SERVE_* config"""
+    workload = config.get('SERVE_WORKLOAD', 'auto')
+    if workload == 'auto':
+        workload = choose_workload(config)
+    options = worker_settings(workload, available_cores(), config.get('SERVE_WORKERS'))
+    options.update(
+        bind=config.get('SERVE_BIND', '0.0.0.0:5000'),
+        # gunicorn's eventlet worker patches after forking; a preloaded app would keep real locks
+        preload_app=options['worker_class'] != 'eventlet',
+        max_requests=config.get('SERVE_MAX_REQUESTS', 1000),
+        max_requests_jitter=config.get('SERVE_MAX_REQUESTS_JITTER', 100),
+        timeout=config.get('SERVE_TIMEOUT', 120),
+        graceful_timeout=config.get('SERVE_GRACEFUL_TIMEOUT', 30),
+        keepalive=config.get('SERVE_KEEPALIVE', 5),
+        accesslog=config.get('SERVE_ACCESS_LOG'),
+        # Heartbeat files on tmpfs; a disk-backed /tmp can stall workers (notably in containers)
+        worker_tmp_dir='/dev/shm' if os.path.isdir('/dev/shm') else None,
+    )
+    return options
+
+def create_server(config_class=Config, **overrides):
+    """A gunicorn application serving create_app(config_class)"""
+    from gunicorn.app.base import BaseApplication
+
+    config = {key: getattr(config_class, key) for key in dir(config_class) if key.isupper()}
+    options = {**serve_options(config), **overrides}
+
+    class ImageApplication(BaseApplication):
+        def __init__(self):
+            # Taken in the master, so every worker's reconcile shares one cutoff
+            self.started_at = datetime.utcnow()
+            super().__init__()
+
+        def load_config(self):
+            for key, value in options.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+            self.cfg.set('post_fork', post_fork)
+            self.cfg.set('post_worker_init', post_worker_init)
+            self.cfg.set('child_exit', child_exit)
+
+        def load(self):
+            from app import create_app
+            # Reconciling jobs is left to the first worker, so only one process ever does it
+            return create_app(config_class, start_dispatcher=False)
+
+    return ImageApplication()
+
+def post_fork(server, worker):
+    # Pooled connections were opened in the master; a child must never reuse them
+    if not server.cfg.preload_app:
+        return
+    from extensions import db
+    app = worker.app.wsgi()
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def post_worker_init(worker):
+    """Readiness: only accept connections once /health passes, retrying until the timeout"""
+    app = worker.app.wsgi()
+    deadline = time.monotonic() + app.config.get('SERVE_READY_TIMEOUT', 30)
+    client = app.test_client()
+    while True:
+        response = client.get('/health')
+        if response.status_code == 200:
+            break
+        if time.monotonic() >= deadline:
+            worker.log.error(f"Worker {worker.pid} not ready: {response.get_json()}")
+            sys.exit(3)  # gunicorn's boot error: the master stops instead of respawning forever
+        time.sleep(READY_POLL_INTERVAL)
+    if worker.age == 1:
+        # Only jobs from before the server started: other workers are already queueing new uploads
+        app.extensions['task_dispatcher'].start(before=worker.app.started_at)
+    worker.log.info(f"Worker {worker.pid} ready")
+
+def child_exit(server, worker):
+    # Drop a dead worker's live gauges (queue depth) from the aggregated /metrics
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    create_server().run()
@@ -1,7 +1,30 @@
 # services/__init__.py
-from .auth_service import AuthService
-from .image_service import ImageService
-from .image_processor import ImageProcessor
-from .cleanup_service import CleanupService
+import importlib
 
-__all__ = ['AuthService', 'ImageService', 'ImageProcessor', 'CleanupService']
\ No newline at end of file
+# Exported name -> defining module. Imported on first access, so a worker that
+# only needs the image processor doesn't load the API's services (and Celery)
+_EXPORTS = {
+    'AuthService': '.auth_service',
+    'ImageService': '.image_service',
+    'ImageProcessor': '.image_processor',
+    'ImageTooLargeError': '.image_processor',
+    'CleanupService': '.cleanup_service',
+    'TaskDispatcher': '.task_dispatcher',
+    'QueueFullError': '.execution_backends',
+    'RenditionCache': '.rendition_cache',
+    'StatusNotifier': '.status_notifier',
+    'create_status_notifier': '.status_notifier',
+    'PasswordHasher': '.password_hasher',
+    'LocalStorage': '.storage',
+    'S3Storage': '.storage',
+    'create_storage': '.storage',
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
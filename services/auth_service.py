@@ -1,25 +1,33 @@
+from flask import current_app
 from flask_jwt_extended import create_access_token
 from models.users import User
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 
 class AuthService:
-    def __init__(self, db_session):
+    def __init__(self, db_session, password_hasher=None):
         self.db_session = db_session
+        # Share the app's hasher, and its worker pool, unless one is given
+        self.password_hasher = password_hasher or current_app.extensions['password_hasher']
     
     def register_user(self, name, password):
         # Check if user already exists
         existing_user = self.db_session.execute(
-            select(User).where(User.name == name)
+            select(User.id).where(User.name == name)
         ).scalar()
         
         if existing_user:
             return None, "User already exists"
         
         # Create new user
-        new_user = User(name=name)
-        new_user.set_password(password)
+        new_user = User(name=name, password=self.password_hasher.hash(password))
         self.db_session.add(new_user)
-        self.db_session.commit()
+        try:
+            self.db_session.commit()
+        except IntegrityError:
+            # Lost a race with a concurrent registration of the same name
+            self.db_session.rollback()
+            return None, "User already exists"
         
         # Generate access token
         access_token = create_access_token(identity=str(new_user.id))
@@ -30,7 +38,11 @@ class AuthService:
             select(User).where(User.name == name)
         ).scalar()
         
-        if user and user.check_password(password):
+        if user and self.password_hasher.verify(user.password, password):
+            # Upgrade hashes made with older parameters while the password is at hand
+            if self.password_hasher.needs_rehash(user.password):
+                user.password = self.password_hasher.hash(password)
+                self.db_session.commit()
             access_token = create_access_token(identity=str(user.id))
             return user, access_token
         
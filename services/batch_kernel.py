@@ -0,0 +1,130 @@
+# services/batch_kernel.py
+from PIL import Image
+from services.pipeline import Pipeline, POINT_OPERATIONS, point_lut
+
+# NumPy is optional and imported on the first available() call, so processes
+# that never enable the kernel don't pay for it. Without it, Pillow does everything
+np = None
+
+# Pillow premultiplies alpha when resampling, so images with an alpha band stay on Pillow
+MODES = ('L', 'RGB')
+SUPPORTED_OPERATIONS = ('grayscale', 'resize', 'crop') + POINT_OPERATIONS
+# Largest weight matrix (output x input pixels along one axis); bigger resamples stay on Pillow
+MAX_WEIGHTS = 16 * 1024 * 1024
+BICUBIC_SUPPORT = 2.0
+
+
+def available():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
+
+def supports(pipeline, mode=None):
+    """True when the kernel can run pipeline's transforms (on images of mode, if given)"""
+    if not available() or (mode is not None and mode not in MODES):
+        return False
+    operations = [op['op'] for op in pipeline.operations[:-1]]
+    if not all(op in SUPPORTED_OPERATIONS for op in operations):
+        return False
+    # transform_batch converts, then resamples, then runs point operations; other orders stay on Pillow
+    stages = [0 if op == 'grayscale' else 2 if op in POINT_OPERATIONS else 1 for op in operations]
+    return stages == sorted(stages)
+
+
+def transform_batch(images, pipeline, source_size):
+    """Apply pipeline's transforms to same-size, same-mode decoded images as one array.
+
+    Grayscale conversion, the fused crop/resize (bicubic, like Image.resize)
+    and point operations each run once over the whole (N, H, W, C) stack.
+    Resampling matches Pillow to within two levels per channel (point
+    operations may stretch that, and a threshold can flip a pixel).
+    Returns one Pillow image per input, in order.
+    """
+    mode = images[0].mode
+    batch = np.stack([np.asarray(img) for img in images])
+    if batch.ndim == 3:
+        batch = batch[..., None]
+
+    if pipeline.grayscale and mode != 'L':
+        batch, mode = _gray(batch)[..., None], 'L'
+    geometry = [op for op in pipeline.operations if op['op'] in ('resize', 'crop')]
+    if geometry:
+        batch = _resample(batch, geometry, source_size)
+    for op in pipeline.operations:
+        if op['op'] in POINT_OPERATIONS:
+            batch = _point(batch, op)
+
+    if mode == 'L':
+        batch = batch[..., 0]
+    return [Image.fromarray(frame) for frame in batch]
+
+
+def _gray(batch):
+    # ITU-R 601-2 luma with Pillow's fixed-point weights and rounding
+    rgb = batch[..., :3].astype(np.uint32)
+    return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+
+def _resample(batch, geometry, source_size):
+    """Fused crop/resize, as Pipeline._resample does it, with dense separable weights"""
+    _, height, width, _ = batch.shape
+    out, box = Pipeline._fuse(geometry, source_size)
+    sx, sy = width / source_size[0], height / source_size[1]
+    box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+    if out == (width, height) and box == (0, 0, width, height):
+        return batch
+
+    int_box = tuple(round(v) for v in box)
+    if int_box == box and out == (int_box[2] - int_box[0], int_box[3] - int_box[1]):
+        # Pure crop, no resampling needed
+        return batch[:, int_box[1]:int_box[3], int_box[0]:int_box[2]]
+
+    if out[0] * width > MAX_WEIGHTS or out[1] * height > MAX_WEIGHTS:
+        raise ValueError("Resample is too large for the batch kernel")
+    # Planar (N, C, H, W) so both passes are batched BLAS matrix products
+    result = batch.transpose(0, 3, 1, 2).astype(np.float32)
+    # Horizontal then vertical, rounding in between, in Pillow's order
+    if out[0] != width or box[0] != 0 or box[2] != width:
+        result = np.clip(np.rint(result @ _weights(width, out[0], box[0], box[2]).T), 0, 255)
+    if out[1] != height or box[1] != 0 or box[3] != height:
+        result = np.clip(np.rint(_weights(height, out[1], box[1], box[3]) @ result), 0, 255)
+    return result.astype(np.uint8).transpose(0, 2, 3, 1)
+
+
+def _weights(in_size, out_size, in0, in1):
+    """(out_size, in_size) bicubic coefficients, computed the way Pillow's resampler does"""
+    scale = (in1 - in0) / out_size
+    filterscale = max(scale, 1.0)
+    support = BICUBIC_SUPPORT * filterscale
+    weights = np.zeros((out_size, in_size), dtype=np.float32)
+    for xx in range(out_size):
+        center = in0 + (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        taps = _bicubic((np.arange(xmin, xmax) - center + 0.5) / filterscale)
+        total = taps.sum()
+        weights[xx, xmin:xmax] = taps / total if total else taps
+    return weights
+
+
+def _bicubic(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(x < 1, ((a + 2) * x - (a + 3)) * x * x + 1,
+                    np.where(x < 2, (((x - 5) * x + 8) * x - 4) * a, 0))
+
+
+def _point(batch, op):
+    """Look every channel up in the op's table"""
+    if op['op'] != 'contrast':
+        return np.array(point_lut(op), dtype=np.uint8)[batch]
+    # One table per image, pivoting on its own mean gray level
+    gray = batch[..., 0] if batch.shape[-1] == 1 else _gray(batch)
+    means = np.floor(gray.reshape(len(batch), -1).mean(axis=1) + 0.5)
+    luts = np.array([point_lut(op, int(mean)) for mean in means], dtype=np.uint8)
+    return luts[np.arange(len(batch))[:, None, None, None], batch]
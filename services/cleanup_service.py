@@ -1,35 +1,98 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from sqlalchemy import select, delete, or_
 from models.image import ImageUpload
 from utils.file_utils import FileUtils
 
 class CleanupService:
-    def __init__(self):
-        pass
-    
+    def __init__(self, chunk_size=500, time_budget=None, delete_workers=8, storage=None, rendition_folder=None):
+        self.chunk_size = chunk_size
+        self.time_budget = time_budget
+        self.delete_workers = delete_workers
+        # Any storage deletes every key of its backend; without one, keys are local paths
+        self.storage = storage
+        self.rendition_folder = rendition_folder
+
     def cleanup_old_files(self, db_session, app_logger, days_old=1):
+        """Delete images older than days_old in chunks, committing each chunk.
+
+        Stops early once time_budget seconds have passed; the remaining rows
+        are still expired, so the next run picks up where this one stopped.
+        """
         try:
             cutoff = datetime.utcnow() - timedelta(days=days_old)
-            
-            # Query old images
-            old_images = db_session.query(ImageUpload).filter(
-                ImageUpload.uploaded_at < cutoff
-            ).all()
+            deadline = time.monotonic() + self.time_budget if self.time_budget is not None else None
 
             deleted_count = 0
-            for img in old_images:
-                # Delete associated files
-                for path in [img.upload_path, img.result_path]:
-                    FileUtils.delete_file(path)
-                
-                # Delete database record
-                db_session.delete(img)
-                deleted_count += 1
-
-            db_session.commit()
-            app_logger.info(f"Cleanup complete: {deleted_count} old images removed")
+            while True:
+                # Query the oldest expired images through the uploaded_at index
+                rows = db_session.execute(
+                    select(ImageUpload.id, ImageUpload.upload_path, ImageUpload.result_path)
+                    .where(ImageUpload.uploaded_at < cutoff)
+                    .order_by(ImageUpload.uploaded_at)
+                    .limit(self.chunk_size)
+                ).all()
+                if not rows:
+                    break
+
+                candidate_paths = {path for row in rows for path in (row.upload_path, row.result_path) if path}
+                db_session.execute(
+                    delete(ImageUpload)
+                    .where(ImageUpload.id.in_([row.id for row in rows]))
+                    .execution_options(synchronize_session=False)
+                )
+                # Deduplicated uploads share files, so keep any still referenced
+                still_referenced = self._referenced_paths(db_session, candidate_paths)
+                db_session.commit()
+
+                self._delete_files(candidate_paths - still_referenced)
+                deleted_count += len(rows)
+
+                if len(rows) < self.chunk_size:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    app_logger.info(f"Cleanup time budget used up after {deleted_count} images, resuming next run")
+                    break
+
+            renditions = self._delete_unused_renditions(days_old)
+            app_logger.info(f"Cleanup complete: {deleted_count} old images and {renditions} unused renditions removed")
             return deleted_count
-            
+
         except Exception as e:
             app_logger.error(f"Cleanup task failed: {e}")
             db_session.rollback()
-            raise
\ No newline at end of file
+            raise
+
+    def _delete_unused_renditions(self, days_old):
+        """Delete renditions not read for days_old days, so none outlives the image it was rendered from.
+
+        A disk hit refreshes a rendition's mtime, and a deleted image's
+        renditions are never read again.
+        """
+        if not self.rendition_folder or not os.path.isdir(self.rendition_folder):
+            return 0
+        cutoff = time.time() - days_old * 24 * 3600
+        with os.scandir(self.rendition_folder) as it:
+            stale = [entry.path for entry in it if entry.is_file() and entry.stat().st_mtime < cutoff]
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(self.delete_workers, len(stale))) as executor:
+                list(executor.map(FileUtils.delete_file, stale))
+        return len(stale)
+
+    def _delete_files(self, paths):
+        if not paths:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.delete_workers, len(paths))) as executor:
+            list(executor.map(self.storage.delete if self.storage else FileUtils.delete_file, paths))
+
+    def _referenced_paths(self, db_session, paths):
+        if not paths:
+            return set()
+        rows = db_session.execute(
+            select(ImageUpload.upload_path, ImageUpload.result_path).where(
+                or_(ImageUpload.upload_path.in_(paths), ImageUpload.result_path.in_(paths))
+            )
+        ).all()
+        return {path for row in rows for path in row if path in paths}
@@ -0,0 +1,197 @@
+# services/execution_backends.py
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from sqlalchemy.orm import sessionmaker
+from models.engine import create_configured_engine, settings_from_config
+from services.image_processor import ImageProcessor
+from services.metrics import get_metrics, init_metrics
+from services.processing_jobs import JOBS
+from services.status_notifier import create_status_notifier
+from services.storage import create_storage
+
+class QueueFullError(Exception):
+    """Raised when a local backend's submission queue stays full past the timeout.
+
+    submitted counts the calls of a submit_many() queued before it filled;
+    image_ids, once the dispatcher has failed them, lists the dropped images.
+    """
+
+    def __init__(self, message="Processing queue is full", submitted=0, image_ids=()):
+        super().__init__(message)
+        self.submitted = submitted
+        self.image_ids = list(image_ids)
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class CeleryBackend:
+    """Sends jobs to Celery workers through the configured broker"""
+
+    name = "celery"
+    loses_jobs_on_exit = False
+
+    def __init__(self, celery):
+        self.celery = celery
+
+    def submit(self, task_name, args, task_id=None):
+        # Workers read dispatched_at back from the message to measure queue wait
+        self.celery.send_task(task_name, args=args, task_id=task_id, headers={"dispatched_at": time.time()})
+
+    def submit_many(self, calls):
+        from celery import group  # Celery loads only in processes that use this backend
+        dispatched_at = time.time()
+        group(
+            self.celery.signature(task_name, args=tuple(args),
+                                  options={"task_id": task_id, "headers": {"dispatched_at": dispatched_at}})
+            for task_name, args, task_id in calls
+        ).apply_async()
+
+    def shutdown(self, wait=True):
+        pass
+
+class _LocalBackend:
+    """Bounded submission shared by the in-process backends.
+
+    At most max_pending jobs may be queued or running; submit() blocks for
+    up to submit_timeout seconds for a free slot, then raises QueueFullError.
+    """
+
+    loses_jobs_on_exit = True
+
+    def __init__(self, max_workers, max_pending=None, submit_timeout=30):
+        self.max_workers = max_workers
+        self.submit_timeout = submit_timeout
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers * 2)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, task_name, args, task_id=None):
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            raise QueueFullError()
+        try:
+            future = self._get_executor().submit(*self._job(task_name, args), time.time())
+        except Exception:
+            self._slots.release()
+            raise
+        get_metrics().task_queued()
+        future.add_done_callback(self._job_done)
+        return future
+
+    def submit_many(self, calls):
+        for index, (task_name, args, task_id) in enumerate(calls):
+            try:
+                self.submit(task_name, args, task_id)
+            except QueueFullError as e:
+                raise QueueFullError(str(e), submitted=index) from e
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=wait)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+            return self._executor
+
+    def _job_done(self, future):
+        self._slots.release()
+        get_metrics().task_finished()
+        if not future.cancelled() and future.exception():
+            logging.getLogger(__name__).error(f"Processing job crashed: {future.exception()}")
+
+class ThreadBackend(_LocalBackend):
+    """Runs jobs on a thread pool inside the web process"""
+
+    name = "thread"
+
+    def __init__(self, app, db, max_workers, **kwargs):
+        super().__init__(max_workers, **kwargs)
+        self.app = app
+        self.db = db
+
+    def _create_executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="image-processor")
+
+    def _job(self, task_name, args):
+        return self._run, task_name, args
+
+    def _run(self, task_name, args, dispatched_at):
+        get_metrics().task_started(dispatched_at)
+        try:
+            with self.app.app_context():
+                return JOBS[task_name](*args, self.db.session, self.app.extensions['result_storage'], self.app.logger,
+                                       notifier=self.app.extensions.get('status_notifier'),
+                                       options=ImageProcessor.options_from_config(self.app.config))
+        except Exception as e:
+            self.app.logger.error(f"Error running {task_name}{tuple(args)}: {str(e)}")
+            return {"error": str(e)}
+
+class ProcessPoolBackend(_LocalBackend):
+    """Runs jobs on a pool of worker processes, one per available core by default.
+
+    Workers open their own database engine and result storage, configured
+    from database_settings and storage_settings like the app's, so no Flask
+    app or broker is needed in the child processes. Status changes reach waiting requests
+    only through notifier_url (Redis); otherwise waiters re-read the database.
+    """
+
+    name = "process"
+
+    def __init__(self, database_uri, storage_settings, max_workers=None, notifier_url=None,
+                 metrics_enabled=False, processor_options=None, database_settings=None, **kwargs):
+        super().__init__(max_workers or available_cores(), **kwargs)
+        self.database_uri = database_uri
+        self.storage_settings = storage_settings
+        self.notifier_url = notifier_url
+        self.metrics_enabled = metrics_enabled
+        self.processor_options = processor_options
+        self.database_settings = database_settings or settings_from_config({})
+
+    def _create_executor(self):
+        # spawn, not fork: the web process already runs threads holding locks
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.database_uri, self.storage_settings, self.notifier_url, self.metrics_enabled,
+                      self.processor_options, self.database_settings)
+        )
+
+    def _job(self, task_name, args):
+        return _run_in_worker, task_name, args
+
+# Per-process state for ProcessPoolBackend workers
+_worker = {}
+
+def _init_worker(database_uri, storage_settings, notifier_url=None, metrics_enabled=False, processor_options=None,
+                 database_settings=None):
+    engine = create_configured_engine(database_uri, database_settings or settings_from_config({}))
+    _worker["session_factory"] = sessionmaker(bind=engine)
+    _worker["storage"] = create_storage(storage_settings, 'processed')
+    _worker["notifier"] = create_status_notifier(notifier_url) if notifier_url else None
+    _worker["logger"] = logging.getLogger("image_worker")
+    _worker["processor_options"] = processor_options
+    init_metrics(metrics_enabled)
+
+def _run_in_worker(task_name, args, dispatched_at):
+    get_metrics().task_started(dispatched_at)
+    logger = _worker["logger"]
+    session = _worker["session_factory"]()
+    try:
+        return JOBS[task_name](*args, session, _worker["storage"], logger,
+                               notifier=_worker["notifier"], options=_worker["processor_options"])
+    except Exception as e:
+        logger.error(f"Error running {task_name}{tuple(args)}: {str(e)}")
+        return {"error": str(e)}
+    finally:
+        session.close()
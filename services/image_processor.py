@@ -1,53 +1,423 @@
 # services/image_processor.py
 import os
-from PIL import Image, UnidentifiedImageError
-from models.image import ImageStatus
-from utils.file_utils import FileUtils
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from PIL import Image, ImageSequence, UnidentifiedImageError
+from sqlalchemy import update
+from models.engine import COMMIT_RETRIES, commit_with_retry
+from models.image import ImageUpload, ImageStatus
+from services import batch_kernel
+from services.metrics import get_metrics
+from services.pipeline import Pipeline
+from services.storage import LocalStorage
+from services.strip_decoder import budget_factor, can_decode_strips, decode_strips, decoded_bytes
+from utils.image_utils import ImageUtils
+
+MAX_PIXELS = 100_000_000
+MEMORY_BUDGET = 512 * 1024 * 1024
+MAX_FRAMES = 1000
+MAX_ANIMATION_PIXELS = 1_000_000_000  # summed over all frames
+FRAME_WORKERS = 4
+# Smaller frames transform faster inline than the thread hand-off costs
+PARALLEL_FRAME_PIXELS = 256 * 256
+# The batch kernel holds float32 copies of a stack, about this many times its decoded size
+BATCH_KERNEL_OVERHEAD = 8
+
+class ImageTooLargeError(ValueError):
+    """The image header declares more pixels or decode memory than allowed"""
 
 class ImageProcessor:
-    def __init__(self, processed_folder):
-        self.processed_folder = processed_folder
+    def __init__(self, storage, notifier=None, max_pixels=MAX_PIXELS, memory_budget=MEMORY_BUDGET,
+                 encoder_presets=None, max_frames=MAX_FRAMES, max_animation_pixels=MAX_ANIMATION_PIXELS,
+                 frame_workers=FRAME_WORKERS, batch_kernel=False, commit_retries=COMMIT_RETRIES):
+        # Results are written to storage; a folder path is short for local storage there
+        self.storage = LocalStorage(storage) if isinstance(storage, str) else storage
+        self.notifier = notifier
+        self.max_pixels = max_pixels
+        self.memory_budget = memory_budget
+        self.encoder_presets = encoder_presets
+        self.max_frames = max_frames
+        self.max_animation_pixels = max_animation_pixels
+        self.frame_workers = frame_workers
+        self.batch_kernel = batch_kernel
+        self.commit_retries = commit_retries
+    
+    @staticmethod
+    def options_from_config(config):
+        """Keyword arguments for the decode limits, encoder presets, batch kernel and commit retries in an app config"""
+        return {
+            "max_pixels": config.get('PROCESSING_MAX_PIXELS', MAX_PIXELS),
+            "memory_budget": config.get('PROCESSING_MEMORY_BUDGET', MEMORY_BUDGET),
+            "encoder_presets": config.get('ENCODER_PRESETS'),
+            "max_frames": config.get('PROCESSING_MAX_FRAMES', MAX_FRAMES),
+            "max_animation_pixels": config.get('PROCESSING_MAX_ANIMATION_PIXELS', MAX_ANIMATION_PIXELS),
+            "frame_workers": config.get('PROCESSING_FRAME_WORKERS', FRAME_WORKERS),
+            "batch_kernel": config.get('PROCESSING_BATCH_KERNEL', False),
+            "commit_retries": config.get('DB_COMMIT_RETRIES', COMMIT_RETRIES)
+        }
     
     def process_image(self, image, db_session, app_logger):
         try:
-            image.status = ImageStatus.PROCESSING.value
-            db_session.commit()
+            self._commit(db_session, lambda: setattr(image, "status", ImageStatus.PROCESSING.value))
+            self._publish(image, image.status)
             app_logger.info(f"Processing image {image.id}")
 
-            input_path = image.upload_path
-            output_filename = f"processed_{os.path.basename(image.upload_path)}"
-            output_path = os.path.join(self.processed_folder, output_filename)
+            result = self._process(image, app_logger)
+            processed_at = datetime.utcnow()
+            with get_metrics().time_stage("commit"):
+                self._commit(db_session, lambda: self._apply_result(image, result, processed_at))
+            self._publish(image, image.status)
+            return result
 
-            # Validate image
-            try:
-                img = Image.open(input_path)
-                img.verify()
-                img = Image.open(input_path) 
-            except UnidentifiedImageError:
-                image.status = ImageStatus.FAILED.value
-                db_session.commit()
-                app_logger.error(f"Invalid image file: {input_path}")
-                return {"status": "failed", "error": "Invalid image file"}
-
-            # Process image
-            processed_img = self._transform_image(img)
-            processed_img.save(output_path, "JPEG")
-
-            image.result_path = output_path
-            image.status = ImageStatus.COMPLETED.value
-            db_session.commit()
-
-            app_logger.info(f"Image {image.id} processed successfully")
-            return {"status": "completed", "result": output_path}
+        except Exception as e:
+            self._commit(db_session, lambda: setattr(image, "status", ImageStatus.FAILED.value))
+            self._publish(image, image.status)
+            app_logger.error(f"Failed to process image {image.id}: {e}")
+            return {"status": "failed", "error": str(e)}
+    
+    def process_images(self, images, db_session, app_logger):
+        """Process several images with two bulk status writes instead of two per image"""
+        if not images:
+            return {}
+        ids = [image.id for image in images]
+        try:
+            self._commit(db_session, lambda: self._set_statuses(db_session, ids, ImageStatus.PROCESSING.value))
+            for image in images:
+                self._publish(image, ImageStatus.PROCESSING.value)
+            app_logger.info(f"Processing batch of {len(ids)} images")
+
+            results, updates = self._process_many(images, app_logger), []
+            for image in images:
+                result = results[image.id]
+                if result["status"] == "completed":
+                    updates.append({
+                        "id": image.id,
+                        "status": result["status"],
+                        "result_path": result["result"],
+                        "result_hash": result["result_hash"],
+                        "processed_at": datetime.utcnow()
+                    })
+                else:
+                    updates.append({"id": image.id, "status": result["status"]})
+
+            with get_metrics().time_stage("commit"):
+                self._commit(db_session, lambda: db_session.execute(update(ImageUpload), updates))
+            for image in images:
+                self._publish(image, results[image.id]["status"])
+            return results
 
         except Exception as e:
-            image.status = ImageStatus.FAILED.value
-            db_session.commit()
+            self._commit(db_session, lambda: self._set_statuses(db_session, ids, ImageStatus.FAILED.value))
+            for image in images:
+                self._publish(image, ImageStatus.FAILED.value)
+            app_logger.error(f"Failed to process batch of {len(ids)} images: {e}")
+            return {image_id: {"status": "failed", "error": str(e)} for image_id in ids}
+    
+    @staticmethod
+    def _set_statuses(db_session, ids, status):
+        db_session.execute(update(ImageUpload).where(ImageUpload.id.in_(ids)).values(status=status))
+    
+    def _commit(self, db_session, apply):
+        # Workers and the API write the same rows; a conflicting commit is rolled back and redone
+        commit_with_retry(db_session, apply, self.commit_retries)
+    
+    @staticmethod
+    def _apply_result(image, result, processed_at):
+        if result["status"] == "completed":
+            image.result_path = result["result"]
+            image.result_hash = result["result_hash"]
+            image.processed_at = processed_at
+        image.status = result["status"]
+    
+    def _publish(self, image, status):
+        # Only after the commit, so a woken waiter reads the new status
+        get_metrics().status_transition(status)
+        if self.notifier:
+            self.notifier.publish(image.user_id, image.id, status)
+    
+    def _process_many(self, images, app_logger):
+        """Process images, running each group that shares a pipeline and decoded size
+        through the NumPy batch kernel when it is enabled. Everything else,
+        and anything that fails to decode, goes through _process one by one.
+        """
+        results = {}
+        if self.batch_kernel and batch_kernel.available():
+            groups = {}
+            for image in images:
+                try:
+                    pipeline = Pipeline.from_spec(image.pipeline) if image.pipeline else Pipeline.default()
+                except ValueError:
+                    continue
+                groups.setdefault(pipeline.to_json(), (pipeline, []))[1].append(image)
+            for pipeline, group in groups.values():
+                if len(group) > 1 and batch_kernel.supports(pipeline):
+                    self._process_stacked(group, pipeline, results, app_logger)
+        for image in images:
+            if image.id not in results:
+                results[image.id] = self._process(image, app_logger)
+        return results
+    
+    def _process_stacked(self, images, pipeline, results, app_logger):
+        """Decode images and transform them in stacks of the same decoded size and mode.
+
+        Stacks are flushed before their float32 working copies would exceed
+        the memory budget. Images this path can't take are left out of results.
+        """
+        stacks = {}
+        for image in images:
+            try:
+                with get_metrics().time_stage("decode"), self.storage.open_buffer(image.upload_path) as source:
+                    animation = self._open_animation(source, pipeline)
+                    if animation is not None:
+                        animation.close()
+                        continue
+                    img, source_size = self._decode_image(source, pipeline)
+            except Exception:
+                continue  # _process reports it
+            if not batch_kernel.supports(pipeline, img.mode):
+                continue
+            key = (img.size, img.mode, source_size)
+            stack = stacks.setdefault(key, [])
+            stack.append((image, img))
+            if len(stack) * decoded_bytes(img.size, img.mode) * BATCH_KERNEL_OVERHEAD >= self.memory_budget:
+                self._transform_stacked(stacks.pop(key), pipeline, source_size, results, app_logger)
+        for (_, _, source_size), stack in stacks.items():
+            self._transform_stacked(stack, pipeline, source_size, results, app_logger)
+    
+    def _transform_stacked(self, stack, pipeline, source_size, results, app_logger):
+        if len(stack) == 1:
+            return  # Nothing to share; _process takes it
+        images = [image for image, _ in stack]
+        try:
+            with get_metrics().time_stage("transform"):
+                processed = batch_kernel.transform_batch([img for _, img in stack], pipeline, source_size)
+        except Exception as e:
+            app_logger.warning(f"Batch kernel failed for {len(stack)} images, using Pillow: {e}")
+            return
+        app_logger.info(f"Transformed {len(stack)} images with the batch kernel")
+        for image, processed_img in zip(images, processed):
+            try:
+                results[image.id] = self._finish(image, processed_img, pipeline, source_size, app_logger)
+            except Exception as e:
+                app_logger.error(f"Failed to process image {image.id}: {e}")
+                results[image.id] = {"status": "failed", "error": str(e)}
+    
+    def _process(self, image, app_logger):
+        """Decode, transform and encode one image without touching the database"""
+        try:
+            # Animation frames are decoded while they are transformed, so the buffer is needed until then
+            with self.storage.open_buffer(image.upload_path) as source:
+                return self._process_source(image, source, app_logger)
+        except Exception as e:
             app_logger.error(f"Failed to process image {image.id}: {e}")
             return {"status": "failed", "error": str(e)}
     
-    def _transform_image(self, img):
-        """Apply image transformations"""
-        img = img.convert("L")  # Convert to grayscale
-        img = img.resize((800, 600))  # Resize to 800x600
-        return img
\ No newline at end of file
+    def _process_source(self, image, source, app_logger):
+        pipeline = Pipeline.from_spec(image.pipeline) if image.pipeline else Pipeline.default()
+        metrics = get_metrics()
+
+        # Validate and decode image in a single pass
+        try:
+            with metrics.time_stage("decode"):
+                animation = self._open_animation(source, pipeline)
+                if animation is None:
+                    img, source_size = self._decode_image(source, pipeline)
+        except FileNotFoundError:
+            raise
+        except (ImageTooLargeError, Image.DecompressionBombError) as e:
+            app_logger.error(f"Rejected image {image.id}: {e}")
+            return {"status": "failed", "error": str(e)}
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            app_logger.error(f"Invalid image file: {image.upload_path}")
+            return {"status": "failed", "error": "Invalid image file"}
+
+        # Process image
+        if animation is not None:
+            # Frames are decoded as they are transformed, so transform includes their decoding
+            with animation, metrics.time_stage("transform"):
+                source_size = animation.size
+                frames, durations, loop = self._transform_animation(animation, pipeline)
+            pipeline = pipeline.resolve(has_alpha=False, animated=True)
+            output = BytesIO()
+            with metrics.time_stage("encode"):
+                self._encode_animation(frames, durations, loop, output, pipeline)
+            return self._store_result(image, output, pipeline, source_size, app_logger)
+        with metrics.time_stage("transform"):
+            processed_img = self._transform_image(img, pipeline, source_size)
+        return self._finish(image, processed_img, pipeline, source_size, app_logger)
+    
+    def _finish(self, image, processed_img, pipeline, source_size, app_logger):
+        """Encode a transformed still image and store the result"""
+        pipeline = pipeline.resolve(self._has_alpha(processed_img))
+        output = BytesIO()
+        with get_metrics().time_stage("encode"):
+            self._encode_image(processed_img, output, pipeline)
+        return self._store_result(image, output, pipeline, source_size, app_logger)
+    
+    def _store_result(self, image, output, pipeline, source_size, app_logger):
+        get_metrics().observe_image(source_size[0] * source_size[1] / 1e6, output.getbuffer().nbytes)
+        result_hash = hashlib.sha256(output.getbuffer()).hexdigest()
+        # Results can be shared by deduplicated uploads; storage never exposes a partial file
+        output_path = self.storage.save(self._output_name(image, pipeline), output.getbuffer())
+
+        app_logger.info(f"Image {image.id} processed successfully")
+        return {"status": "completed", "result": output_path, "result_hash": result_hash}
+    
+    def render(self, key, pipeline):
+        """Run pipeline on the image stored under key and return the encoded bytes"""
+        output = BytesIO()
+        with self.storage.open_buffer(key) as source:
+            animation = self._open_animation(source, pipeline)
+            if animation is not None:
+                with animation:
+                    frames, durations, loop = self._transform_animation(animation, pipeline)
+                self._encode_animation(frames, durations, loop, output, pipeline.resolve(False, animated=True))
+                return output.getvalue()
+            img, source_size = self._decode_image(source, pipeline)
+        img = self._transform_image(img, pipeline, source_size)
+        self._encode_image(img, output, pipeline.resolve(self._has_alpha(img)))
+        return output.getvalue()
+    
+    def _output_name(self, image, pipeline):
+        stem = image.content_hash or os.path.splitext(os.path.basename(image.upload_path))[0]
+        return f"processed_{stem}_{pipeline.cache_key[:16]}.{pipeline.extension}"
+    
+    def _decode_image(self, source, pipeline):
+        """Open, validate and decode an image once, at the smallest scale the pipeline needs.
+
+        source is a path or a seekable buffer, like Storage.open_buffer's.
+        Returns the decoded image and the original size it was scaled from.
+        Limits are checked from the header, before any pixel data is read:
+        more than max_pixels fails, and a decode that would exceed the
+        memory budget is streamed in strips and downscaled, or fails when
+        the format can't be streamed.
+        """
+        img = ImageUtils.open(source)
+        source_size = img.size
+        if source_size[0] * source_size[1] > self.max_pixels:
+            raise ImageTooLargeError(
+                f"Image is {source_size[0]}x{source_size[1]}, over the {self.max_pixels} pixel limit")
+        target_size = pipeline.decode_size(source_size)
+        grayscale = pipeline.grayscale
+        if img.format == "JPEG":
+            # Let libjpeg scale by 1/2, 1/4 or 1/8 and emit grayscale directly
+            img.draft("L" if grayscale else img.mode, target_size)
+        # A palette image expanded to RGB holds its source and four bytes per pixel while converting
+        mode = self._decoded_mode(img, grayscale)
+        needed = decoded_bytes(img.size, img.mode)
+        if mode != img.mode:
+            needed += decoded_bytes(img.size, mode)
+        if needed > self.memory_budget:
+            if not can_decode_strips(img):
+                raise ImageTooLargeError(
+                    f"Decoding {source_size[0]}x{source_size[1]} {img.format} needs "
+                    f"{needed // 2 ** 20} MB, over the {self.memory_budget // 2 ** 20} MB budget")
+            factor = max(budget_factor(img.size, self.memory_budget),
+                         min(img.width // target_size[0], img.height // target_size[1]))
+            return decode_strips(source, img, factor, grayscale), source_size
+        img.load()  # Raises on truncated or corrupt data
+
+        if img.mode != mode:
+            img = img.convert(mode)
+
+        factor = min(img.width // target_size[0], img.height // target_size[1])
+        if factor > 1:
+            img = img.reduce(factor)
+        return img, source_size
+    
+    @staticmethod
+    def _decoded_mode(img, grayscale):
+        """The mode _decode_image returns img in: palette and bilevel images can't be averaged, so they are expanded"""
+        if grayscale:
+            return "L"
+        if img.mode in ("P", "1"):
+            return "RGBA" if "transparency" in img.info else "RGB"
+        return img.mode
+    
+    def _open_animation(self, source, pipeline):
+        """Open source when it has several frames and the pipeline's output can keep them.
+
+        Returns None otherwise, and the first frame goes through the still
+        image path. Like _decode_image, checks the header against the limits.
+        """
+        if not pipeline.animatable:
+            return None
+        img = ImageUtils.open(source)
+        if not getattr(img, "is_animated", False):
+            img.close()
+            return None
+        width, height = img.size
+        if width * height > self.max_pixels:
+            img.close()
+            raise ImageTooLargeError(f"Image is {width}x{height}, over the {self.max_pixels} pixel limit")
+        if decoded_bytes(img.size, "RGBA") > self.memory_budget:
+            img.close()
+            raise ImageTooLargeError(
+                f"Decoding a {width}x{height} frame needs {decoded_bytes(img.size, 'RGBA') // 2 ** 20} MB, "
+                f"over the {self.memory_budget // 2 ** 20} MB budget")
+        return img
+    
+    def _transform_animation(self, img, pipeline):
+        """Transform every frame of an opened animation, decoding one frame at a time.
+
+        Large frames are transformed on a thread pool (resampling releases
+        the GIL) with at most two per worker in flight, so only the
+        transformed output accumulates. Returns the frames, their
+        durations in milliseconds and the loop count (None: play once).
+        """
+        width, height = img.size
+        target_size = pipeline.decode_size(img.size)
+        factor = max(1, min(width // target_size[0], height // target_size[1]))
+        workers = self.frame_workers if width * height >= PARALLEL_FRAME_PIXELS else 0
+        frames, durations, pending = [], [], deque()
+        with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="frame") as pool:
+            for index, frame in enumerate(ImageSequence.Iterator(img)):
+                if index >= self.max_frames:
+                    raise ImageTooLargeError(f"Animation has more than {self.max_frames} frames")
+                if (index + 1) * width * height > self.max_animation_pixels:
+                    raise ImageTooLargeError(
+                        f"Animation frames exceed {self.max_animation_pixels} pixels in total")
+                # Copy out of the shared sequence before the next seek
+                if pipeline.grayscale:
+                    source = frame.convert("L")
+                else:
+                    source = frame.convert("RGBA" if self._has_alpha(frame) else "RGB")
+                # Read after decoding: WebP only fills in a frame's duration on load
+                durations.append(frame.info.get("duration", 100))
+                if not workers:
+                    frames.append(self._transform_frame(source, pipeline, img.size, factor))
+                    continue
+                pending.append(pool.submit(self._transform_frame, source, pipeline, img.size, factor))
+                if len(pending) >= 2 * workers:
+                    frames.append(pending.popleft().result())
+            frames.extend(future.result() for future in pending)
+        return frames, durations, img.info.get("loop")
+    
+    def _transform_frame(self, frame, pipeline, source_size, factor):
+        if factor > 1:
+            frame = frame.reduce(factor)
+        return pipeline.apply(frame, source_size)
+    
+    def _encode_animation(self, frames, durations, loop, output, pipeline):
+        options = pipeline.save_options(self.encoder_presets)
+        options.update(save_all=True, append_images=frames[1:], duration=durations)
+        if loop is not None:
+            options["loop"] = loop
+        frames[0].save(output, pipeline.format, **options)
+    
+    def _transform_image(self, img, pipeline=None, source_size=None):
+        """Apply image transformations (grayscale + 800x600 unless a pipeline is given)"""
+        pipeline = pipeline or Pipeline.default()
+        return pipeline.apply(img, source_size)
+    
+    def _encode_image(self, img, output_path, pipeline):
+        if pipeline.format == "JPEG" and img.mode not in ("L", "RGB", "CMYK"):
+            img = img.convert("L" if img.mode in ("LA", "I", "I;16") else "RGB")
+        img.save(output_path, pipeline.format, **pipeline.save_options(self.encoder_presets))
+    
+    @staticmethod
+    def _has_alpha(img):
+        return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
\ No newline at end of file
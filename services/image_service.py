@@ -1,44 +1,273 @@
-from sqlalchemy import select
+from sqlalchemy import select, insert, or_, and_
 from models.image import ImageUpload, ImageStatus
 from models.users import User
+from services.pipeline import Pipeline
+from services.storage import HEADER_BYTES
 from utils.file_utils import FileUtils
-import os
+from utils.image_utils import ImageUtils
+import uuid
+import base64
+from datetime import datetime
+
+UNFINISHED_STATUSES = (ImageStatus.PENDING.value, ImageStatus.PROCESSING.value)
 
 class ImageService:
-    def __init__(self, db_session, upload_folder, processed_folder):
+    def __init__(self, db_session, upload_storage, result_storage):
         self.db_session = db_session
-        self.upload_folder = upload_folder
-        self.processed_folder = processed_folder
+        self.upload_storage = upload_storage
+        self.result_storage = result_storage
     
-    def upload_image(self, user_id, file, allowed_extensions):
-        # Validate file
-        if not file or file.filename == '':
-            raise ValueError("No file provided")
-        
-        if not FileUtils.allowed_file(file.filename, allowed_extensions):
-            raise ValueError("Invalid file type")
-        
-        # Save file
-        filename = f"{user_id}_{file.filename}"
-        upload_path = os.path.join(self.upload_folder, filename)
-        file.save(upload_path)
+    def upload_image(self, user_id, file, allowed_extensions, pipeline_spec=None):
+        pipeline = Pipeline.from_spec(pipeline_spec) if pipeline_spec else Pipeline.default()
+        pipeline_key = pipeline.cache_key
+        upload_path, content_hash, input_format = self._store_file(file, allowed_extensions)
         
         # Create image record
         image = ImageUpload(
             user_id=user_id,
             original_filename=file.filename,
             upload_path=upload_path,
+            content_hash=content_hash,
+            pipeline=pipeline.to_json(),
+            pipeline_key=pipeline_key,
             status=ImageStatus.PENDING.value
         )
+        
+        # Reuse an existing result for the same bytes and pipeline
+        result = self._find_results(pipeline, {content_hash: input_format}).get(content_hash)
+        if result:
+            image.result_path = result.result_path
+            image.result_hash = result.result_hash
+            image.processed_at = result.processed_at
+            image.status = ImageStatus.COMPLETED.value
+        
         self.db_session.add(image)
         self.db_session.commit()
         
         return image
     
-    def get_user_images(self, user_id):
-        return self.db_session.execute(
-            select(ImageUpload).where(ImageUpload.user_id == user_id)
-        ).scalars().all()
+    def upload_images(self, user_id, files, allowed_extensions, pipeline_spec=None):
+        """Store several files and insert all their rows in one transaction.
+        
+        Rows that need processing get a pre-assigned task_id. Returns a list of
+        row dicts (including the new id) and a list of per-file errors.
+        """
+        pipeline = Pipeline.from_spec(pipeline_spec) if pipeline_spec else Pipeline.default()
+        pipeline_key = pipeline.cache_key
+        pipeline_json = pipeline.to_json()
+        
+        rows, errors, input_formats = [], [], {}
+        for index, file in enumerate(files):
+            try:
+                upload_path, content_hash, input_format = self._store_file(file, allowed_extensions)
+            except ValueError as e:
+                errors.append({"index": index, "filename": file.filename, "error": str(e)})
+                continue
+            
+            input_formats[content_hash] = input_format
+            rows.append({
+                "user_id": user_id,
+                "original_filename": file.filename,
+                "upload_path": upload_path,
+                "result_path": None,
+                "result_hash": None,
+                "processed_at": None,
+                "content_hash": content_hash,
+                "pipeline": pipeline_json,
+                "pipeline_key": pipeline_key,
+                "status": ImageStatus.PENDING.value,
+                "task_id": None
+            })
+        
+        if not rows:
+            return [], errors
+        
+        # Reuse existing results for the same bytes and pipeline
+        results = self._find_results(pipeline, input_formats)
+        for row in rows:
+            result = results.get(row["content_hash"])
+            if result:
+                row["result_path"] = result.result_path
+                row["result_hash"] = result.result_hash
+                row["processed_at"] = result.processed_at
+                row["status"] = ImageStatus.COMPLETED.value
+            else:
+                row["task_id"] = str(uuid.uuid4())
+        
+        ids = self.db_session.scalars(
+            insert(ImageUpload).returning(ImageUpload.id, sort_by_parameter_order=True),
+            rows
+        ).all()
+        self.db_session.commit()
+        
+        for row, image_id in zip(rows, ids):
+            row["id"] = image_id
+        return rows, errors
+    
+    def _store_file(self, file, allowed_extensions):
+        # Validate file
+        if not file or file.filename == '':
+            raise ValueError("No file provided")
+        
+        if not FileUtils.allowed_file(file.filename, allowed_extensions):
+            raise ValueError("Invalid file type")
+        
+        # Save file under its content hash so identical uploads share storage. The
+        # hash and header come from the bytes as they are written, in one pass
+        extension = FileUtils.file_extension(file.filename)
+        headers = []
+        
+        def check(head):
+            headers.append(self._check_header(head))
+        
+        upload_path, content_hash = self.upload_storage.save_stream(file.stream, extension, check=check)
+        header = headers[0] if headers else None
+        return upload_path, content_hash, header['format'] if header else None
+    
+    @staticmethod
+    def _check_header(head):
+        """The parsed header (see ImageUtils.read_header), or None when it lies past HEADER_BYTES"""
+        # A file short enough to be seen whole that no plugin recognizes can't be an image;
+        # a longer one may just have its header past HEADER_BYTES, so the worker decides
+        header = ImageUtils.read_header(head)
+        if header is None and len(head) < HEADER_BYTES:
+            raise ValueError("Invalid image file")
+        return header
+    
+    def _find_results(self, pipeline, input_formats):
+        """Existing results for pipeline, keyed by content hash, from a content hash -> input format map.
+        
+        JPEG inputs are never animated or transparent, so an 'auto' pipeline stores
+        them as JPEG and can reuse results written under its legacy_cache_key.
+        """
+        results = self.find_processed_results(list(input_formats), pipeline.cache_key)
+        legacy_key = pipeline.legacy_cache_key
+        stills = [content_hash for content_hash, input_format in input_formats.items()
+                  if input_format == 'JPEG' and content_hash not in results]
+        if legacy_key and stills:
+            results.update(self.find_processed_results(stills, legacy_key))
+        return results
+    
+    def find_processed_results(self, content_hashes, pipeline_key):
+        """Map each content hash to an existing result (result_path, result_hash, processed_at) for pipeline_key"""
+        rows = self.db_session.execute(
+            select(
+                ImageUpload.content_hash,
+                ImageUpload.result_path,
+                ImageUpload.result_hash,
+                ImageUpload.processed_at
+            ).where(
+                ImageUpload.content_hash.in_(content_hashes),
+                ImageUpload.pipeline_key == pipeline_key,
+                ImageUpload.status == ImageStatus.COMPLETED.value,
+                ImageUpload.result_path.isnot(None)
+            ).distinct()
+        ).all()
+        
+        results = {}
+        for row in rows:
+            if row.content_hash not in results and self.result_storage.exists(row.result_path):
+                results[row.content_hash] = row
+        return results
+    
+    def get_pipeline(self, image):
+        return Pipeline.from_spec(image.pipeline) if image.pipeline else Pipeline.default()
+    
+    def get_rendition_pipeline(self, image, args, max_dimension):
+        """Build the pipeline for an on-the-fly rendition from w, h, fmt and q query args"""
+        base = self.get_pipeline(image)
+        operations = base.operations[:-1]
+        output = dict(base.output)
+        
+        width = self._int_arg(args, 'w', 1, max_dimension)
+        height = self._int_arg(args, 'h', 1, max_dimension)
+        if width or height:
+            operations.append({'op': 'resize', 'mode': 'fit', 'width': width, 'height': height})
+        if args.get('fmt'):
+            output['format'] = args['fmt']
+        if args.get('q'):
+            output['quality'] = self._int_arg(args, 'q', 1, 95)
+        
+        return Pipeline.from_spec(operations + [output])
+    
+    def _int_arg(self, args, name, minimum, maximum):
+        value = args.get(name)
+        if not value:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid {name}: must be an integer")
+        if not minimum <= value <= maximum:
+            raise ValueError(f"Invalid {name}: must be between {minimum} and {maximum}")
+        return value
+    
+    def assign_task(self, image, task_id):
+        image.task_id = task_id
+        self.db_session.commit()
+        return image
+    
+    def get_statuses(self, user_id, image_ids=None):
+        """Map id -> status for the user's images, or for their unfinished ones when image_ids is None"""
+        query = select(ImageUpload.id, ImageUpload.status).where(ImageUpload.user_id == user_id)
+        if image_ids is None:
+            query = query.where(ImageUpload.status.in_(UNFINISHED_STATUSES))
+        else:
+            query = query.where(ImageUpload.id.in_(image_ids))
+        return dict(self.db_session.execute(query).all())
+    
+    def get_user_images(self, user_id, limit=None, cursor=None, status=None, since=None, until=None):
+        """Return one page of a user's images, newest first, and the cursor for the next page.
+        
+        Pages are keyed on (uploaded_at, id), so each page is an index range scan
+        on ix_image_uploads_user_uploaded however deep the client has paged.
+        With no limit, every matching image is returned and the cursor is None.
+        """
+        query = select(
+            ImageUpload.id,
+            ImageUpload.original_filename,
+            ImageUpload.status,
+            ImageUpload.uploaded_at,
+            ImageUpload.result_path
+        ).where(ImageUpload.user_id == user_id)
+        
+        if status:
+            query = query.where(ImageUpload.status == status)
+        if since:
+            query = query.where(ImageUpload.uploaded_at >= since)
+        if until:
+            query = query.where(ImageUpload.uploaded_at < until)
+        if cursor:
+            cursor_uploaded_at, cursor_id = self._decode_cursor(cursor)
+            query = query.where(or_(
+                ImageUpload.uploaded_at < cursor_uploaded_at,
+                and_(ImageUpload.uploaded_at == cursor_uploaded_at, ImageUpload.id < cursor_id)
+            ))
+        
+        query = query.order_by(ImageUpload.uploaded_at.desc(), ImageUpload.id.desc())
+        if limit is not None:
+            query = query.limit(limit + 1)
+        rows = self.db_session.execute(query).all()
+        
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self._encode_cursor(rows[-1].uploaded_at, rows[-1].id)
+        return rows, next_cursor
+    
+    @staticmethod
+    def _encode_cursor(uploaded_at, image_id):
+        raw = f"{uploaded_at.isoformat()}|{image_id}".encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+    
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            uploaded_at, image_id = raw.split('|')
+            return datetime.fromisoformat(uploaded_at), int(image_id)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Invalid cursor")
     
     def get_image_by_id(self, image_id):
         return self.db_session.get(ImageUpload, image_id)
@@ -0,0 +1,150 @@
+# services/metrics.py
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+# Seconds; processing stages run from under a millisecond to several seconds
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MEGAPIXEL_BUCKETS = (0.01, 0.1, 0.5, 1, 2, 5, 12, 24, 50, 100)
+BYTE_BUCKETS = (1024, 10240, 51200, 102400, 262144, 524288, 1048576, 4194304, 16777216)
+RSS_BUCKETS = tuple(2 ** power * 1048576 for power in range(5, 14))  # 32 MB to 8 GB
+
+class NullMetrics:
+    """Used when metrics are disabled; every call is a no-op"""
+
+    enabled = False
+    _null_timer = nullcontext()
+
+    def time_stage(self, stage):
+        return self._null_timer
+
+    def observe_request(self, endpoint, method, status, seconds):
+        pass
+
+    def observe_image(self, megapixels, output_bytes):
+        pass
+
+    def job_peak_memory(self, rss_bytes):
+        pass
+
+    def status_transition(self, status):
+        pass
+
+    def task_queued(self):
+        pass
+
+    def task_started(self, dispatched_at=None):
+        pass
+
+    def task_finished(self):
+        pass
+
+    def cache_lookup(self, cache, outcome):
+        pass
+
+class PrometheusMetrics:
+    """prometheus_client metrics for this process.
+
+    With PROMETHEUS_MULTIPROC_DIR set (before the first import of
+    prometheus_client), every process writes its samples to that directory
+    and /metrics aggregates them, so any gunicorn worker or local
+    processing worker on the host can be scraped through one endpoint.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        from prometheus_client import Counter, Gauge, Histogram
+        self.request_seconds = Histogram(
+            'http_request_duration_seconds', 'Request latency by route',
+            ['endpoint', 'method', 'status'])
+        self.stage_seconds = Histogram(
+            'image_processing_stage_seconds', 'Time spent in each processing stage',
+            ['stage'], buckets=STAGE_BUCKETS)
+        self.input_megapixels = Histogram(
+            'image_input_megapixels', 'Size of processed source images', buckets=MEGAPIXEL_BUCKETS)
+        self.output_bytes = Histogram(
+            'image_output_bytes', 'Size of encoded results', buckets=BYTE_BUCKETS)
+        self.job_peak_rss = Histogram(
+            'image_job_peak_rss_bytes', 'Peak resident memory of the worker process per job', buckets=RSS_BUCKETS)
+        self.status_transitions = Counter(
+            'image_status_transitions_total', 'Image status changes', ['status'])
+        self.queue_depth = Gauge(
+            'image_queue_depth', 'Jobs queued or running on local backends', multiprocess_mode='livesum')
+        self.task_wait_seconds = Histogram(
+            'image_task_wait_seconds', 'Time from dispatch until a worker starts the job', buckets=STAGE_BUCKETS)
+        self.cache_lookups = Counter(
+            'cache_lookups_total', 'Cache lookups by outcome (hit ratio = hits / all)', ['cache', 'outcome'])
+
+    @contextmanager
+    def time_stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds.labels(stage).observe(time.perf_counter() - started)
+
+    def observe_request(self, endpoint, method, status, seconds):
+        self.request_seconds.labels(endpoint, method, status).observe(seconds)
+
+    def observe_image(self, megapixels, output_bytes):
+        self.input_megapixels.observe(megapixels)
+        self.output_bytes.observe(output_bytes)
+
+    def job_peak_memory(self, rss_bytes):
+        self.job_peak_rss.observe(rss_bytes)
+
+    def status_transition(self, status):
+        self.status_transitions.labels(status).inc()
+
+    def task_queued(self):
+        self.queue_depth.inc()
+
+    def task_started(self, dispatched_at=None):
+        """Record the queue wait of a job; dispatched_at is a time.time() stamp"""
+        if dispatched_at is not None:
+            self.task_wait_seconds.observe(max(time.time() - dispatched_at, 0))
+
+    def task_finished(self):
+        self.queue_depth.dec()
+
+    def cache_lookup(self, cache, outcome):
+        self.cache_lookups.labels(cache, outcome).inc()
+
+_null = NullMetrics()
+_prometheus = None
+_active = _null
+
+def init_metrics(enabled):
+    """Select the metrics implementation for this process and return it"""
+    global _active, _prometheus
+    if not enabled:
+        _active = _null
+        return _active
+    if _prometheus is None:
+        try:
+            _prometheus = PrometheusMetrics()
+        except ImportError:
+            raise RuntimeError("METRICS_ENABLED requires the prometheus_client package")
+    _active = _prometheus
+    return _active
+
+def get_metrics():
+    return _active
+
+def set_metrics(metrics):
+    """Install another implementation, such as a benchmark's stage recorder, and return the previous one"""
+    global _active
+    previous, _active = _active, metrics
+    return previous
+
+def render_metrics():
+    """Return the exposition body and content type for /metrics"""
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
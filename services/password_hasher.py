@@ -0,0 +1,87 @@
+# services/password_hasher.py
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+HASH_METHODS = ('pbkdf2', 'scrypt')
+
+class PasswordHasher:
+    """Hashes and verifies passwords off the request thread.
+
+    At most max_workers hashes run at once, on a thread pool (hashlib
+    releases the GIL while it works) or a process pool. Under eventlet the
+    work goes to eventlet's native thread pool, so a login only blocks its
+    own green thread.
+    """
+
+    def __init__(self, method='pbkdf2', pbkdf2_iterations=600000, scrypt_n=2 ** 15, scrypt_r=8,
+                 scrypt_p=1, salt_length=16, max_workers=2, executor='thread'):
+        if method == 'pbkdf2':
+            self.method = f"pbkdf2:sha256:{pbkdf2_iterations}"
+        elif method == 'scrypt':
+            self.method = f"scrypt:{scrypt_n}:{scrypt_r}:{scrypt_p}"
+        else:
+            raise ValueError(f"Unknown password hash method: {method}")
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"Unknown password hash executor: {executor}")
+        self.salt_length = salt_length
+        self.max_workers = max_workers
+        self.executor = executor
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            method=config.get('PASSWORD_HASH_METHOD', 'pbkdf2'),
+            pbkdf2_iterations=config.get('PASSWORD_PBKDF2_ITERATIONS', 600000),
+            scrypt_n=config.get('PASSWORD_SCRYPT_N', 2 ** 15),
+            scrypt_r=config.get('PASSWORD_SCRYPT_R', 8),
+            scrypt_p=config.get('PASSWORD_SCRYPT_P', 1),
+            max_workers=config.get('PASSWORD_HASH_WORKERS', 2),
+            executor=config.get('PASSWORD_HASH_EXECUTOR', 'thread')
+        )
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True when a stored hash was made with other parameters than the current ones"""
+        method, _, rest = password_hash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != self.method or len(salt) < self.salt_length
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=wait)
+
+    def _run(self, fn, *args):
+        with self._slots:
+            if _eventlet_patched():
+                from eventlet import tpool
+                return tpool.execute(fn, *args)
+            return self._get_pool().submit(fn, *args).result()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                if self.executor == 'process':
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="password-hasher")
+            return self._pool
+
+def _eventlet_patched():
+    # Monkey patching implies eventlet is already imported; importing it here
+    # from a worker thread would break that thread's join()
+    patcher = sys.modules.get('eventlet.patcher')
+    return bool(patcher and patcher.is_monkey_patched('thread'))
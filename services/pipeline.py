@@ -0,0 +1,517 @@
+# services/pipeline.py
+import hashlib
+import json
+import math
+from PIL import Image, ImageStat
+
+# Output format name -> (Pillow format, file extension, MIME type)
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'png': ('PNG', 'png', 'image/png'),
+    'gif': ('GIF', 'gif', 'image/gif'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+# Stored as JPEG (PNG for images with alpha, GIF for animations) and served as WebP to clients that accept it
+AUTO_FORMAT = 'auto'
+ANIMATED_FORMATS = ('gif', 'webp')
+# Encoder settings per output variant, overridden per key by the app's ENCODER_PRESETS.
+# effort is WebP's method (0-6), PNG's zlib level (0-9), or for JPEG 0 for
+# baseline and 1 for optimized progressive; lossless WebP reads quality as effort too
+ENCODER_PRESETS = {
+    'jpeg': {'quality': 75, 'effort': 1},
+    'png': {'effort': 9},
+    'webp': {'quality': 80, 'effort': 4},
+    'webp-lossless': {'quality': 80, 'effort': 4},
+}
+RESIZE_MODES = ('fit', 'fill', 'exact')
+MAX_DIMENSION = 10000
+
+OPERATION_FIELDS = {
+    'resize': {'width', 'height', 'mode'},
+    'crop': {'left', 'top', 'width', 'height'},
+    'rotate': {'angle', 'expand'},
+    'grayscale': set(),
+    'format': {'format', 'quality', 'lossless', 'effort'},
+    'brightness': {'factor'},
+    'contrast': {'factor'},
+    'gamma': {'gamma'},
+    'threshold': {'level'},
+}
+# Per-channel lookup table operations
+POINT_OPERATIONS = ('brightness', 'contrast', 'gamma', 'threshold')
+# Point operations that give the same pixels before or after a crop or right-angle rotation.
+# contrast pivots on the image's mean, so it depends on what the crop keeps
+SINKABLE_POINT_OPERATIONS = ('brightness', 'gamma')
+GEOMETRY_OPERATIONS = ('resize', 'crop', 'rotate')
+
+TRANSPOSE_METHODS = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
+
+DEFAULT_PIPELINE = [
+    {"op": "grayscale"},
+    {"op": "resize", "width": 800, "height": 600, "mode": "exact"},
+    {"op": "format", "format": "auto"},
+]
+
+
+class Pipeline:
+    """An ordered list of image operations, canonicalized on construction.
+
+    The stored operations are already reordered and fused, so two specs that
+    produce the same image share a cache_key. Consecutive crop/resize steps
+    are folded into a single resize(box=...) when the pipeline is applied.
+    """
+
+    def __init__(self, operations):
+        self.operations = self._optimize(operations)
+
+    @classmethod
+    def from_spec(cls, spec):
+        if isinstance(spec, (str, bytes)):
+            try:
+                spec = json.loads(spec)
+            except ValueError:
+                raise ValueError("Invalid pipeline: not valid JSON")
+        if not isinstance(spec, list) or not spec:
+            raise ValueError("Invalid pipeline: expected a non-empty list of operations")
+        return cls([cls._validate(op) for op in spec])
+
+    @classmethod
+    def default(cls):
+        return cls.from_spec(DEFAULT_PIPELINE)
+
+    def to_json(self):
+        return json.dumps(self.operations, sort_keys=True, separators=(',', ':'))
+
+    @property
+    def cache_key(self):
+        return hashlib.sha256(self.to_json().encode()).hexdigest()
+
+    @property
+    def legacy_cache_key(self):
+        """For an 'auto' pipeline, the key of the same steps writing JPEG, which is
+        what the default pipeline stored before 'auto' existed. None otherwise.
+        """
+        return self.with_format('jpeg').cache_key if self.negotiable else None
+
+    @property
+    def grayscale(self):
+        return self.operations[0]['op'] == 'grayscale'
+
+    @property
+    def output(self):
+        return self.operations[-1]
+
+    @property
+    def negotiable(self):
+        """True when the output format is picked per request (format 'auto')"""
+        return self.output['format'] == AUTO_FORMAT
+
+    @property
+    def animatable(self):
+        """True when the output keeps every frame of an animated input"""
+        return self.negotiable or self.output['format'] in ANIMATED_FORMATS
+
+    @property
+    def format(self):
+        return OUTPUT_FORMATS[self._format_name][0]
+
+    @property
+    def extension(self):
+        return OUTPUT_FORMATS[self._format_name][1]
+
+    @property
+    def mimetype(self):
+        return OUTPUT_FORMATS[self._format_name][2]
+
+    @property
+    def _format_name(self):
+        # Until resolve() pins it, an 'auto' output describes the JPEG it usually stores
+        return 'jpeg' if self.negotiable else self.output['format']
+
+    def with_format(self, fmt, lossless=False):
+        """The same pipeline writing fmt, keeping any quality and effort overrides"""
+        output = {key: value for key, value in self.output.items() if key != 'lossless'}
+        output['format'] = fmt
+        if lossless:
+            output['lossless'] = True
+        return Pipeline(self.operations[:-1] + [output])
+
+    def resolve(self, has_alpha, animated=False):
+        """Pin an 'auto' output to the stored format: GIF for animations, PNG for alpha, otherwise JPEG"""
+        if not self.negotiable:
+            return self
+        if animated:
+            return self.with_format('gif')
+        return self.with_format('png' if has_alpha else 'jpeg')
+
+    def save_options(self, presets=None):
+        """Pillow save() options: the preset for this output, then the pipeline's own overrides"""
+        name = self._format_name
+        lossless = name == 'webp' and self.output.get('lossless', False)
+        preset_name = 'webp-lossless' if lossless else name
+        settings = dict(ENCODER_PRESETS.get(preset_name, {}))
+        settings.update((presets or {}).get(preset_name, {}))
+        for field in ('quality', 'effort'):
+            if self.output.get(field) is not None:
+                settings[field] = self.output[field]
+
+        quality, effort = settings.get('quality'), settings.get('effort')
+        if name == 'jpeg':
+            options = {'quality': quality} if quality else {}
+            if effort:
+                options.update(optimize=True, progressive=True)
+            return options
+        if name == 'webp':
+            options = {'lossless': lossless}
+            if quality:
+                options['quality'] = quality
+            if effort is not None:
+                options['method'] = min(effort, 6)
+            return options
+        if name == 'png' and effort is not None:
+            return {'compress_level': effort, 'optimize': effort >= 9}
+        return {}
+
+    def decode_size(self, size):
+        """Smallest decode size that still feeds the first resample at full quality"""
+        pending = []
+        for op in self.operations:
+            if op['op'] in ('resize', 'crop'):
+                pending.append(op)
+            elif op['op'] != 'grayscale':
+                break
+        if not pending:
+            return size
+
+        (out_w, out_h), (x0, y0, x1, y1) = self._fuse(pending, size)
+        return (
+            min(size[0], math.ceil(size[0] * out_w / (x1 - x0))),
+            min(size[1], math.ceil(size[1] * out_h / (y1 - y0))),
+        )
+
+    def apply(self, img, source_size=None):
+        """Run the operations on img.
+
+        source_size is the size of the image before any decode-time
+        downscaling; crop coordinates are always relative to it.
+        """
+        size = source_size or img.size
+        scale = (img.width / size[0], img.height / size[1])
+        pending = []
+        for op in self.operations:
+            if op['op'] in ('resize', 'crop'):
+                pending.append(op)
+                continue
+
+            if pending:
+                img = self._resample(img, pending, size, scale)
+                pending = []
+                size, scale = img.size, (1.0, 1.0)
+
+            if op['op'] == 'grayscale' and img.mode != 'L':
+                img = img.convert('L')
+            elif op['op'] in POINT_OPERATIONS:
+                img = _apply_point(img, op)
+            elif op['op'] == 'rotate':
+                img = self._rotate(img, op)
+                size, scale = img.size, (1.0, 1.0)
+
+        if pending:
+            img = self._resample(img, pending, size, scale)
+        return img
+
+    def _resample(self, img, operations, size, scale):
+        out, box = self._fuse(operations, size)
+        box = (box[0] * scale[0], box[1] * scale[1], box[2] * scale[0], box[3] * scale[1])
+        if out == img.size and box == (0, 0, img.width, img.height):
+            return img
+
+        int_box = tuple(round(v) for v in box)
+        if int_box == box and out == (int_box[2] - int_box[0], int_box[3] - int_box[1]):
+            # Pure crop, no resampling needed
+            return img.crop(int_box)
+        return img.resize(out, box=box)
+
+    @staticmethod
+    def _rotate(img, op):
+        if op['angle'] in TRANSPOSE_METHODS and (op['expand'] or op['angle'] == 180):
+            return img.transpose(TRANSPOSE_METHODS[op['angle']])
+        return img.rotate(op['angle'], resample=Image.Resampling.BICUBIC, expand=op['expand'])
+
+    @staticmethod
+    def _fuse(operations, size):
+        """Fold consecutive crop/resize operations into one (output size, source box)"""
+        out_w, out_h = size
+        x0, y0, x1, y1 = 0.0, 0.0, float(size[0]), float(size[1])
+        for op in operations:
+            sx, sy = (x1 - x0) / out_w, (y1 - y0) / out_h
+            if op['op'] == 'crop':
+                left, top = min(op['left'], out_w), min(op['top'], out_h)
+                right = min(left + op['width'], out_w)
+                bottom = min(top + op['height'], out_h)
+                if right <= left or bottom <= top:
+                    raise ValueError("Crop region is outside the image")
+                visible = (left, top, right, bottom)
+                out_w, out_h = right - left, bottom - top
+            else:
+                (new_w, new_h), visible = _resize_geometry(op, (out_w, out_h))
+                out_w, out_h = new_w, new_h
+
+            if visible:
+                left, top, right, bottom = visible
+                x0, y0, x1, y1 = x0 + left * sx, y0 + top * sy, x0 + right * sx, y0 + bottom * sy
+        return (out_w, out_h), (x0, y0, x1, y1)
+
+    @staticmethod
+    def _validate(op):
+        if not isinstance(op, dict) or op.get('op') not in OPERATION_FIELDS:
+            raise ValueError(f"Invalid pipeline: unknown operation {op!r}")
+        name = op['op']
+        unknown = set(op) - OPERATION_FIELDS[name] - {'op'}
+        if unknown:
+            raise ValueError(f"Invalid pipeline: unexpected fields for {name}: {sorted(unknown)}")
+
+        if name == 'resize':
+            mode = op.get('mode', 'fit')
+            if mode not in RESIZE_MODES:
+                raise ValueError(f"Invalid pipeline: resize mode must be one of {RESIZE_MODES}")
+            required = mode != 'fit'
+            width = _integer(op, 'width', 1, MAX_DIMENSION, required)
+            height = _integer(op, 'height', 1, MAX_DIMENSION, required)
+            if width is None and height is None:
+                raise ValueError("Invalid pipeline: resize needs a width or height")
+            return {'op': 'resize', 'mode': mode, 'width': width, 'height': height}
+
+        if name == 'crop':
+            return {
+                'op': 'crop',
+                'left': _integer(op, 'left', 0, None, True),
+                'top': _integer(op, 'top', 0, None, True),
+                'width': _integer(op, 'width', 1, None, True),
+                'height': _integer(op, 'height', 1, None, True),
+            }
+
+        if name == 'rotate':
+            angle = op.get('angle')
+            if not isinstance(angle, (int, float)) or isinstance(angle, bool) or not math.isfinite(angle):
+                raise ValueError("Invalid pipeline: rotate angle must be a number")
+            angle = angle % 360
+            if angle == int(angle):
+                angle = int(angle)
+            expand = op.get('expand', True)
+            if not isinstance(expand, bool):
+                raise ValueError("Invalid pipeline: rotate expand must be a boolean")
+            return {'op': 'rotate', 'angle': angle, 'expand': expand}
+
+        if name in ('brightness', 'contrast'):
+            return {'op': name, 'factor': _number(op, 'factor', 0, 10, 1)}
+
+        if name == 'gamma':
+            gamma = _number(op, 'gamma', 0, 10, 1)
+            if gamma == 0:
+                raise ValueError("Invalid pipeline: gamma must be greater than 0")
+            return {'op': 'gamma', 'gamma': gamma}
+
+        if name == 'threshold':
+            level = _integer(op, 'level', 0, 255, False)
+            return {'op': 'threshold', 'level': 128 if level is None else level}
+
+        if name == 'format':
+            fmt = str(op.get('format', 'jpeg')).lower()
+            fmt = FORMAT_ALIASES.get(fmt, fmt)
+            if fmt not in OUTPUT_FORMATS and fmt != AUTO_FORMAT:
+                raise ValueError(f"Invalid pipeline: format must be one of {sorted(OUTPUT_FORMATS) + [AUTO_FORMAT]}")
+            output = {'op': 'format', 'format': fmt, 'quality': _integer(op, 'quality', 1, 95, False)}
+            # Only set when given, so existing pipelines keep their cache keys
+            lossless = op.get('lossless', False)
+            if not isinstance(lossless, bool):
+                raise ValueError("Invalid pipeline: format lossless must be a boolean")
+            if lossless:
+                output['lossless'] = True
+            effort = _integer(op, 'effort', 0, 9, False)
+            if effort is not None:
+                output['effort'] = effort
+            return output
+
+        return {'op': name}
+
+    @staticmethod
+    def _optimize(operations):
+        output = {'op': 'format', 'format': 'jpeg', 'quality': None}
+        steps = []
+        for op in operations:
+            if op['op'] == 'format':
+                output = op  # Only the last format takes effect
+            elif op['op'] == 'rotate' and op['angle'] == 0:
+                continue
+            elif op['op'] == 'grayscale' and any(step['op'] == 'grayscale' for step in steps):
+                continue  # Nothing after the first conversion brings color back
+            else:
+                steps.append(op)
+
+        # Converting first means every later resample touches one channel instead of three,
+        # and brightness and gamma after crops touch only the pixels that are kept.
+        # Nothing is moved across an operation it doesn't commute with
+        steps = _sink_point_operations(_hoist_grayscale(steps))
+        optimized, geometry = [], []
+        for op in steps + [None]:
+            if op is not None and op['op'] in GEOMETRY_OPERATIONS:
+                geometry.append(op)
+                continue
+            optimized.extend(_collapse_resizes(_merge_transposes(_sink_transposes(geometry))))
+            geometry = []
+            if op is not None:
+                optimized.append(op)
+        return optimized + [output]
+
+def _integer(op, field, minimum, maximum, required):
+    value = op.get(field)
+    if value is None:
+        if required:
+            raise ValueError(f"Invalid pipeline: {op['op']} requires {field}")
+        return None
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f"Invalid pipeline: {op['op']} {field} must be an integer")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"Invalid pipeline: {op['op']} {field} is out of range")
+    return value
+
+
+def _number(op, field, minimum, maximum, default):
+    value = op.get(field, default)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+        raise ValueError(f"Invalid pipeline: {op['op']} {field} must be a number")
+    if not minimum <= value <= maximum:
+        raise ValueError(f"Invalid pipeline: {op['op']} {field} is out of range")
+    return value
+
+
+def point_lut(op, mean=None):
+    """256-entry lookup table for a point operation; contrast pivots on the image's mean gray level"""
+    if op['op'] == 'brightness':
+        values = [v * op['factor'] for v in range(256)]
+    elif op['op'] == 'contrast':
+        values = [mean + (v - mean) * op['factor'] for v in range(256)]
+    elif op['op'] == 'gamma':
+        values = [255 * (v / 255) ** (1 / op['gamma']) for v in range(256)]
+    else:
+        values = [255 if v >= op['level'] else 0 for v in range(256)]
+    return [min(255, max(0, int(round(v)))) for v in values]
+
+
+def _apply_point(img, op):
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+    mean = None
+    if op['op'] == 'contrast':
+        # Same pivot as ImageEnhance.Contrast
+        mean = int(ImageStat.Stat(img.convert('L')).mean[0] + 0.5)
+    lut = point_lut(op, mean)
+    if img.mode in ('LA', 'RGBA'):
+        return img.point(lut * (len(img.mode) - 1) + list(range(256)))  # alpha unchanged
+    return img.point(lut * len(img.mode))
+
+
+def _resize_geometry(op, size):
+    """Output size of a resize, plus the visible region of the input for fill"""
+    width, height = size
+    if op['mode'] == 'exact':
+        return (op['width'], op['height']), None
+
+    ratios = []
+    if op['width'] is not None:
+        ratios.append(op['width'] / width)
+    if op['height'] is not None:
+        ratios.append(op['height'] / height)
+
+    if op['mode'] == 'fit':
+        scale = min(ratios)
+        return (max(1, round(width * scale)), max(1, round(height * scale))), None
+
+    # fill: scale to cover, then center-crop to the requested size
+    scale = max(ratios)
+    visible_w, visible_h = op['width'] / scale, op['height'] / scale
+    left, top = (width - visible_w) / 2, (height - visible_h) / 2
+    return (op['width'], op['height']), (left, top, left + visible_w, top + visible_h)
+
+
+def _is_transpose(op):
+    return op['op'] == 'rotate' and op['angle'] in TRANSPOSE_METHODS and (
+        op['expand'] or op['angle'] == 180)
+
+
+def _hoist_grayscale(operations):
+    """Move grayscale before the geometry ahead of it, but never across a point operation"""
+    operations = list(operations)
+    for i, op in enumerate(operations):
+        if op['op'] == 'grayscale':
+            target = i
+            while target > 0 and operations[target - 1]['op'] in GEOMETRY_OPERATIONS:
+                target -= 1
+            operations.insert(target, operations.pop(i))
+            break
+    return operations
+
+
+def _sink_point_operations(operations):
+    """Move brightness and gamma after the crops and right-angle rotations that follow them"""
+    operations = list(operations)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(operations) - 1):
+            point, geometry = operations[i], operations[i + 1]
+            if point['op'] in SINKABLE_POINT_OPERATIONS and (geometry['op'] == 'crop' or _is_transpose(geometry)):
+                operations[i], operations[i + 1] = geometry, point
+                changed = True
+    return operations
+
+
+def _sink_transposes(operations):
+    """Move right-angle rotations after resizes so resampling sees the source first"""
+    operations = list(operations)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(operations) - 1):
+            rotate, resize = operations[i], operations[i + 1]
+            if _is_transpose(rotate) and resize['op'] == 'resize':
+                if rotate['angle'] != 180:
+                    resize = dict(resize, width=resize['height'], height=resize['width'])
+                operations[i], operations[i + 1] = resize, rotate
+                changed = True
+    return operations
+
+
+def _merge_transposes(operations):
+    merged = []
+    for op in operations:
+        if merged and _is_transpose(op) and _is_transpose(merged[-1]):
+            angle = (merged.pop()['angle'] + op['angle']) % 360
+            if angle:
+                merged.append({'op': 'rotate', 'angle': angle, 'expand': True})
+        else:
+            merged.append(op)
+    return merged
+
+
+def _collapse_resizes(operations):
+    collapsed = []
+    for op in operations:
+        previous = collapsed[-1] if collapsed else None
+        if previous and previous['op'] == 'resize' and op['op'] == 'resize':
+            if op['mode'] == 'exact' and previous['mode'] != 'fill':
+                # An exact resize discards the previous scale entirely
+                collapsed.pop()
+            elif previous['mode'] == 'exact' and op['mode'] == 'fit':
+                # Both sizes are known, so the fit resolves to an exact size
+                collapsed.pop()
+                (width, height), _ = _resize_geometry(op, (previous['width'], previous['height']))
+                op = {'op': 'resize', 'mode': 'exact', 'width': width, 'height': height}
+        collapsed.append(op)
+    return collapsed
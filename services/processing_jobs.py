@@ -0,0 +1,46 @@
+# services/processing_jobs.py
+from sqlalchemy import select
+from models.image import ImageUpload
+from services.image_processor import ImageProcessor
+from services.metrics import get_metrics
+from utils.memory_utils import MemoryUtils
+
+def process_image_job(image_id, db_session, storage, app_logger, notifier=None, options=None):
+    MemoryUtils.reset_peak_rss()
+    image = db_session.get(ImageUpload, image_id)
+    if not image:
+        app_logger.error(f"Image {image_id} not found")
+        return {"error": "Image not found"}
+
+    processor = ImageProcessor(storage, notifier, **(options or {}))
+    result = processor.process_image(image, db_session, app_logger)
+    result["peak_rss_bytes"] = _report_peak_memory(f"image {image_id}", app_logger)
+    return result
+
+def process_images_batch_job(image_ids, db_session, storage, app_logger, notifier=None, options=None):
+    MemoryUtils.reset_peak_rss()
+    # Load the whole batch with one IN query
+    images = db_session.execute(
+        select(ImageUpload).where(ImageUpload.id.in_(image_ids))
+    ).scalars().all()
+    missing = set(image_ids) - {image.id for image in images}
+    if missing:
+        app_logger.error(f"Images {sorted(missing)} not found")
+
+    processor = ImageProcessor(storage, notifier, **(options or {}))
+    results = processor.process_images(images, db_session, app_logger)
+    _report_peak_memory(f"batch of {len(images)} images", app_logger)
+    return results
+
+def _report_peak_memory(job, app_logger):
+    # Peak RSS is per process: on a thread pool, concurrent jobs share one figure
+    peak = MemoryUtils.peak_rss_bytes()
+    get_metrics().job_peak_memory(peak)
+    app_logger.info(f"Peak RSS for {job}: {peak / 2 ** 20:.1f} MB")
+    return peak
+
+# Task name -> job function; the same names Celery registers in tasks/image_tasks.py
+JOBS = {
+    "tasks.process_image": process_image_job,
+    "tasks.process_images_batch": process_images_batch_job,
+}
@@ -0,0 +1,189 @@
+# services/rendition_cache.py
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from services.metrics import get_metrics
+
+# Once the disk tier passes its cap, least recently used files go until it is back under this share of it
+DISK_LOW_WATER = 0.9
+
+
+class _Flight:
+    """A render in progress that other requests for the same key wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.data = None
+        self.error = None
+
+
+class RenditionCache:
+    """Two-tier cache of rendered image bytes.
+
+    A byte-bounded in-memory LRU sits in front of a directory of rendered
+    files, itself bounded by max_disk_bytes: a file's mtime is refreshed on
+    every disk hit, and the least recently used go first. Concurrent misses
+    for the same key share a single render.
+    """
+
+    def __init__(self, cache_folder, max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # Measured on the first write, so startup never walks the folder
+        self._disk_bytes = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'disk_evictions': 0,
+        }
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def get_or_render(self, key, extension, render):
+        """Return the bytes for key, calling render() only if no tier has them"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                get_metrics().cache_lookup('rendition', 'memory_hit')
+                return data
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self._stats['coalesced'] += 1
+                get_metrics().cache_lookup('rendition', 'coalesced')
+
+        if not leader:
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return flight.data
+
+        try:
+            path = self._disk_path(key, extension)
+            data = self._read_disk(path)
+            with self._lock:
+                self._stats['disk_hits' if data is not None else 'misses'] += 1
+            get_metrics().cache_lookup('rendition', 'disk_hit' if data is not None else 'miss')
+            if data is None:
+                data = render()
+                self._write_disk(path, data)
+
+            with self._lock:
+                self._memory_put(key, data)
+            flight.data = data
+            return data
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_items'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+            stats['disk_bytes'] = self._disk_bytes
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def _disk_path(self, key, extension):
+        return os.path.join(self.cache_folder, f"{key}.{extension}")
+
+    def _read_disk(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Recently used, as far as disk eviction is concerned
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, path, data):
+        # Write to a temp file and rename so readers never see a partial rendition
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_folder, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+            else:
+                self._disk_bytes += len(data)
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Delete the least recently used renditions until the folder is back under its low water mark"""
+        if not self._evicting.acquire(blocking=False):
+            return  # Another thread is already evicting
+        try:
+            # Listed again rather than trusted: other processes write to the same folder
+            entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_disk_bytes * DISK_LOW_WATER
+            evicted = 0
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            with self._lock:
+                self._disk_bytes = total
+                self._stats['disk_evictions'] += evicted
+        finally:
+            self._evicting.release()
+
+    def _disk_entries(self):
+        """(path, size, mtime) of every finished rendition on disk"""
+        entries = []
+        with os.scandir(self.cache_folder) as it:
+            for entry in it:
+                if entry.name.endswith('.part') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _memory_put(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._stats['evictions'] += 1
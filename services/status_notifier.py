@@ -0,0 +1,97 @@
+# services/status_notifier.py
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+class StatusNotifier:
+    """Fans image status changes out to requests waiting in this process.
+
+    Events are kept in a short ring buffer with increasing sequence numbers;
+    a waiter remembers the last sequence it saw and wakes on anything newer.
+    Waiters still re-read the database, so a dropped event only delays them.
+    """
+
+    def __init__(self, history=1024):
+        self._events = deque(maxlen=history)
+        self._sequence = 0
+        self._condition = threading.Condition()
+
+    def publish(self, user_id, image_id, status):
+        self._deliver({"user_id": user_id, "image_id": image_id, "status": status})
+
+    def cursor(self):
+        with self._condition:
+            return self._sequence
+
+    def wait(self, user_id, cursor, timeout):
+        """Wait up to timeout seconds for events for user_id newer than cursor.
+
+        Returns the matching events and the cursor to pass to the next call.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                events = [event for sequence, event in self._events
+                          if sequence > cursor and event["user_id"] == user_id]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events, self._sequence
+                cursor = self._sequence
+                self._condition.wait(remaining)
+
+    def _deliver(self, event):
+        with self._condition:
+            self._sequence += 1
+            self._events.append((self._sequence, event))
+            self._condition.notify_all()
+
+class RedisStatusNotifier(StatusNotifier):
+    """Publishes status changes on a Redis channel so every web node hears them.
+
+    Processes that only publish (workers) never subscribe; the listener
+    thread starts on the first wait() in a web process.
+    """
+
+    channel = "image-status"
+
+    def __init__(self, url, history=1024):
+        super().__init__(history)
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def publish(self, user_id, image_id, status):
+        try:
+            self._redis.publish(self.channel, json.dumps(
+                {"user_id": user_id, "image_id": image_id, "status": status}))
+        except Exception as e:
+            # Waiters fall back to re-reading the database
+            logging.getLogger(__name__).warning(f"Failed to publish status of image {image_id}: {e}")
+
+    def wait(self, user_id, cursor, timeout):
+        self._ensure_listening()
+        return super().wait(user_id, cursor, timeout)
+
+    def _ensure_listening(self):
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name="status-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._deliver(json.loads(message["data"]))
+            except Exception as e:
+                logging.getLogger(__name__).warning(f"Status listener disconnected: {e}")
+                time.sleep(1)
+
+def create_status_notifier(url=None):
+    """Redis pub/sub when url is set, otherwise in-process only"""
+    return RedisStatusNotifier(url) if url else StatusNotifier()
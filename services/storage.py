@@ -0,0 +1,344 @@
+# services/storage.py
+"""Where originals and results are kept: a sharded local directory or an S3 bucket.
+
+A storage hands out keys, stored in upload_path and result_path. A local
+key is the file's path, so rows written before sharding still resolve;
+an S3 key is the object key. Each storage writes under its own folder
+(or prefix) but reads and deletes any key of its backend.
+"""
+import contextlib
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import uuid
+import weakref
+from io import BytesIO
+from utils.file_utils import FileUtils
+
+CHUNK_SIZE = 64 * 1024
+SHARD_DEPTH = 2  # levels of two hex digits: 65,536 leaf directories
+S3_PART_SIZE = 8 * 1024 * 1024
+HEADER_BYTES = 64 * 1024  # kept from the start of each file for header checks
+SPOOL_MEMORY_BYTES = 1024 * 1024  # uploads bound for S3 stay in memory up to this size
+S3_BUFFER_BYTES = 64 * 1024 * 1024  # objects read into memory up to this size, mapped from a temp file above
+AREAS = ('uploads', 'processed')
+
+def storage_settings(config):
+    """The storage settings from an app config, as a plain dict that can be sent to worker processes"""
+    return {
+        'backend': config.get('STORAGE_BACKEND', 'local'),
+        'upload_folder': config.get('UPLOAD_FOLDER'),
+        'processed_folder': config.get('PROCESSED_FOLDER'),
+        'shard_depth': config.get('STORAGE_SHARD_DEPTH', SHARD_DEPTH),
+        's3_bucket': config.get('S3_BUCKET'),
+        's3_endpoint_url': config.get('S3_ENDPOINT_URL'),
+        's3_region': config.get('S3_REGION'),
+        's3_upload_prefix': config.get('S3_UPLOAD_PREFIX', 'originals/'),
+        's3_processed_prefix': config.get('S3_PROCESSED_PREFIX', 'processed/'),
+    }
+
+def create_storage(settings, area):
+    """The storage writing to area ('uploads' or 'processed')"""
+    if area not in AREAS:
+        raise ValueError(f"Unknown storage area: {area}")
+    backend = settings['backend']
+    if backend == 'local':
+        folder = settings['upload_folder'] if area == 'uploads' else settings['processed_folder']
+        return LocalStorage(folder, settings['shard_depth'])
+    if backend == 's3':
+        if not settings['s3_bucket']:
+            raise ValueError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        prefix = settings['s3_upload_prefix'] if area == 'uploads' else settings['s3_processed_prefix']
+        return S3Storage(settings['s3_bucket'], prefix, settings['shard_depth'],
+                         endpoint_url=settings['s3_endpoint_url'], region=settings['s3_region'])
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+def shard(name, depth=SHARD_DEPTH):
+    """Subdirectories for name, from its hash, so no directory grows past a few hundred entries"""
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return [digest[2 * level:2 * level + 2] for level in range(depth)]
+
+def _keep_head(head, chunk):
+    if len(head) < HEADER_BYTES:
+        head += chunk[:HEADER_BYTES - len(head)]
+
+class _HashingReader:
+    """Wraps a stream, hashing what is read through it and keeping the first HEADER_BYTES"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+        self.head = bytearray()
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.digest.update(chunk)
+        _keep_head(self.head, chunk)
+        return chunk
+
+class Spool:
+    """Where werkzeug writes an uploaded file as it parses the request (see Storage.spool).
+
+    Hashes and keeps the head of the bytes on the way in, so saving the
+    upload needs no second pass: a local spool is renamed into place, an
+    S3 one is uploaded once to its final key. The file is removed when
+    the spool is closed (werkzeug closes it at the end of the request)
+    unless it was moved into place.
+    """
+
+    def __init__(self, file, storage, path=None):
+        self.file = file
+        self.storage = storage
+        self.path = path
+        self.digest = hashlib.sha256()
+        self.head = bytearray()
+        self.size = 0
+        # Also on garbage collection, for a request aborted before werkzeug got the file
+        self._discard = weakref.finalize(self, FileUtils.delete_file, path) if path else None
+
+    def write(self, data):
+        self.digest.update(data)
+        _keep_head(self.head, data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        if self._discard:
+            self._discard()
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class _Buffer:
+    """A buffer that its readers can't close: Pillow closes the file of an image
+    when the image is closed, and one buffer serves several Image.open calls
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._buffer, name)
+
+@contextlib.contextmanager
+def _mapped(f):
+    """A read-only memory map of the open file f, or an empty buffer for an empty file (mmap refuses those)"""
+    if os.fstat(f.fileno()).st_size == 0:
+        yield BytesIO()
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        yield buffer
+
+class LocalStorage:
+    """Files under root, in hash-prefixed subdirectories, written by renaming a finished temp file"""
+
+    local = True
+
+    def __init__(self, root, shard_depth=SHARD_DEPTH):
+        self.root = root
+        self.shard_depth = shard_depth
+        os.makedirs(root, exist_ok=True)
+
+    def key_for(self, name):
+        return os.path.join(self.root, *shard(name, self.shard_depth), name)
+
+    def spool(self):
+        # In root, so the rename into place never crosses filesystems
+        fd, path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        return Spool(os.fdopen(fd, 'w+b'), self, path)
+
+    def save_stream(self, stream, extension, chunk_size=CHUNK_SIZE, check=None):
+        """Store stream under its SHA-256; returns the key and the hash.
+
+        A spool from this storage is renamed into place; any other stream is
+        copied in chunks. check, when given, is called with the first
+        HEADER_BYTES before the file is placed; if it raises, nothing is kept.
+        """
+        if isinstance(stream, Spool) and stream.storage is self:
+            stream.file.flush()
+            if check:
+                check(bytes(stream.head))
+            content_hash = stream.digest.hexdigest()
+            return self._place(stream.path, f"{content_hash}.{extension}"), content_hash
+        reader = _HashingReader(stream)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(reader, out, chunk_size)
+            if check:
+                check(bytes(reader.head))
+            content_hash = reader.digest.hexdigest()
+            key = self._place(tmp_path, f"{content_hash}.{extension}")
+            return key, content_hash
+        except Exception:
+            FileUtils.delete_file(tmp_path)
+            raise
+
+    def _place(self, tmp_path, name):
+        key = self.key_for(name)
+        if os.path.exists(key):
+            # Identical bytes are already stored
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            os.replace(tmp_path, key)
+        return key
+
+    def save(self, name, data):
+        """Write bytes under name, never exposing a partial file"""
+        key = self.key_for(name)
+        os.makedirs(os.path.dirname(key), exist_ok=True)
+        FileUtils.write_atomic(key, data)
+        return key
+
+    def open(self, key):
+        return open(key, 'rb')
+
+    @contextlib.contextmanager
+    def open_buffer(self, key):
+        """The file memory-mapped: decoders read the page cache without copying it through read calls"""
+        with open(key, 'rb') as f, _mapped(f) as buffer:
+            yield _Buffer(buffer)
+
+    def local_path(self, key):
+        return key
+
+    def exists(self, key):
+        return bool(key) and os.path.exists(key)
+
+    def size(self, key):
+        return os.path.getsize(key)
+
+    def delete(self, key):
+        return FileUtils.delete_file(key)
+
+class S3Storage:
+    """Objects under prefix in an S3-compatible bucket (AWS, MinIO, Ceph...), streamed both ways.
+
+    Credentials come from boto3's usual sources (AWS_* variables, profile,
+    instance role). boto3 is only needed when this backend is used.
+    """
+
+    local = False
+
+    def __init__(self, bucket, prefix='', shard_depth=SHARD_DEPTH, endpoint_url=None, region=None, client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.shard_depth = shard_depth
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs boto3 (pip install boto3)")
+        self.client = client or boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        # Multipart in S3_PART_SIZE parts, so an upload holds a few parts in memory, never the file
+        self.transfer_config = TransferConfig(multipart_threshold=S3_PART_SIZE, multipart_chunksize=S3_PART_SIZE)
+
+    def key_for(self, name):
+        return '/'.join([self.prefix.rstrip('/'), *shard(name, self.shard_depth), name]).lstrip('/')
+
+    def spool(self):
+        return Spool(tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES), self)
+
+    def save_stream(self, stream, extension, chunk_size=CHUNK_SIZE, check=None):
+        """Upload stream while hashing it, then copy it to its content-addressed key in the bucket.
+
+        A spool from this storage is already hashed, so it is uploaded
+        straight to its key. check works as in LocalStorage.save_stream.
+        """
+        if isinstance(stream, Spool) and stream.storage is self:
+            if check:
+                check(bytes(stream.head))
+            content_hash = stream.digest.hexdigest()
+            key = self.key_for(f"{content_hash}.{extension}")
+            if not self.exists(key):
+                stream.file.seek(0)
+                self.client.upload_fileobj(stream.file, self.bucket, key, Config=self.transfer_config)
+            return key, content_hash
+        reader = _HashingReader(stream)
+        # The key depends on the hash, known only once everything is sent
+        tmp_key = f"{self.prefix.rstrip('/')}/tmp/{uuid.uuid4().hex}.part".lstrip('/')
+        self.client.upload_fileobj(reader, self.bucket, tmp_key, Config=self.transfer_config)
+        try:
+            if check:
+                check(bytes(reader.head))
+            content_hash = reader.digest.hexdigest()
+            key = self.key_for(f"{content_hash}.{extension}")
+            if not self.exists(key):
+                # Server-side: the bytes aren't sent again
+                self.client.copy({'Bucket': self.bucket, 'Key': tmp_key}, self.bucket, key, Config=self.transfer_config)
+            return key, content_hash
+        finally:
+            self.client.delete_object(Bucket=self.bucket, Key=tmp_key)
+
+    def save(self, name, data):
+        # A PUT is atomic: readers see the old object or the whole new one
+        key = self.key_for(name)
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(data))
+        return key
+
+    def open(self, key, byte_range=None):
+        """A stream of the object's bytes, read from S3 as it is consumed.
+
+        byte_range is a (start, stop) pair, stop exclusive, for just that slice.
+        """
+        options = {'Range': f"bytes={byte_range[0]}-{byte_range[1] - 1}"} if byte_range else {}
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key, **options)['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+
+    @contextlib.contextmanager
+    def open_buffer(self, key):
+        """The object in a seekable buffer for decoders: in memory, or mapped from a temp file when large"""
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+        body = response['Body']
+        try:
+            if response['ContentLength'] <= S3_BUFFER_BYTES:
+                yield _Buffer(BytesIO(body.read()))
+                return
+            with tempfile.TemporaryFile() as tmp:
+                shutil.copyfileobj(body, tmp, S3_PART_SIZE)
+                tmp.flush()
+                with _mapped(tmp) as buffer:
+                    yield _Buffer(buffer)
+        finally:
+            body.close()
+
+    def local_path(self, key):
+        return None
+
+    def exists(self, key):
+        if not key:
+            return False
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+
+    def delete(self, key):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Error deleting object {key}: {e}")
+            return False
@@ -0,0 +1,119 @@
+# services/strip_decoder.py
+import contextlib
+import math
+import os
+import struct
+import zlib
+from PIL import Image
+
+# PNG raw modes the strip decoder handles (8 bits per sample) -> bytes per pixel
+STRIP_RAWMODES = {"L": 1, "LA": 2, "P": 1, "RGB": 3, "RGBA": 4}
+# Pillow keeps every multi-band mode at 4 bytes per pixel
+DECODED_PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2}
+READ_SIZE = 64 * 1024
+
+def decoded_bytes(size, mode):
+    """Memory Pillow needs to hold an image of this size and mode"""
+    return size[0] * size[1] * DECODED_PIXEL_BYTES.get(mode, 4)
+
+def can_decode_strips(img):
+    """True for non-interlaced 8-bit PNGs, whose rows can be decoded a strip at a time"""
+    if img.format != "PNG" or img.info.get("interlace") or len(img.tile) != 1:
+        return False
+    decoder, _, _, rawmode = img.tile[0]
+    return decoder == "zip" and rawmode in STRIP_RAWMODES
+
+def budget_factor(size, memory_budget):
+    """Smallest integer downscale whose 4-byte-per-pixel result fits in memory_budget"""
+    return max(1, math.ceil(math.sqrt(size[0] * size[1] * 4 / memory_budget)))
+
+def decode_strips(source, img, factor, grayscale=False, strip_bytes=8 * 1024 * 1024):
+    """Decode a PNG opened (but not loaded) as img, downscaled by factor with a box filter.
+
+    The zlib stream is inflated incrementally and each strip of rows is
+    unfiltered by Pillow, so memory stays near strip_bytes plus the
+    downscaled result however large the source is. A strip is handed to
+    Pillow as a stored (uncompressed) zlib stream led by the previous
+    strip's last row, which the PNG row filters reference.
+    """
+    width, height = img.size
+    _, _, offset, rawmode = img.tile[0]
+    pixel_bytes = STRIP_RAWMODES[rawmode]
+    row_bytes = width * pixel_bytes + 1  # one filter-type byte per row
+    rows_per_strip = factor * max(1, strip_bytes // (width * 4 * factor))
+    palette = img.palette.getdata() if img.mode == "P" else None
+    transparency = img.info.get("transparency")
+
+    output = None
+    previous_row = bytes(width * pixel_bytes)
+    pending = bytearray()
+    rows = _inflate(source, offset)
+    top = 0
+    while top < height:
+        strip_rows = min(rows_per_strip, height - top)
+        wanted = strip_rows * row_bytes
+        while len(pending) < wanted:
+            data = next(rows, None)
+            if data is None:
+                raise OSError(f"Truncated PNG data at row {top + len(pending) // row_bytes}")
+            pending += data
+        data = b"\x00" + previous_row + pending[:wanted]
+        del pending[:wanted]
+
+        strip = Image.frombytes(img.mode, (width, strip_rows + 1), zlib.compress(data, 0), "zip", rawmode)
+        del data
+        previous_row = strip.crop((0, strip_rows, width, strip_rows + 1)).tobytes("raw", rawmode)
+        strip = strip.crop((0, 1, width, strip_rows + 1))
+        if palette:
+            strip.putpalette(palette[1], palette[0])
+            if transparency is not None:
+                strip.info["transparency"] = transparency
+        if grayscale and strip.mode != "L":
+            strip = strip.convert("L")
+        elif strip.mode == "P":
+            strip = strip.convert("RGBA" if transparency is not None else "RGB")
+        if factor > 1:
+            strip = strip.reduce(factor)
+
+        if output is None:
+            output = Image.new(strip.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+        output.paste(strip, (0, top // factor))
+        top += strip_rows
+    return output
+
+def _inflate(source, offset):
+    """Yield the inflated IDAT stream of the PNG in source (a path or a seekable buffer),
+    at most READ_SIZE bytes at a time.
+
+    offset is where the first IDAT chunk's data starts, as Pillow reports
+    it in the image tile. Output is bounded per step, so a stream that
+    inflates far beyond its compressed size can't balloon memory.
+    """
+    inflater = zlib.decompressobj()
+    opened = open(source, "rb") if isinstance(source, (str, os.PathLike)) else contextlib.nullcontext(source)
+    with opened as f:
+        f.seek(offset - 8)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type != b"IDAT":
+                return
+            remaining = length
+            while remaining:
+                data = f.read(min(remaining, READ_SIZE))
+                if not data:
+                    return
+                remaining -= len(data)
+                try:
+                    while True:
+                        out = inflater.decompress(data, READ_SIZE)
+                        if out:
+                            yield out
+                        data = inflater.unconsumed_tail
+                        if not data and len(out) < READ_SIZE:
+                            break
+                except zlib.error as e:
+                    raise OSError(f"Corrupt PNG data: {e}")
+            f.seek(4, 1)  # CRC
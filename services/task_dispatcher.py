@@ -0,0 +1,238 @@
+# services/task_dispatcher.py
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import select, update, or_, and_
+from models.engine import COMMIT_RETRIES, commit_with_retry, settings_from_config
+from models.image import ImageUpload, ImageStatus
+from services.execution_backends import CeleryBackend, ThreadBackend, ProcessPoolBackend, QueueFullError
+from services.metrics import get_metrics
+from services.image_processor import ImageProcessor
+from services.storage import storage_settings
+
+# Broker URLs that cannot reach a separate worker process
+LOCAL_BROKER_URLS = {'', 'memory://'}
+
+class BatchCoalescer:
+    """Buffers items and hands them to flush() in batches of batch_size,
+    or whatever has accumulated after max_wait seconds."""
+
+    def __init__(self, flush, batch_size, max_wait):
+        self._flush = flush
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, item):
+        with self._lock:
+            self._pending.append(item)
+            if len(self._pending) >= self.batch_size:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_wait, self._flush_late)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._flush(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._flush(batch)
+
+    def _flush_late(self):
+        # No caller waits on a timer flush, so a failure can only be logged here
+        try:
+            self.flush()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Flushing a batch of {self.batch_size} failed: {e}")
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+class TaskDispatcher:
+    """Hands image processing to an execution backend.
+
+    PROCESSING_BACKEND picks the backend: 'celery', 'thread' (a bounded
+    executor in this process), 'process' (a local process pool for nodes
+    without a broker) or 'auto', which uses Celery only when a real broker
+    is configured.
+
+    With batch_size > 1, image ids are coalesced and sent to
+    tasks.process_images_batch instead of one task per image. The task_id
+    stored on each row then identifies the image's job rather than the
+    Celery batch task.
+
+    A local backend whose queue stays full raises QueueFullError. Every
+    image whose job was dropped, including the rest of a coalesced batch,
+    is then marked failed, so no client waits on a row nothing will process.
+    """
+
+    def __init__(self, app, db, celery, max_workers=4, batch_size=1, batch_max_wait=0.05):
+        self.app = app
+        self.db = db
+        self.celery = celery
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.created_at = datetime.utcnow()
+        self._backend = None
+        self._lock = threading.Lock()
+        self._coalescer = None
+        if batch_size > 1:
+            self._coalescer = BatchCoalescer(self._dispatch_batch, batch_size, batch_max_wait)
+
+    def uses_broker(self):
+        broker_url = self.app.config.get('CELERY_BROKER_URL') or ''
+        return broker_url not in LOCAL_BROKER_URLS
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = self._create_backend()
+            return self._backend
+
+    def start(self, before=None):
+        """Requeue abandoned jobs in the background when the backend keeps its queue in memory"""
+        if self.backend.loses_jobs_on_exit and self.app.config.get('PROCESSING_RECONCILE_ON_START', True):
+            threading.Thread(target=self.reconcile, args=(before,), name="reconcile-jobs", daemon=True).start()
+
+    def reconcile(self, before=None):
+        """Requeue jobs a previous process left PROCESSING, or queued but never started.
+
+        Only rows uploaded before `before` (by default, when this dispatcher
+        was created) are touched: anything newer was queued by a live
+        process, possibly another server worker. Only safe when this process
+        is the sole consumer of the local queue.
+        """
+        before = before or self.created_at
+        with self.app.app_context():
+            session = self.db.session
+            rows = session.execute(
+                select(ImageUpload.id, ImageUpload.task_id).where(
+                    ImageUpload.uploaded_at < before,
+                    or_(ImageUpload.status == ImageStatus.PROCESSING.value,
+                        and_(ImageUpload.status == ImageStatus.PENDING.value, ImageUpload.task_id.isnot(None)))
+                )
+            ).all()
+            if not rows:
+                return 0
+            
+            session.execute(
+                update(ImageUpload)
+                .where(ImageUpload.id.in_([row.id for row in rows]),
+                       ImageUpload.status == ImageStatus.PROCESSING.value)
+                .values(status=ImageStatus.PENDING.value)
+            )
+            session.commit()
+        
+        self.app.logger.info(f"Requeueing {len(rows)} abandoned image jobs")
+        try:
+            self.dispatch_many([(row.id, row.task_id) for row in rows])
+        except QueueFullError as e:
+            self.app.logger.error(f"Processing queue full while requeueing; failed {len(e.image_ids)} images")
+        return len(rows)
+
+    def dispatch(self, image_id, task_id):
+        if self._coalescer:
+            self._coalescer.add(image_id)
+        else:
+            self._submit("tasks.process_image", [image_id], task_id, [image_id])
+        return task_id
+
+    def dispatch_many(self, jobs):
+        """Dispatch (image_id, task_id) pairs, as one Celery group when a broker is used"""
+        if not jobs:
+            return []
+
+        if self._coalescer:
+            # The ids are all known up front, so split them into batches without waiting
+            image_ids = [image_id for image_id, _ in jobs]
+            batches = [image_ids[i:i + self.batch_size] for i in range(0, len(image_ids), self.batch_size)]
+            calls = [("tasks.process_images_batch", [batch], None) for batch in batches]
+        else:
+            batches = [[image_id] for image_id, _ in jobs]
+            calls = [("tasks.process_image", [image_id], task_id) for image_id, task_id in jobs]
+        try:
+            self.backend.submit_many(calls)
+        except QueueFullError as e:
+            dropped = [image_id for batch in batches[e.submitted:] for image_id in batch]
+            self._fail(dropped)
+            raise QueueFullError(str(e), e.submitted, dropped) from e
+        return [task_id for _, task_id in jobs]
+
+    def shutdown(self, wait=True):
+        if self._coalescer:
+            self._coalescer.flush()
+        with self._lock:
+            backend = self._backend
+        if backend:
+            backend.shutdown(wait=wait)
+
+    def _dispatch_batch(self, image_ids):
+        self._submit("tasks.process_images_batch", [image_ids], None, image_ids)
+
+    def _submit(self, task_name, args, task_id, image_ids):
+        try:
+            self.backend.submit(task_name, args, task_id)
+        except QueueFullError as e:
+            self._fail(image_ids)
+            raise QueueFullError(str(e), image_ids=image_ids) from e
+
+    def _fail(self, image_ids):
+        """Mark the still-pending images of dropped jobs failed, and tell anyone waiting on them"""
+        failed = ImageStatus.FAILED.value
+        with self.app.app_context():
+            session = self.db.session
+            rows = session.execute(
+                select(ImageUpload.id, ImageUpload.user_id)
+                .where(ImageUpload.id.in_(image_ids), ImageUpload.status == ImageStatus.PENDING.value)
+            ).all()
+            commit_with_retry(session, lambda: session.execute(
+                update(ImageUpload)
+                .where(ImageUpload.id.in_([row.id for row in rows]),
+                       ImageUpload.status == ImageStatus.PENDING.value)
+                .values(status=failed)
+            ), self.app.config.get('DB_COMMIT_RETRIES', COMMIT_RETRIES))
+        self.app.logger.error(f"Processing queue full; failed {len(rows)} images: {[row.id for row in rows]}")
+        notifier = self.app.extensions.get('status_notifier')
+        for row in rows:
+            get_metrics().status_transition(failed)
+            if notifier:
+                notifier.publish(row.user_id, row.id, failed)
+
+    def _create_backend(self):
+        config = self.app.config
+        name = config.get('PROCESSING_BACKEND', 'auto')
+        if name == 'auto':
+            name = 'celery' if self.uses_broker() else 'thread'
+
+        local_options = {
+            'max_pending': config.get('PROCESSING_QUEUE_SIZE'),
+            'submit_timeout': config.get('PROCESSING_SUBMIT_TIMEOUT', 30),
+        }
+        if name == 'celery':
+            return CeleryBackend(self.celery)
+        if name == 'thread':
+            return ThreadBackend(self.app, self.db, self.max_workers, **local_options)
+        if name == 'process':
+            return ProcessPoolBackend(
+                config['SQLALCHEMY_DATABASE_URI'],
+                storage_settings(config),
+                max_workers=config.get('PROCESSING_POOL_WORKERS'),
+                notifier_url=config.get('STATUS_NOTIFIER_URL'),
+                metrics_enabled=config.get('METRICS_ENABLED', False),
+                processor_options=ImageProcessor.options_from_config(config),
+                database_settings=settings_from_config(config),
+                **local_options
+            )
+        raise ValueError(f"Unknown PROCESSING_BACKEND: {name}")
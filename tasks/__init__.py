@@ -1,4 +1,2 @@
 # tasks/__init__.py
-# from .image_tasks import make_celery, create_tasks
-
-# __all__ = ['make_celery', 'create_tasks']
\ No newline at end of file
+# Importing tasks.image_tasks registers every task on the shared extensions.celery app
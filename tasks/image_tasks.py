@@ -1,40 +1,80 @@
 # tasks/image_tasks.py
-from celery import Celery
+import os
+from celery import Task
+from celery.signals import task_prerun
 from flask import current_app
-from models import ImageUpload
-from services import ImageProcessor, CleanupService
-
-def make_celery(app):
-    celery = Celery(
-        app.import_name,
-        backend=app.config['CELERY_RESULT_BACKEND'],
-        broker=app.config['CELERY_BROKER_URL']
-    )
-    celery.conf.update(app.config)
-
-    class ContextTask(celery.Task):
-        def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return self.run(*args, **kwargs)
-    celery.Task = ContextTask
-    return celery
-
-def register_tasks(celery, app, db):
-    @celery.task(name="tasks.process_image")
-    def process_image_task(image_id):
-        with app.app_context():
-            image = db.session.get(ImageUpload, image_id)
-            if not image:
-                current_app.logger.error(f"Image {image_id} not found")
-                return {"error": "Image not found"}
-
-            processor = ImageProcessor(app.config['PROCESSED_FOLDER'])
-            return processor.process_image(image, db.session, current_app.logger)
-
-    @celery.task(name="tasks.cleanup_old_files")
-    def cleanup_old_files_task():
-        with app.app_context():
-            cleanup_service = CleanupService()
-            return cleanup_service.cleanup_old_files(db.session, current_app.logger)
-    
-    return process_image_task, cleanup_old_files_task
\ No newline at end of file
+from extensions import celery, db
+from services.cleanup_service import CleanupService
+from services.image_processor import ImageProcessor
+from services.metrics import get_metrics
+from services.processing_jobs import process_image_job, process_images_batch_job
+
+class AppContextTask(Task):
+    """Runs inside the app context of the Flask app init_celery bound to the Celery app"""
+
+    def __call__(self, *args, **kwargs):
+        with self.app.flask_app.app_context():
+            return self.run(*args, **kwargs)
+
+# Queue wait, from the dispatched_at header CeleryBackend stamps on each message
+@task_prerun.connect(weak=False, dispatch_uid="image-task-wait")
+def record_task_wait(task=None, **kwargs):
+    get_metrics().task_started(getattr(task.request, 'dispatched_at', None))
+
+def _job_arguments():
+    app = current_app
+    return {
+        "notifier": app.extensions.get('status_notifier'),
+        "options": ImageProcessor.options_from_config(app.config),
+    }
+
+@celery.task(name="tasks.process_image", base=AppContextTask)
+def process_image_task(image_id):
+    try:
+        current_app.logger.info(f"Processing image {image_id}")
+
+        result = process_image_job(
+            image_id, db.session, current_app.extensions['result_storage'], current_app.logger,
+            **_job_arguments())
+
+        current_app.logger.info(f"Image processing completed: {result}")
+        return result
+
+    except Exception as e:
+        current_app.logger.error(f"Error processing image {image_id}: {str(e)}")
+        return {"error": str(e)}
+
+@celery.task(name="tasks.process_images_batch", base=AppContextTask)
+def process_images_batch_task(image_ids):
+    try:
+        results = process_images_batch_job(
+            image_ids, db.session, current_app.extensions['result_storage'], current_app.logger,
+            **_job_arguments())
+
+        current_app.logger.info(f"Batch processing completed for {len(results)} images")
+        return results
+
+    except Exception as e:
+        current_app.logger.error(f"Error processing batch {image_ids}: {str(e)}")
+        return {"error": str(e)}
+
+@celery.task(name="tasks.cleanup_old_files", base=AppContextTask)
+def cleanup_old_files_task():
+    config = current_app.config
+    try:
+        current_app.logger.info("Starting cleanup task")
+        cleanup_service = CleanupService(
+            chunk_size=config['CLEANUP_CHUNK_SIZE'],
+            time_budget=config['CLEANUP_TIME_BUDGET_SECONDS'],
+            delete_workers=config['CLEANUP_DELETE_WORKERS'],
+            storage=current_app.extensions['result_storage'],
+            rendition_folder=config.get('RENDITION_FOLDER') or os.path.join(config['PROCESSED_FOLDER'], 'renditions')
+        )
+        result = cleanup_service.cleanup_old_files(
+            db.session, current_app.logger, days_old=config['CLEANUP_RETENTION_DAYS'])
+        current_app.logger.info(f"Cleanup completed: {result} files removed")
+        return {"status": "completed", "files_removed": result}
+
+    except Exception as e:
+        current_app.logger.error(f"Error in cleanup task: {str(e)}")
+        return {"error": str(e)}
@@ -71,4 +71,522 @@ def test_get_nonexistent_image(client, auth_headers):
     """Test getting status of nonexistent image."""
     response = client.get('/api/images/99999', headers=auth_headers)
     
-    assert response.status_code == 404
\ No newline at end of file
+    assert response.status_code == 404
+
+def test_upload_image_async(app, client, auth_headers, create_test_image):
+    """Test async upload enqueues processing and returns a status URL."""
+    app.config['PROCESSING_MODE'] = 'async'
+    data = {'file': (create_test_image(), 'test.jpg')}
+    
+    response = client.post('/api/upload',
+                          data=data,
+                          headers=auth_headers,
+                          content_type='multipart/form-data')
+    
+    assert response.status_code == 202
+    data = response.get_json()
+    assert data['task_id']
+    assert data['status_url'] == f"/api/images/{data['image_id']}"
+    
+    # memory:// broker falls back to the in-process executor; wait for it to drain
+    app.extensions['task_dispatcher'].shutdown()
+    # The fixture's app context shares one session across requests
+    app.extensions['sqlalchemy'].session.expire_all()
+    
+    response = client.get(data['status_url'], headers=auth_headers)
+    status = response.get_json()
+    assert status['status'] == 'completed'
+    assert status['task_id'] == data['task_id']
+    assert status['result_url'] == f"/api/images/{data['image_id']}/result"
+
+def test_upload_duplicate_image_reuses_result(app, client, auth_headers, create_test_image):
+    """Test re-uploading identical bytes reuses the stored original and result."""
+    from models import ImageUpload
+    
+    image_bytes = create_test_image().getvalue()
+    first = client.post('/api/upload',
+                        data={'file': (BytesIO(image_bytes), 'first.jpg')},
+                        headers=auth_headers,
+                        content_type='multipart/form-data').get_json()
+    second = client.post('/api/upload',
+                         data={'file': (BytesIO(image_bytes), 'second.jpg')},
+                         headers=auth_headers,
+                         content_type='multipart/form-data').get_json()
+    
+    assert second['status'] == 'completed'
+    assert second['deduplicated'] == True
+    
+    db = app.extensions['sqlalchemy']
+    first_image = db.session.get(ImageUpload, first['image_id'])
+    second_image = db.session.get(ImageUpload, second['image_id'])
+    assert first_image.content_hash == second_image.content_hash
+    assert first_image.upload_path == second_image.upload_path
+    assert first_image.result_path == second_image.result_path
+    assert second_image.original_filename == 'second.jpg'
+
+def test_upload_reuses_results_stored_under_the_legacy_default_key(app, client, auth_headers, create_test_image):
+    """Test results the default pipeline stored as JPEG before 'auto' are reused for JPEG inputs only."""
+    from models import ImageUpload
+    from services.pipeline import Pipeline
+    
+    db = app.extensions['sqlalchemy']
+    legacy_key = Pipeline.default().legacy_cache_key
+    uploads = {}
+    for format, name in (('JPEG', 'photo.jpg'), ('PNG', 'drawing.png')):
+        image_bytes = create_test_image(format).getvalue()
+        first = client.post('/api/upload', data={'file': (BytesIO(image_bytes), name)},
+                            headers=auth_headers, content_type='multipart/form-data').get_json()
+        image = db.session.get(ImageUpload, first['image_id'])
+        image.pipeline_key = legacy_key
+        db.session.commit()
+        uploads[format] = (image_bytes, name, image.result_path)
+    
+    image_bytes, name, result_path = uploads['JPEG']
+    second = client.post('/api/upload', data={'file': (BytesIO(image_bytes), name)},
+                         headers=auth_headers, content_type='multipart/form-data').get_json()
+    assert second['deduplicated'] == True
+    assert db.session.get(ImageUpload, second['image_id']).result_path == result_path
+    
+    image_bytes, name, result_path = uploads['PNG']
+    second = client.post('/api/upload', data={'file': (BytesIO(image_bytes), name)},
+                         headers=auth_headers, content_type='multipart/form-data').get_json()
+    assert not second.get('deduplicated')
+
+def test_upload_image_with_pipeline(app, client, auth_headers, create_test_image):
+    """Test uploads can carry their own pipeline."""
+    import json
+    from PIL import Image
+    from models import ImageUpload
+    
+    pipeline = [{'op': 'resize', 'width': 50, 'mode': 'fit'}, {'op': 'format', 'format': 'png'}]
+    data = {'file': (create_test_image(), 'test.jpg'), 'pipeline': json.dumps(pipeline)}
+    
+    response = client.post('/api/upload', data=data, headers=auth_headers,
+                          content_type='multipart/form-data')
+    
+    assert response.status_code == 200
+    image = app.extensions['sqlalchemy'].session.get(ImageUpload, response.get_json()['image_id'])
+    assert json.loads(image.pipeline)[0] == {'op': 'resize', 'mode': 'fit', 'width': 50, 'height': None}
+    with Image.open(image.result_path) as result:
+        assert result.format == 'PNG'
+        assert result.size == (50, 50)
+
+def test_upload_image_invalid_pipeline(client, auth_headers, create_test_image):
+    """Test an invalid pipeline is rejected."""
+    data = {'file': (create_test_image(), 'test.jpg'), 'pipeline': '[{"op": "blur"}]'}
+    
+    response = client.post('/api/upload', data=data, headers=auth_headers,
+                          content_type='multipart/form-data')
+    
+    assert response.status_code == 400
+
+def test_get_processed_image_rendition(app, client, auth_headers, create_test_image):
+    """Test on-the-fly renditions are rendered once and then served from cache."""
+    from PIL import Image
+    
+    upload = client.post('/api/upload',
+                         data={'file': (create_test_image(), 'test.jpg')},
+                         headers=auth_headers,
+                         content_type='multipart/form-data').get_json()
+    url = f"/api/images/{upload['image_id']}/result?w=200&fmt=png"
+    
+    response = client.get(url, headers=auth_headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    with Image.open(BytesIO(response.data)) as img:
+        assert img.size == (200, 150)  # fit inside the default 800x600 rendition
+        assert img.mode == 'L'
+    
+    assert client.get(url, headers=auth_headers).data == response.data
+    stats = app.extensions['rendition_cache'].get_stats()
+    assert stats['misses'] == 1
+    assert stats['memory_hits'] == 1
+
+def test_get_processed_image_negotiates_webp(client, auth_headers, create_test_image):
+    """Test 'auto' results are served as WebP to clients that accept it, varying on Accept."""
+    import json
+    from PIL import Image
+    
+    upload = client.post('/api/upload',
+                         data={'file': (create_test_image(), 'test.jpg')},
+                         headers=auth_headers,
+                         content_type='multipart/form-data').get_json()
+    url = f"/api/images/{upload['image_id']}/result"
+    
+    webp = client.get(url, headers={**auth_headers, 'Accept': 'image/avif,image/webp,*/*'})
+    assert webp.status_code == 200
+    assert webp.mimetype == 'image/webp'
+    assert 'Accept' in webp.headers['Vary']
+    with Image.open(BytesIO(webp.data)) as img:
+        assert img.format == 'WEBP'
+        assert img.size == (800, 600)
+    revalidated = client.get(url, headers={**auth_headers, 'Accept': 'image/webp',
+                                           'If-None-Match': webp.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert 'Accept' in revalidated.headers['Vary']
+    
+    jpeg = client.get(url, headers={**auth_headers, 'Accept': '*/*'})
+    assert jpeg.mimetype == 'image/jpeg'
+    assert 'Accept' in jpeg.headers['Vary']
+    assert jpeg.headers['ETag'] != webp.headers['ETag']
+    
+    # Transparent images are stored as PNG and negotiated to lossless WebP
+    source = BytesIO()
+    Image.new('RGBA', (60, 40), (255, 0, 0, 128)).save(source, 'PNG')
+    pipeline = [{'op': 'resize', 'width': 30, 'mode': 'fit'}, {'op': 'format', 'format': 'auto'}]
+    upload = client.post('/api/upload',
+                         data={'file': (BytesIO(source.getvalue()), 'logo.png'), 'pipeline': json.dumps(pipeline)},
+                         headers=auth_headers,
+                         content_type='multipart/form-data').get_json()
+    url = f"/api/images/{upload['image_id']}/result"
+    assert client.get(url, headers=auth_headers).mimetype == 'image/png'
+    webp = client.get(url, headers={**auth_headers, 'Accept': 'image/webp'})
+    assert webp.mimetype == 'image/webp'
+    assert b'VP8L' in webp.data[:64]  # lossless bitstream
+
+def test_get_processed_image_rendition_invalid_args(client, auth_headers, create_test_image):
+    """Test rendition parameters are validated."""
+    upload = client.post('/api/upload',
+                         data={'file': (create_test_image(), 'test.jpg')},
+                         headers=auth_headers,
+                         content_type='multipart/form-data').get_json()
+    
+    for query in ['w=0', 'w=abc', 'h=100000', 'fmt=bmp', 'q=100']:
+        response = client.get(f"/api/images/{upload['image_id']}/result?{query}", headers=auth_headers)
+        assert response.status_code == 400
+
+def test_upload_images_batch(app, client, auth_headers, create_test_image):
+    """Test batch upload inserts every valid file and reports per-file errors."""
+    data = {'files': [
+        (create_test_image(), 'first.jpg'),
+        (create_test_image('PNG'), 'second.png'),
+        (BytesIO(b'not an image'), 'notes.txt'),
+    ]}
+    
+    response = client.post('/api/uploads/batch', data=data, headers=auth_headers,
+                          content_type='multipart/form-data')
+    
+    assert response.status_code == 202
+    data = response.get_json()
+    assert [image['original_filename'] for image in data['images']] == ['first.jpg', 'second.png']
+    assert all(image['task_id'] for image in data['images'])
+    assert data['errors'] == [{'index': 2, 'filename': 'notes.txt', 'error': 'Invalid file type'}]
+    
+    app.extensions['task_dispatcher'].shutdown()
+    app.extensions['sqlalchemy'].session.expire_all()
+    for image in data['images']:
+        status = client.get(image['status_url'], headers=auth_headers).get_json()
+        assert status['status'] == 'completed'
+
+def test_upload_images_batch_reports_ids_when_queue_full(app, client, auth_headers, create_test_image):
+    """Test a batch that only partly fits the queue returns 503 with every committed id."""
+    import threading
+    from services.execution_backends import ThreadBackend
+    
+    release = threading.Event()
+    
+    class BlockingBackend(ThreadBackend):
+        def _job(self, task_name, args):
+            return lambda timeout, dispatched_at: release.wait(timeout), 5
+    
+    backend = BlockingBackend(app, app.extensions['sqlalchemy'], max_workers=1, max_pending=1, submit_timeout=0.01)
+    app.extensions['task_dispatcher']._backend = backend
+    data = {'files': [(create_test_image(), 'first.jpg'), (create_test_image(), 'second.jpg')]}
+    
+    response = client.post('/api/uploads/batch', data=data, headers=auth_headers,
+                          content_type='multipart/form-data')
+    release.set()
+    backend.shutdown()
+    
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    images = response.get_json()['images']
+    assert [image['status'] for image in images] == ['pending', 'failed']
+    status = client.get(images[1]['status_url'], headers=auth_headers).get_json()
+    assert status['status'] == 'failed'
+
+def test_upload_images_batch_no_valid_files(client, auth_headers):
+    """Test batch upload with only invalid files is rejected."""
+    data = {'files': [(BytesIO(b'text'), 'notes.txt')]}
+    
+    response = client.post('/api/uploads/batch', data=data, headers=auth_headers,
+                          content_type='multipart/form-data')
+    
+    assert response.status_code == 400
+    assert len(response.get_json()['errors']) == 1
+
+def test_list_images_pagination(app, client, auth_headers):
+    """Test list_images pages with a keyset cursor and filters."""
+    from datetime import datetime, timedelta
+    from flask_jwt_extended import decode_token
+    from models import ImageUpload
+    
+    user_id = int(decode_token(auth_headers['Authorization'].split()[1])['sub'])
+    db = app.extensions['sqlalchemy']
+    start = datetime(2024, 1, 1)
+    db.session.add_all([
+        ImageUpload(user_id=user_id, original_filename=f'{index}.jpg', upload_path=f'/tmp/{index}.jpg',
+                    status='completed' if index % 2 else 'pending',
+                    uploaded_at=start + timedelta(hours=index // 2))  # pairs share a timestamp
+        for index in range(5)
+    ])
+    db.session.commit()
+    
+    # Without limit or cursor the body is the whole list, as before pagination
+    response = client.get('/api/images', headers=auth_headers)
+    assert [image['original'] for image in response.get_json()] == ['4.jpg', '3.jpg', '2.jpg', '1.jpg', '0.jpg']
+    assert 'X-Next-Cursor' not in response.headers
+    
+    seen, url = [], '/api/images?limit=2'
+    while url:
+        response = client.get(url, headers=auth_headers)
+        seen.extend(image['original'] for image in response.get_json())
+        url = None
+        if 'Link' in response.headers:
+            assert response.headers['X-Next-Cursor'] in response.headers['Link']
+            url = response.headers['Link'].split('>')[0][1:]
+    assert seen == ['4.jpg', '3.jpg', '2.jpg', '1.jpg', '0.jpg']
+    
+    data = client.get('/api/images?status=completed', headers=auth_headers).get_json()
+    assert [image['original'] for image in data] == ['3.jpg', '1.jpg']
+    
+    data = client.get('/api/images?since=2024-01-01T01:00:00&until=2024-01-01T02:00:00',
+                      headers=auth_headers).get_json()
+    assert [image['original'] for image in data] == ['3.jpg', '2.jpg']
+    
+    for query in ['limit=0', 'limit=1000', 'status=unknown', 'cursor=bogus', 'since=yesterday']:
+        assert client.get(f'/api/images?{query}', headers=auth_headers).status_code == 400
+
+def test_get_result_conditional_and_range(app, client, auth_headers, create_test_image):
+    """Test results carry strong validators, revalidate with 304 and honour Range."""
+    import os
+    from models import ImageUpload
+    
+    upload = client.post('/api/upload', headers=auth_headers, data={
+        'file': (create_test_image(), 'test.jpg')
+    }, content_type='multipart/form-data').get_json()
+    url = f"/api/images/{upload['image_id']}/result"
+    
+    response = client.get(url, headers=auth_headers)
+    assert response.status_code == 200
+    image = app.extensions['sqlalchemy'].session.get(ImageUpload, upload['image_id'])
+    assert response.headers['ETag'] == f'"{image.result_hash}"'
+    assert 'immutable' in response.headers['Cache-Control']
+    last_modified = response.headers['Last-Modified']
+    body = response.data
+    
+    # Revalidation is answered from the row alone, even if the file is gone
+    os.rename(image.result_path, image.result_path + '.moved')
+    response = client.get(url, headers={**auth_headers, 'If-None-Match': f'"{image.result_hash}"'})
+    assert response.status_code == 304
+    assert response.data == b''
+    response = client.get(url, headers={**auth_headers, 'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    os.rename(image.result_path + '.moved', image.result_path)
+    
+    response = client.get(url, headers={**auth_headers, 'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.data == body[:10]
+
+def test_get_result_x_accel_redirect(app, client, auth_headers, create_test_image):
+    """Test SENDFILE_MODE=x-accel hands the authorized result to the proxy."""
+    import os
+    from models import ImageUpload
+    
+    app.config['SENDFILE_MODE'] = 'x-accel'
+    upload = client.post('/api/upload', headers=auth_headers, data={
+        'file': (create_test_image(), 'test.jpg')
+    }, content_type='multipart/form-data').get_json()
+    
+    response = client.get(f"/api/images/{upload['image_id']}/result", headers=auth_headers)
+    
+    image = app.extensions['sqlalchemy'].session.get(ImageUpload, upload['image_id'])
+    assert response.status_code == 200
+    assert response.data == b''
+    relative = os.path.relpath(image.result_path, app.config['PROCESSED_FOLDER']).replace(os.sep, '/')
+    assert response.headers['X-Accel-Redirect'] == f"/protected-results/{relative}"
+    assert response.headers['ETag'] == f'"{image.result_hash}"'
+
+def test_upload_is_spooled_into_storage(app, client, auth_headers, create_test_image):
+    """Test an upload is written once, into the upload folder, and renamed into place."""
+    import os
+    from unittest.mock import patch
+    from models import ImageUpload
+    
+    # Copying the upload in would go through copyfileobj
+    with patch('services.storage.shutil.copyfileobj', side_effect=AssertionError("upload was copied")):
+        response = client.post('/api/upload', headers=auth_headers, data={
+            'file': (create_test_image(), 'test.jpg')
+        }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    
+    image = app.extensions['sqlalchemy'].session.get(ImageUpload, response.get_json()['image_id'])
+    upload_folder = app.config['UPLOAD_FOLDER']
+    assert os.path.dirname(os.path.dirname(os.path.dirname(image.upload_path))) == upload_folder
+    assert [name for _, _, files in os.walk(upload_folder) for name in files] == [os.path.basename(image.upload_path)]
+
+def test_upload_rejects_non_image_content(app, client, auth_headers):
+    """Test a file whose bytes aren't an image is refused at upload and not kept."""
+    import os
+    
+    response = client.post('/api/upload', headers=auth_headers, data={
+        'file': (BytesIO(b'not really a jpeg'), 'photo.jpg')
+    }, content_type='multipart/form-data')
+    
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Invalid image file'
+    assert not [name for _, _, files in os.walk(app.config['UPLOAD_FOLDER']) for name in files]
+
+def test_upload_and_download_through_s3_storage(tmp_path, create_test_image):
+    """Test originals and results go to the bucket and the result is streamed back from it."""
+    pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    import boto3
+    from app import create_app
+    from models import ImageUpload
+    
+    class S3Config:
+        TESTING = True
+        SECRET_KEY = 'test-secret-key-for-testing'
+        JWT_SECRET_KEY = 'test-jwt-secret-key-for-testing'
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 's3.db'}"
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        PROCESSED_FOLDER = str(tmp_path / 'processed')
+        ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+        CELERY_BROKER_URL = 'memory://'
+        CELERY_RESULT_BACKEND = 'cache+memory://'
+        PASSWORD_PBKDF2_ITERATIONS = 1000
+        STORAGE_BACKEND = 's3'
+        S3_BUCKET = 'images'
+        S3_REGION = 'us-east-1'
+    
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='images')
+        app = create_app(S3Config)
+        try:
+            client = app.test_client()
+            token = client.post('/api/register', json={'name': 's3user', 'password': 'secret123'}).get_json()['access_token']
+            headers = {'Authorization': f'Bearer {token}'}
+            upload = client.post('/api/upload', headers=headers, data={
+                'file': (create_test_image(), 'test.jpg')
+            }, content_type='multipart/form-data').get_json()
+            assert upload['status'] == 'completed'
+            
+            with app.app_context():
+                image = app.extensions['sqlalchemy'].session.get(ImageUpload, upload['image_id'])
+                assert image.upload_path.startswith('originals/')
+                assert image.result_path.startswith('processed/')
+                result_path = image.result_path
+            
+            response = client.get(f"/api/images/{upload['image_id']}/result", headers=headers)
+            assert response.status_code == 200
+            assert response.mimetype == 'image/jpeg'
+            assert response.data == app.extensions['result_storage'].open(result_path).read()
+            assert response.headers['Accept-Ranges'] == 'bytes'
+            body, etag = response.data, response.headers['ETag']
+            response.close()
+            
+            response = client.get(f"/api/images/{upload['image_id']}/result",
+                                  headers={**headers, 'Range': 'bytes=10-19', 'If-Range': etag})
+            assert response.status_code == 206
+            assert response.headers['Content-Range'] == f"bytes 10-19/{len(body)}"
+            assert response.data == body[10:20]
+            response.close()
+            
+            response = client.get(f"/api/images/{upload['image_id']}/result",
+                                  headers={**headers, 'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+            assert response.status_code == 200
+            assert response.data == body
+            response.close()
+            
+            response = client.get(f"/api/images/{upload['image_id']}/result",
+                                  headers={**headers, 'Range': f"bytes={len(body)}-"})
+            assert response.status_code == 416
+            assert response.headers['Content-Range'] == f"bytes */{len(body)}"
+            
+            assert not (tmp_path / 'uploads').exists()
+        finally:
+            app.extensions['task_dispatcher'].shutdown()
+
+def _complete_later(app, image_id, delay=0.2):
+    """Mark an image completed from another thread, the way a worker would."""
+    import threading
+    import time
+    from models import ImageUpload
+    
+    def complete():
+        time.sleep(delay)
+        with app.app_context():
+            session = app.extensions['sqlalchemy'].session
+            image = session.get(ImageUpload, image_id)
+            image.status = 'completed'
+            image.result_path = image.upload_path
+            session.commit()
+            app.extensions['status_notifier'].publish(image.user_id, image.id, 'completed')
+    
+    thread = threading.Thread(target=complete)
+    thread.start()
+    return thread
+
+def _pending_image(app, client, auth_headers, create_test_image):
+    """Upload an image and put it back in the queue."""
+    from models import ImageUpload
+    
+    response = client.post('/api/upload', headers=auth_headers, data={
+        'file': (create_test_image(), 'test.jpg')
+    }, content_type='multipart/form-data')
+    session = app.extensions['sqlalchemy'].session
+    image = session.get(ImageUpload, response.get_json()['image_id'])
+    image.status = 'pending'
+    session.commit()
+    return image.id
+
+def test_wait_image_status_long_poll(app, client, auth_headers, create_test_image):
+    """Test the long-poll returns as soon as a worker finishes the image."""
+    import time
+    
+    image_id = _pending_image(app, client, auth_headers, create_test_image)
+    
+    response = client.get(f'/api/images/{image_id}/wait?timeout=0.1', headers=auth_headers)
+    assert response.get_json()['changed'] is False
+    assert response.get_json()['status'] == 'pending'
+    
+    thread = _complete_later(app, image_id)
+    started = time.monotonic()
+    response = client.get(f'/api/images/{image_id}/wait?timeout=10', headers=auth_headers)
+    thread.join()
+    
+    assert time.monotonic() - started < 5
+    data = response.get_json()
+    assert data['changed'] is True
+    assert data['status'] == 'completed'
+    assert data['result_url'] == f'/api/images/{image_id}/result'
+    
+    # A finished image is reported immediately
+    response = client.get(f'/api/images/{image_id}/wait', headers=auth_headers)
+    assert response.get_json()['status'] == 'completed'
+    
+    response = client.get(f'/api/images/{image_id}/wait?timeout=soon', headers=auth_headers)
+    assert response.status_code == 400
+
+def test_user_events_stream(app, client, auth_headers, create_test_image):
+    """Test the SSE stream reports a user's pending images and ends once all finish."""
+    import json
+    
+    image_id = _pending_image(app, client, auth_headers, create_test_image)
+    thread = _complete_later(app, image_id)
+    
+    response = client.get('/api/images/events', headers=auth_headers)
+    body = response.get_data(as_text=True)
+    thread.join()
+    
+    assert response.mimetype == 'text/event-stream'
+    status_events = [block for block in body.split('\n\n') if block.startswith('event: status')]
+    assert len(status_events) == 1
+    assert json.loads(status_events[0].split('data: ', 1)[1]) == {
+        "image_id": image_id, "status": "completed", "result_url": f"/api/images/{image_id}/result"}
+    assert body.rstrip().endswith('event: end\ndata: {}')
+    
+    response = client.get('/api/images/wait?timeout=0', headers=auth_headers)
+    assert response.get_json() == {"images": [], "pending": []}
+
@@ -1,7 +1,6 @@
 # tests/test_models.py
 import pytest
 from models import User, ImageUpload, ImageStatus
-from werkzeug.security import check_password_hash
 
 def test_user_model(app): # 'app' fixture is injected
     """Test User model."""
@@ -10,13 +9,12 @@ def test_user_model(app): # 'app' fixture is injected
         # The key 'sqlalchemy' is the default used by Flask-SQLAlchemy
         db = app.extensions['sqlalchemy'] 
         
-        user = User(name='testuser')
-        user.set_password('testpassword')
+        password_hasher = app.extensions['password_hasher']
+        user = User(name='testuser', password=password_hasher.hash('testpassword'))
         
         assert user.name == 'testuser'
-        assert check_password_hash(user.password, 'testpassword')
-        assert user.check_password('testpassword') == True
-        assert user.check_password('wrongpassword') == False
+        assert password_hasher.verify(user.password, 'testpassword') == True
+        assert password_hasher.verify(user.password, 'wrongpassword') == False
 
 def test_image_upload_model(app):
     """Test ImageUpload model."""
@@ -81,3 +79,80 @@ def test_image_to_dict(app):
         assert isinstance(image_dict['uploaded_at'], str)
         # Check the format roughly (basic check)
         assert 'T' in image_dict['uploaded_at']
+
+def test_ensure_schema_checks_fingerprint(tmp_path):
+    """Test the schema is created once and only rebuilt when the models change."""
+    from sqlalchemy import Column, Integer, MetaData, Table, create_engine, inspect
+    from models import Base, ensure_schema
+    
+    engine = create_engine(f"sqlite:///{tmp_path / 'schema.db'}")
+    assert ensure_schema(engine) == True
+    assert {'users', 'image_uploads', 'schema_version'} <= set(inspect(engine).get_table_names())
+    assert ensure_schema(engine) == False
+    
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        table.to_metadata(metadata)
+    Table('extra', metadata, Column('id', Integer, primary_key=True))
+    assert ensure_schema(engine, metadata) == True
+    assert 'extra' in inspect(engine).get_table_names()
+    assert ensure_schema(engine, metadata) == False
+    engine.dispose()
+
+def _create_baseline_tables(engine):
+    # The tables as the first release created them, before any later columns and indexes
+    from sqlalchemy import text
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR(1000) NOT NULL, "
+            "password VARCHAR(100) NOT NULL)"))
+        connection.execute(text(
+            "CREATE TABLE image_uploads (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), "
+            "original_filename VARCHAR(200) NOT NULL, upload_path VARCHAR(500) NOT NULL, "
+            "result_path VARCHAR(500), status VARCHAR(50), task_id VARCHAR(100), uploaded_at DATETIME)"))
+
+def test_ensure_schema_extends_existing_tables(tmp_path):
+    """Test a database from the first release gets the new columns and indexes, keeping its rows."""
+    from sqlalchemy import create_engine, inspect, text
+    from sqlalchemy.orm import Session
+    from models import ensure_schema
+    
+    engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    _create_baseline_tables(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (id, name, password) VALUES (1, 'old', 'hash')"))
+        connection.execute(text("INSERT INTO image_uploads (id, user_id, original_filename, upload_path, status, "
+                                "uploaded_at) VALUES (1, 1, 'a.png', 'a.png', 'completed', '2024-01-01 00:00:00')"))
+    
+    assert ensure_schema(engine) == True
+    columns = {column['name'] for column in inspect(engine).get_columns('image_uploads')}
+    assert {'content_hash', 'pipeline', 'pipeline_key', 'result_hash', 'processed_at'} <= columns
+    indexes = {index['name'] for index in inspect(engine).get_indexes('image_uploads')}
+    assert {'ix_image_uploads_user_uploaded', 'ix_image_uploads_uploaded_at'} <= indexes
+    assert 'ix_users_name' in {index['name'] for index in inspect(engine).get_indexes('users')}
+    
+    with Session(engine) as session:
+        image = session.get(ImageUpload, 1)
+        assert image.original_filename == 'a.png'
+        assert image.content_hash is None
+    assert ensure_schema(engine) == False
+    engine.dispose()
+
+def test_ensure_schema_refuses_tables_it_cannot_fix(tmp_path):
+    """Test duplicate names block the unique index and leave the fingerprint unwritten."""
+    import pytest
+    from sqlalchemy import create_engine, inspect, text
+    from models import ensure_schema
+    from models.schema import SchemaMismatchError
+    
+    engine = create_engine(f"sqlite:///{tmp_path / 'duplicates.db'}")
+    _create_baseline_tables(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (name, password) VALUES ('twin', 'a'), ('twin', 'b')"))
+    
+    with pytest.raises(SchemaMismatchError, match='ix_users_name'):
+        ensure_schema(engine)
+    assert 'schema_version' not in inspect(engine).get_table_names()
+    with pytest.raises(SchemaMismatchError):
+        ensure_schema(engine)
+    engine.dispose()
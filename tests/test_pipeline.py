@@ -0,0 +1,199 @@
+# tests/test_pipeline.py
+import pytest
+from PIL import Image
+from services.pipeline import Pipeline
+
+def test_pipeline_default():
+    """Test the default pipeline matches the original grayscale + 800x600 JPEG."""
+    pipeline = Pipeline.default()
+    
+    assert pipeline.grayscale == True
+    assert pipeline.format == 'JPEG'
+    assert pipeline.extension == 'jpg'
+    
+    img = pipeline.apply(Image.new('RGB', (200, 200), color='red'))
+    assert img.mode == 'L'
+    assert img.size == (800, 600)
+
+def test_pipeline_invalid_spec():
+    """Test invalid specs raise ValueError."""
+    for spec in ['not json', '[]', [{'op': 'blur'}], [{'op': 'resize', 'mode': 'exact', 'width': 10}],
+                 [{'op': 'crop', 'left': 0, 'top': 0, 'width': 0, 'height': 5}],
+                 [{'op': 'format', 'format': 'bmp'}], [{'op': 'grayscale', 'amount': 1}]]:
+        with pytest.raises(ValueError):
+            Pipeline.from_spec(spec)
+
+def test_pipeline_moves_grayscale_first():
+    """Test grayscale runs before resampling and the format op ends the pipeline."""
+    pipeline = Pipeline.from_spec([
+        {'op': 'format', 'format': 'png'},
+        {'op': 'resize', 'width': 100, 'height': 100, 'mode': 'exact'},
+        {'op': 'grayscale'},
+    ])
+    
+    assert [op['op'] for op in pipeline.operations] == ['grayscale', 'resize', 'format']
+
+def test_pipeline_collapses_resizes():
+    """Test consecutive resizes collapse into one."""
+    pipeline = Pipeline.from_spec([
+        {'op': 'resize', 'width': 400, 'mode': 'fit'},
+        {'op': 'resize', 'width': 800, 'height': 600, 'mode': 'exact'},
+        {'op': 'resize', 'width': 400, 'height': 400, 'mode': 'fit'},
+    ])
+    
+    assert pipeline.operations[:-1] == [
+        {'op': 'resize', 'mode': 'exact', 'width': 400, 'height': 300}
+    ]
+
+def test_pipeline_sinks_right_angle_rotation():
+    """Test right-angle rotations move after resizes with swapped dimensions."""
+    pipeline = Pipeline.from_spec([
+        {'op': 'rotate', 'angle': 90},
+        {'op': 'resize', 'width': 300, 'height': 200, 'mode': 'exact'},
+    ])
+    
+    assert pipeline.operations[0] == {'op': 'resize', 'mode': 'exact', 'width': 200, 'height': 300}
+    assert pipeline.operations[1] == {'op': 'rotate', 'angle': 90, 'expand': True}
+    assert pipeline.apply(Image.new('RGB', (1000, 500))).size == (300, 200)
+
+def test_pipeline_cache_key_is_canonical():
+    """Test equivalent specs share a cache key."""
+    first = Pipeline.from_spec([{'op': 'grayscale'}, {'op': 'resize', 'width': 100, 'height': 50, 'mode': 'exact'}])
+    second = Pipeline.from_spec('[{"op": "resize", "height": 50, "width": 100, "mode": "exact"}, '
+                                '{"op": "grayscale"}, {"op": "format", "format": "jpg"}]')
+    third = Pipeline.from_spec([{'op': 'resize', 'width': 100, 'height': 50, 'mode': 'exact'}])
+    
+    assert first.cache_key == second.cache_key
+    assert first.cache_key != third.cache_key
+
+def test_pipeline_legacy_cache_key_is_the_jpeg_key():
+    """Test an 'auto' pipeline knows the key it had when the default wrote JPEG."""
+    jpeg = Pipeline.from_spec([{'op': 'grayscale'}, {'op': 'resize', 'width': 800, 'height': 600, 'mode': 'exact'},
+                               {'op': 'format', 'format': 'jpeg'}])
+    
+    assert Pipeline.default().legacy_cache_key == jpeg.cache_key
+    assert Pipeline.default().cache_key != jpeg.cache_key
+    assert jpeg.legacy_cache_key is None
+
+def test_pipeline_encoder_options():
+    """Test save options come from the preset for the output, then the pipeline's own overrides."""
+    auto = Pipeline.default()
+    assert auto.negotiable
+    assert auto.save_options() == {'quality': 75, 'optimize': True, 'progressive': True}
+    assert auto.resolve(has_alpha=True).format == 'PNG'
+    assert auto.resolve(has_alpha=False).save_options({'jpeg': {'effort': 0}}) == {'quality': 75}
+    
+    webp = auto.with_format('webp', lossless=True)
+    assert (webp.format, webp.mimetype) == ('WEBP', 'image/webp')
+    assert webp.save_options() == {'lossless': True, 'quality': 80, 'method': 4}
+    assert Pipeline.from_spec([{'op': 'format', 'format': 'webp', 'quality': 60, 'effort': 9}]).save_options(
+        {'webp': {'quality': 70}}) == {'lossless': False, 'quality': 60, 'method': 6}
+    assert Pipeline.from_spec([{'op': 'format', 'format': 'png'}]).save_options() == {
+        'compress_level': 9, 'optimize': True}
+    with pytest.raises(ValueError):
+        Pipeline.from_spec([{'op': 'format', 'format': 'webp', 'lossless': 'yes'}])
+
+def test_pipeline_fuses_crop_and_resize():
+    """Test crop followed by resize runs as a single resize(box=...)."""
+    pipeline = Pipeline.from_spec([
+        {'op': 'crop', 'left': 100, 'top': 50, 'width': 400, 'height': 300},
+        {'op': 'resize', 'width': 200, 'height': 150, 'mode': 'exact'},
+    ])
+    
+    assert pipeline._fuse(pipeline.operations[:-1], (1000, 1000)) == ((200, 150), (100, 50, 500, 350))
+    assert pipeline.decode_size((1000, 1000)) == (500, 500)
+    
+    source = Image.new('RGB', (1000, 1000))
+    source.paste((255, 0, 0), (100, 50, 500, 350))
+    img = pipeline.apply(source)
+    assert img.size == (200, 150)
+    assert img.getpixel((5, 5)) == (255, 0, 0)
+    assert img.getpixel((194, 144)) == (255, 0, 0)
+
+def test_pipeline_fill_and_decode_scale():
+    """Test fill crops to the target aspect and crop coordinates survive downscaled decodes."""
+    pipeline = Pipeline.from_spec([{'op': 'resize', 'width': 100, 'height': 100, 'mode': 'fill'}])
+    assert pipeline.apply(Image.new('RGB', (400, 200))).size == (100, 100)
+    
+    pipeline = Pipeline.from_spec([
+        {'op': 'crop', 'left': 200, 'top': 0, 'width': 200, 'height': 200},
+        {'op': 'resize', 'width': 100, 'height': 100, 'mode': 'exact'},
+    ])
+    assert pipeline.decode_size((400, 400)) == (200, 200)
+    source = Image.new('L', (400, 400))
+    source.paste(255, (200, 0, 400, 200))
+    # Simulate a half-scale decode of the 400x400 original
+    img = pipeline.apply(source.reduce(2), source_size=(400, 400))
+    assert img.size == (100, 100)
+    assert img.getpixel((50, 50)) == 255
+
+def test_pipeline_point_operations():
+    """Test point operations run in place, on color bands only, and validate their values."""
+    pipeline = Pipeline.from_spec([
+        {'op': 'gamma', 'gamma': 2},
+        {'op': 'resize', 'width': 10, 'height': 10, 'mode': 'exact'},
+        {'op': 'brightness', 'factor': 2},
+        {'op': 'format', 'format': 'png'},
+    ])
+    assert [op['op'] for op in pipeline.operations] == ['gamma', 'resize', 'brightness', 'format']
+    
+    img = pipeline.apply(Image.new('RGBA', (20, 20), color=(36, 0, 255, 255)))
+    assert img.size == (10, 10)
+    assert img.getpixel((5, 5)) == (192, 0, 255, 255)  # 255*sqrt(36/255)=96, doubled
+    img = Pipeline.from_spec([{'op': 'brightness', 'factor': 2}]).apply(Image.new('LA', (4, 4), color=(50, 100)))
+    assert img.getpixel((0, 0)) == (100, 100)  # alpha kept
+    
+    img = Pipeline.from_spec([{'op': 'threshold', 'level': 100}]).apply(Image.new('L', (4, 4), color=99))
+    assert img.getpixel((0, 0)) == 0
+    img = Pipeline.from_spec([{'op': 'contrast', 'factor': 0}]).apply(Image.new('RGB', (4, 4), color=(200, 100, 0)))
+    assert img.getpixel((0, 0)) == (118, 118, 118)  # everything collapses to the mean gray
+    
+    for spec in [{'op': 'gamma', 'gamma': 0}, {'op': 'brightness', 'factor': -1},
+                 {'op': 'contrast', 'factor': 'high'}, {'op': 'threshold', 'level': 256}]:
+        with pytest.raises(ValueError):
+            Pipeline.from_spec([spec])
+
+def _apply_in_spec_order(spec, img):
+    # One operation at a time, exactly as written
+    for op in spec:
+        img = Pipeline.from_spec([op]).apply(img)
+    return img
+
+def test_pipeline_keeps_point_operations_that_do_not_commute():
+    """Test contrast and threshold keep their place relative to geometry and grayscale."""
+    halves = Image.new('L', (4, 2), color=0)
+    halves.paste(200, (2, 0, 4, 2))
+    spec = [{'op': 'contrast', 'factor': 0.5}, {'op': 'crop', 'left': 2, 'top': 0, 'width': 2, 'height': 2}]
+    pipeline = Pipeline.from_spec(spec)
+    assert [op['op'] for op in pipeline.operations] == ['contrast', 'crop', 'format']
+    assert pipeline.apply(halves).getpixel((0, 0)) == _apply_in_spec_order(spec, halves).getpixel((0, 0)) == 150
+    assert pipeline.cache_key != Pipeline.from_spec(spec[::-1]).cache_key
+    
+    red = Image.new('RGB', (2, 2), color=(200, 50, 50))
+    spec = [{'op': 'threshold', 'level': 128}, {'op': 'grayscale'}]
+    pipeline = Pipeline.from_spec(spec)
+    assert [op['op'] for op in pipeline.operations] == ['threshold', 'grayscale', 'format']
+    assert pipeline.grayscale == False
+    assert pipeline.apply(red).getpixel((0, 0)) == _apply_in_spec_order(spec, red).getpixel((0, 0)) == 76
+    assert pipeline.cache_key != Pipeline.from_spec(spec[::-1]).cache_key
+
+def test_pipeline_sinks_brightness_and_gamma_past_crops_and_transposes():
+    """Test brightness and gamma move after crops and right-angle rotations without changing the output."""
+    noise = Image.merge('RGB', (Image.effect_noise((40, 30), 60), Image.linear_gradient('L').resize((40, 30)),
+                                Image.radial_gradient('L').resize((40, 30))))
+    specs = [
+        [{'op': 'gamma', 'gamma': 2.2}, {'op': 'crop', 'left': 5, 'top': 3, 'width': 20, 'height': 20},
+         {'op': 'rotate', 'angle': 90}, {'op': 'brightness', 'factor': 1.3}],
+        [{'op': 'brightness', 'factor': 0.7}, {'op': 'rotate', 'angle': 180},
+         {'op': 'crop', 'left': 0, 'top': 0, 'width': 10, 'height': 10}, {'op': 'contrast', 'factor': 2}],
+    ]
+    expected_order = [['crop', 'rotate', 'gamma', 'brightness', 'format'],
+                      ['rotate', 'crop', 'brightness', 'contrast', 'format']]
+    for spec, order in zip(specs, expected_order):
+        pipeline = Pipeline.from_spec(spec)
+        assert [op['op'] for op in pipeline.operations] == order
+        assert pipeline.apply(noise).tobytes() == _apply_in_spec_order(spec, noise).tobytes()
+    
+    # Across a resize, gamma would see averaged pixels, so it stays ahead of it
+    spec = [{'op': 'gamma', 'gamma': 2.2}, {'op': 'resize', 'width': 20, 'height': 15, 'mode': 'exact'}]
+    assert [op['op'] for op in Pipeline.from_spec(spec).operations] == ['gamma', 'resize', 'format']
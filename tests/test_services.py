@@ -4,6 +4,7 @@ from unittest.mock import Mock, patch
 from services.auth_service import AuthService
 from services.image_service import ImageService
 from services.image_processor import ImageProcessor
+from services.pipeline import Pipeline
 from models import User, ImageUpload, ImageStatus
 
 def test_auth_service_register_user(app):
@@ -83,4 +84,877 @@ def test_file_utils_allowed_file():
     
     assert FileUtils.allowed_file('test.jpg', {'jpg', 'png'}) == True
     assert FileUtils.allowed_file('test.txt', {'jpg', 'png'}) == False
-    assert FileUtils.allowed_file('test', {'jpg', 'png'}) == False
\ No newline at end of file
+    assert FileUtils.allowed_file('test', {'jpg', 'png'}) == False
+
+def test_task_dispatcher_uses_broker(app):
+    """Test TaskDispatcher only targets Celery when a real broker is configured."""
+    dispatcher = app.extensions['task_dispatcher']
+    
+    assert dispatcher.uses_broker() == False  # memory:// in tests
+    app.config['CELERY_BROKER_URL'] = 'redis://localhost:6379/0'
+    assert dispatcher.uses_broker() == True
+
+def test_cleanup_service_keeps_shared_files(app, tmp_path):
+    """Test CleanupService keeps files still referenced by newer uploads."""
+    from datetime import datetime, timedelta
+    from services.cleanup_service import CleanupService
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        shared = tmp_path / 'shared.jpg'
+        unique = tmp_path / 'unique.jpg'
+        shared.write_bytes(b'shared')
+        unique.write_bytes(b'unique')
+        
+        old = datetime.utcnow() - timedelta(days=2)
+        db.session.add_all([
+            ImageUpload(user_id=1, original_filename='a.jpg', upload_path=str(shared), uploaded_at=old),
+            ImageUpload(user_id=1, original_filename='b.jpg', upload_path=str(unique), uploaded_at=old),
+            ImageUpload(user_id=1, original_filename='c.jpg', upload_path=str(shared)),
+        ])
+        db.session.commit()
+        
+        deleted = CleanupService().cleanup_old_files(db.session, app.logger)
+        
+        assert deleted == 2
+        assert shared.exists()
+        assert not unique.exists()
+
+def test_cleanup_service_chunks_and_time_budget(app, tmp_path):
+    """Test CleanupService deletes in chunks and stops once the time budget is spent."""
+    from datetime import datetime, timedelta
+    from services.cleanup_service import CleanupService
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        old = datetime.utcnow() - timedelta(days=2)
+        files = []
+        for i in range(5):
+            path = tmp_path / f'old{i}.jpg'
+            path.write_bytes(b'old')
+            files.append(path)
+            db.session.add(ImageUpload(user_id=1, original_filename=path.name,
+                                       upload_path=str(path), uploaded_at=old + timedelta(minutes=i)))
+        db.session.commit()
+        
+        # A spent budget still finishes the first chunk, oldest rows first
+        assert CleanupService(chunk_size=2, time_budget=0).cleanup_old_files(db.session, app.logger) == 2
+        assert [path.exists() for path in files] == [False, False, True, True, True]
+        
+        assert CleanupService(chunk_size=2).cleanup_old_files(db.session, app.logger) == 3
+        assert not any(path.exists() for path in files)
+        assert db.session.query(ImageUpload).count() == 0
+
+def test_cleanup_service_removes_unused_renditions(app, tmp_path):
+    """Test cleanup deletes renditions nobody read within the retention period."""
+    import os
+    import time
+    from services.cleanup_service import CleanupService
+    
+    renditions = tmp_path / 'renditions'
+    renditions.mkdir()
+    stale, fresh = renditions / 'stale.webp', renditions / 'fresh.webp'
+    stale.write_bytes(b'old')
+    fresh.write_bytes(b'new')
+    two_days_ago = time.time() - 2 * 24 * 3600
+    os.utime(stale, (two_days_ago, two_days_ago))
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        CleanupService(rendition_folder=str(renditions)).cleanup_old_files(db.session, app.logger, days_old=1)
+    assert not stale.exists()
+    assert fresh.exists()
+
+def test_local_storage_shards_and_writes_atomically(tmp_path):
+    """Test local storage files content under hash-prefixed directories and leaves no partial files."""
+    import hashlib
+    import os
+    from io import BytesIO
+    from services.storage import LocalStorage
+    
+    root = tmp_path / 'store'
+    storage = LocalStorage(str(root))
+    data = os.urandom(200_000)
+    key, content_hash = storage.save_stream(BytesIO(data), 'jpg')
+    
+    assert content_hash == hashlib.sha256(data).hexdigest()
+    relative = os.path.relpath(key, root).split(os.sep)
+    assert len(relative) == 3 and all(len(part) == 2 for part in relative[:2])
+    assert relative[2] == f"{content_hash}.jpg"
+    with storage.open(key) as f:
+        assert f.read() == data
+    assert storage.save_stream(BytesIO(data), 'jpg') == (key, content_hash)
+    
+    class Broken:
+        def read(self, size=-1):
+            raise OSError("connection reset")
+    with pytest.raises(OSError):
+        storage.save_stream(Broken(), 'jpg')
+    assert not list(root.glob('*.part'))
+    
+    result = storage.save('processed_x.png', b'result')
+    assert storage.exists(result) and storage.size(result) == 6
+    assert storage.delete(result) and not storage.exists(result)
+
+def test_s3_storage_streams_objects():
+    """Test the S3 backend against moto's in-process S3."""
+    pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    import boto3
+    import hashlib
+    import os
+    from io import BytesIO
+    from services.storage import S3Storage, S3_PART_SIZE
+    
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='images')
+        storage = S3Storage('images', 'originals/', client=client)
+        
+        # Over one part, so the upload goes multipart
+        data = os.urandom(S3_PART_SIZE + 1024)
+        key, content_hash = storage.save_stream(BytesIO(data), 'png')
+        assert content_hash == hashlib.sha256(data).hexdigest()
+        assert key.startswith('originals/') and key.endswith(f"/{content_hash}.png")
+        assert [item['Key'] for item in client.list_objects_v2(Bucket='images')['Contents']] == [key]
+        
+        assert storage.exists(key) and storage.size(key) == len(data)
+        assert storage.open(key).read() == data
+        with storage.open_buffer(key) as buffer:
+            assert buffer.read() == data
+        
+        assert storage.delete(key)
+        assert not storage.exists(key)
+        with pytest.raises(FileNotFoundError):
+            storage.open(key)
+
+def test_image_processor_decode_image_draft(tmp_path):
+    """Test JPEGs are decoded at a reduced scale that still covers the target."""
+    from PIL import Image
+    
+    path = tmp_path / 'large.jpg'
+    Image.new('RGB', (4000, 3000), color='blue').save(path, 'JPEG')
+    
+    img, source_size = ImageProcessor('/tmp')._decode_image(str(path), Pipeline.default())
+    
+    assert source_size == (4000, 3000)
+    assert img.mode == 'L'
+    assert img.size == (1000, 750)  # 1/4 scale, the smallest covering 800x600
+
+def test_image_processor_decode_image_reduce(tmp_path):
+    """Test non-JPEG inputs are reduced by an integer factor."""
+    from PIL import Image
+    
+    path = tmp_path / 'large.png'
+    Image.new('P', (2500, 1900)).save(path, 'PNG')
+    
+    img, source_size = ImageProcessor('/tmp')._decode_image(str(path), Pipeline.default())
+    
+    assert img.mode == 'L'
+    assert img.size == (834, 634)  # 1/3 scale
+
+def test_image_processor_invalid_image(app, tmp_path):
+    """Test corrupt input is marked failed."""
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        path = tmp_path / 'broken.jpg'
+        path.write_bytes(b'not an image')
+        image = ImageUpload(user_id=1, original_filename='broken.jpg', upload_path=str(path))
+        db.session.add(image)
+        db.session.commit()
+        
+        result = ImageProcessor(str(tmp_path)).process_image(image, db.session, app.logger)
+        
+        assert result == {"status": "failed", "error": "Invalid image file"}
+        assert image.status == ImageStatus.FAILED.value
+
+def test_image_processor_decodes_over_budget_png_in_strips(tmp_path):
+    """Test a PNG over the memory budget is streamed in strips to the same pixels."""
+    from PIL import Image
+
+    path = tmp_path / 'wide.png'
+    Image.effect_noise((2400, 1800), 60).convert('RGB').save(path)
+    pipeline = Pipeline.from_spec([{"op": "resize", "width": 800, "height": 600}])
+
+    expected, _ = ImageProcessor('/tmp')._decode_image(str(path), pipeline)
+    img, source_size = ImageProcessor('/tmp', memory_budget=4 * 1024 * 1024)._decode_image(str(path), pipeline)
+
+    assert source_size == (2400, 1800)
+    assert img.size == expected.size == (800, 600)
+    assert img.tobytes() == expected.tobytes()
+    # A tighter budget downscales further rather than going over it
+    img, _ = ImageProcessor('/tmp', memory_budget=1024 * 1024)._decode_image(str(path), pipeline)
+    assert img.size == (480, 360)
+
+def test_image_processor_rejects_oversized_images(app, tmp_path):
+    """Test pixel-limit and unstreamable over-budget inputs fail cleanly, and jobs report peak RSS."""
+    from PIL import Image
+    from services.processing_jobs import process_image_job
+
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        png = tmp_path / 'big.png'
+        Image.new('L', (1000, 1000)).save(png)
+        gif = tmp_path / 'big.gif'
+        Image.new('P', (1000, 1000)).save(gif)
+        images = [ImageUpload(user_id=1, original_filename=p.name, upload_path=str(p)) for p in (png, gif)]
+        db.session.add_all(images)
+        db.session.commit()
+
+        result = process_image_job(images[0].id, db.session, str(tmp_path), app.logger,
+                                   options={"max_pixels": 500_000})
+        assert result["status"] == "failed"
+        assert "over the 500000 pixel limit" in result["error"]
+        assert result["peak_rss_bytes"] > 0
+
+        result = ImageProcessor(str(tmp_path), memory_budget=100_000).process_image(images[1], db.session, app.logger)
+        assert result["status"] == "failed"
+        assert "MB budget" in result["error"]
+        assert images[1].status == ImageStatus.FAILED.value
+
+def test_image_processor_budgets_palette_images_as_expanded(tmp_path):
+    """Test a palette image counts against the budget at the RGB it is expanded to."""
+    from PIL import Image
+    from services.image_processor import ImageTooLargeError
+
+    path = tmp_path / 'palette.gif'
+    Image.new('P', (1000, 1000)).save(path)
+    processor = ImageProcessor('/tmp', memory_budget=2 * 1000 * 1000)
+
+    # 1 MB of palette indices becomes 4 MB of RGB
+    with pytest.raises(ImageTooLargeError):
+        processor._decode_image(str(path), Pipeline.from_spec([{"op": "resize", "width": 500, "height": 500}]))
+    img, _ = processor._decode_image(str(path), Pipeline.from_spec([{"op": "grayscale"}]))
+    assert img.mode == 'L'
+
+def test_image_processor_keeps_animation(app, tmp_path):
+    """Test animated GIFs keep every frame, duration and loop count, within the frame limits."""
+    import json
+    from PIL import Image, ImageSequence
+
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        path = tmp_path / 'anim.gif'
+        colors = ['red', 'green', 'blue', 'yellow', 'white']
+        frames = [Image.new('RGB', (600, 400), color) for color in colors]
+        frames[0].save(path, save_all=True, append_images=frames[1:], duration=[100, 200, 300, 400, 500], loop=0)
+        pipelines = [
+            [{'op': 'resize', 'width': 60, 'mode': 'fit'}, {'op': 'format', 'format': 'auto'}],
+            [{'op': 'resize', 'width': 300, 'mode': 'fit'}, {'op': 'format', 'format': 'webp'}],
+        ]
+        images = [ImageUpload(user_id=1, original_filename='anim.gif', upload_path=str(path),
+                              pipeline=json.dumps(spec)) for spec in pipelines]
+        db.session.add_all(images)
+        db.session.commit()
+
+        processor = ImageProcessor(str(tmp_path), frame_workers=2)
+        for image, (fmt, size) in zip(images, [('GIF', (60, 40)), ('WEBP', (300, 200))]):
+            result = processor.process_image(image, db.session, app.logger)
+            assert result['status'] == 'completed'
+            with Image.open(result['result']) as output:
+                assert output.format == fmt
+                assert output.n_frames == 5
+                assert output.info['loop'] == 0
+                durations = []
+                for frame in ImageSequence.Iterator(output):
+                    frame.load()  # WebP sets duration on load
+                    durations.append(frame.info['duration'])
+                assert durations == [100, 200, 300, 400, 500]
+                assert output.size == size
+                output.seek(2)
+                assert output.convert('RGB').getpixel((5, 5))[2] > 200  # third frame is blue
+
+        result = ImageProcessor(str(tmp_path), max_frames=3).process_image(images[0], db.session, app.logger)
+        assert result == {"status": "failed", "error": "Animation has more than 3 frames"}
+
+def test_rendition_cache_tiers_and_eviction(tmp_path):
+    """Test RenditionCache serves from memory, falls back to disk and evicts LRU entries."""
+    from services.rendition_cache import RenditionCache
+    
+    cache = RenditionCache(str(tmp_path), max_memory_bytes=10)
+    
+    assert cache.get_or_render('a', 'jpg', lambda: b'123456') == b'123456'
+    assert cache.get_or_render('a', 'jpg', lambda: b'unused') == b'123456'
+    assert cache.get_or_render('b', 'jpg', lambda: b'abcdef') == b'abcdef'  # evicts 'a'
+    assert cache.get_or_render('a', 'jpg', lambda: b'unused') == b'123456'  # from disk
+    
+    stats = cache.get_stats()
+    assert stats['misses'] == 2
+    assert stats['memory_hits'] == 1
+    assert stats['disk_hits'] == 1
+    assert stats['evictions'] == 2
+
+def test_rendition_cache_bounds_disk_tier(tmp_path):
+    """Test the disk tier evicts least recently read renditions once it passes its cap."""
+    import os
+    from services.rendition_cache import RenditionCache
+    
+    cache = RenditionCache(str(tmp_path), max_memory_bytes=0, max_disk_bytes=35)
+    for index, key in enumerate('abc'):
+        cache.get_or_render(key, 'jpg', lambda: b'x' * 10)
+        os.utime(tmp_path / f'{key}.jpg', (1000 + index, 1000 + index))
+    # Reading 'a' makes 'b' the least recently used, and 'd' takes the folder over its cap
+    assert cache.get_or_render('a', 'jpg', lambda: b'unused') == b'x' * 10
+    cache.get_or_render('d', 'jpg', lambda: b'x' * 10)
+    
+    assert sorted(os.listdir(tmp_path)) == ['a.jpg', 'c.jpg', 'd.jpg']
+    stats = cache.get_stats()
+    assert stats['disk_bytes'] == 30
+    assert stats['disk_evictions'] == 1
+
+def test_rendition_cache_collapses_concurrent_renders(tmp_path):
+    """Test concurrent misses for the same key share one render."""
+    import threading
+    import time
+    from services.rendition_cache import RenditionCache
+    
+    cache = RenditionCache(str(tmp_path))
+    calls = []
+    
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        return b'rendered'
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_render('k', 'png', render)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert results == [b'rendered'] * 5
+    assert len(calls) == 1
+
+def test_batch_coalescer_flushes_on_size_and_timeout():
+    """Test BatchCoalescer flushes full batches immediately and partial ones after max_wait."""
+    import time
+    from services.task_dispatcher import BatchCoalescer
+    
+    batches = []
+    coalescer = BatchCoalescer(batches.append, batch_size=3, max_wait=0.05)
+    for image_id in range(4):
+        coalescer.add(image_id)
+    
+    assert batches == [[0, 1, 2]]
+    time.sleep(0.2)
+    assert batches == [[0, 1, 2], [3]]
+
+def test_image_processor_process_images(app, tmp_path):
+    """Test ImageProcessor process_images writes every status in bulk."""
+    from PIL import Image
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        good = tmp_path / 'good.png'
+        Image.new('RGB', (50, 50), color='green').save(good)
+        broken = tmp_path / 'broken.png'
+        broken.write_bytes(b'broken')
+        images = [
+            ImageUpload(user_id=1, original_filename='good.png', upload_path=str(good)),
+            ImageUpload(user_id=1, original_filename='broken.png', upload_path=str(broken)),
+        ]
+        db.session.add_all(images)
+        db.session.commit()
+        
+        results = ImageProcessor(str(tmp_path)).process_images(images, db.session, app.logger)
+        
+        assert results[images[0].id]['status'] == 'completed'
+        assert results[images[1].id]['status'] == 'failed'
+        assert images[0].status == ImageStatus.COMPLETED.value
+        assert images[0].result_path == results[images[0].id]['result']
+        assert images[1].status == ImageStatus.FAILED.value
+
+def test_image_processor_process_images_fails_batch_when_commit_fails(app, tmp_path):
+    """Test a batch whose final commit fails is marked FAILED instead of staying PROCESSING."""
+    from PIL import Image
+    from sqlalchemy.exc import OperationalError
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        paths = []
+        for name in ('first.png', 'second.png'):
+            paths.append(tmp_path / name)
+            Image.new('RGB', (50, 50), color='green').save(paths[-1])
+        images = [ImageUpload(user_id=1, original_filename=path.name, upload_path=str(path)) for path in paths]
+        db.session.add_all(images)
+        db.session.commit()
+        ids = [image.id for image in images]
+        
+        notifier = Mock()
+        processor = ImageProcessor(str(tmp_path), notifier=notifier, commit_retries=0)
+        execute = db.session.execute
+        
+        def execute_failing_bulk_update(statement, params=None, *args, **kwargs):
+            # The bulk result write passes its rows as a list of parameter sets
+            if isinstance(params, list):
+                raise OperationalError('UPDATE', {}, Exception('database is locked'))
+            return execute(statement, params, *args, **kwargs)
+        
+        with patch.object(db.session, 'execute', side_effect=execute_failing_bulk_update):
+            results = processor.process_images(images, db.session, app.logger)
+        
+        assert {results[image_id]['status'] for image_id in ids} == {'failed'}
+        db.session.expire_all()
+        assert [db.session.get(ImageUpload, image_id).status for image_id in ids] == [ImageStatus.FAILED.value] * 2
+        assert [call.args[2] for call in notifier.publish.call_args_list[-2:]] == [ImageStatus.FAILED.value] * 2
+
+def test_batch_kernel_matches_pillow():
+    """Test the NumPy batch kernel transforms a stack like Pipeline.apply does image by image."""
+    np = pytest.importorskip('numpy')
+    from PIL import Image
+    from services import batch_kernel
+    
+    images = [Image.merge('RGB', (Image.effect_noise((120, 90), 40 + index),
+                                  Image.linear_gradient('L').resize((120, 90)),
+                                  Image.radial_gradient('L').resize((120, 90)))) for index in range(3)]
+    for spec in [[{'op': 'resize', 'width': 50, 'height': 40}, {'op': 'contrast', 'factor': 1.5}],
+                 [{'op': 'grayscale'}, {'op': 'crop', 'left': 5, 'top': 5, 'width': 100, 'height': 60},
+                  {'op': 'resize', 'width': 160, 'height': 90, 'mode': 'fill'}, {'op': 'gamma', 'gamma': 2.2}],
+                 [{'op': 'crop', 'left': 10, 'top': 0, 'width': 30, 'height': 30}, {'op': 'brightness', 'factor': 0.5}]]:
+        pipeline = Pipeline.from_spec(spec)
+        assert batch_kernel.supports(pipeline, 'RGB')
+        for expected, actual in zip([pipeline.apply(img) for img in images],
+                                    batch_kernel.transform_batch(images, pipeline, (120, 90))):
+            assert (actual.mode, actual.size) == (expected.mode, expected.size)
+            diff = np.abs(np.asarray(actual, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+            assert diff.max() <= 2
+    
+    assert not batch_kernel.supports(Pipeline.from_spec([{'op': 'rotate', 'angle': 45}]))
+    assert not batch_kernel.supports(Pipeline.default(), 'RGBA')
+    # The kernel resamples before any point operation, so a contrast ahead of a resize stays on Pillow
+    assert not batch_kernel.supports(Pipeline.from_spec([{'op': 'contrast', 'factor': 1.5},
+                                                         {'op': 'resize', 'width': 50, 'height': 40}]))
+
+def test_image_processor_process_images_with_batch_kernel(app, tmp_path):
+    """Test same-size images share the batch kernel and the rest fall back to _process."""
+    pytest.importorskip('numpy')
+    from PIL import Image
+    from services import batch_kernel
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        images = []
+        for index, size in enumerate([(64, 48), (64, 48), (64, 48), (30, 30)]):
+            path = tmp_path / f'{index}.png'
+            Image.new('RGB', size, color=(index * 60, 100, 200)).save(path)
+            images.append(ImageUpload(user_id=1, original_filename=path.name, upload_path=str(path)))
+        broken = tmp_path / 'broken.png'
+        broken.write_bytes(b'broken')
+        images.append(ImageUpload(user_id=1, original_filename='broken.png', upload_path=str(broken)))
+        db.session.add_all(images)
+        db.session.commit()
+        
+        processor = ImageProcessor(str(tmp_path), batch_kernel=True)
+        with patch.object(batch_kernel, 'transform_batch', wraps=batch_kernel.transform_batch) as kernel, \
+                patch.object(processor, '_process', wraps=processor._process) as single:
+            results = processor.process_images(images, db.session, app.logger)
+        
+        assert [len(call.args[0]) for call in kernel.call_args_list] == [3]
+        assert sorted(call.args[0].id for call in single.call_args_list) == [images[3].id, images[4].id]
+        assert [results[image.id]['status'] for image in images] == ['completed'] * 4 + ['failed']
+        with Image.open(results[images[0].id]['result']) as result:
+            assert (result.mode, result.size) == ('L', (800, 600))
+
+def test_concurrent_workers_commit_status_without_lock_errors(tmp_path):
+    """Test N workers flipping statuses on one SQLite file all commit, via WAL, the busy timeout and retries."""
+    import threading
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import Session
+    from models import ensure_schema
+    from models.engine import commit_with_retry, create_configured_engine, settings_from_config
+    
+    engine = create_configured_engine(f"sqlite:///{tmp_path / 'concurrent.db'}", settings_from_config({}))
+    ensure_schema(engine)
+    with Session(engine) as session:
+        session.add_all(ImageUpload(user_id=1, original_filename=f'{i}.png', upload_path=f'{i}.png') for i in range(4))
+        session.commit()
+        assert session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+    
+    workers, rounds, errors = 8, 15, []
+    def worker(index):
+        try:
+            with Session(engine) as session:
+                for round_index in range(rounds):
+                    image = session.get(ImageUpload, 1 + (index + round_index) % 4)
+                    for status in (ImageStatus.PROCESSING.value, ImageStatus.COMPLETED.value):
+                        commit_with_retry(session, lambda: setattr(image, 'status', status))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with Session(engine) as session:
+        assert {image.status for image in session.query(ImageUpload)} == {ImageStatus.COMPLETED.value}
+    engine.dispose()
+    
+    # A conflicting commit is redone from scratch; other errors surface at once
+    session = Mock()
+    locked = OperationalError('UPDATE', {}, Exception('database is locked'))
+    session.commit.side_effect = [locked, None]
+    apply = Mock(return_value='done')
+    assert commit_with_retry(session, apply, backoff=0) == 'done'
+    assert apply.call_count == 2 and session.rollback.call_count == 1
+    session.commit.side_effect = OperationalError('UPDATE', {}, Exception('no such table'))
+    with pytest.raises(OperationalError):
+        commit_with_retry(session, apply, backoff=0)
+    assert apply.call_count == 3
+
+def test_task_dispatcher_batches_local_jobs(app, tmp_path):
+    """Test TaskDispatcher coalesces ids into batch jobs on the local executor."""
+    from unittest.mock import patch
+    from PIL import Image
+    from services.task_dispatcher import TaskDispatcher
+    
+    db = app.extensions['sqlalchemy']
+    images = []
+    for index in range(3):
+        path = tmp_path / f'{index}.png'
+        Image.new('RGB', (20, 20)).save(path)
+        images.append(ImageUpload(user_id=1, original_filename=path.name, upload_path=str(path)))
+    db.session.add_all(images)
+    db.session.commit()
+    image_ids = [image.id for image in images]
+    
+    dispatcher = TaskDispatcher(app, db, None, batch_size=2, batch_max_wait=10)
+    with patch.object(ImageProcessor, 'process_images', autospec=True,
+                      side_effect=ImageProcessor.process_images) as process_images:
+        for image_id in image_ids:
+            dispatcher.dispatch(image_id, None)
+        dispatcher.shutdown()  # flushes the partial batch
+    
+    assert sorted(len(call.args[1]) for call in process_images.call_args_list) == [1, 2]
+    db.session.expire_all()
+    assert all(db.session.get(ImageUpload, image_id).status == 'completed' for image_id in image_ids)
+
+def test_process_pool_backend_runs_and_reconciles_jobs(app, tmp_path):
+    """Test the process pool backend processes new jobs and requeues abandoned ones."""
+    from datetime import datetime, timedelta
+    from PIL import Image
+    from services.task_dispatcher import TaskDispatcher
+    
+    app.config['PROCESSING_BACKEND'] = 'process'
+    app.config['PROCESSING_POOL_WORKERS'] = 2
+    db = app.extensions['sqlalchemy']
+    images = []
+    for index, status in enumerate([ImageStatus.PENDING.value, ImageStatus.PROCESSING.value]):
+        path = tmp_path / f'{index}.png'
+        Image.new('RGB', (20, 20)).save(path)
+        images.append(ImageUpload(user_id=1, original_filename=path.name, upload_path=str(path),
+                                  status=status, task_id=f'task-{index}'))
+    db.session.add_all(images)
+    db.session.commit()
+    
+    dispatcher = TaskDispatcher(app, db, None)
+    assert dispatcher.backend.name == 'process'
+    # Rows uploaded once the server started belong to live workers
+    assert dispatcher.reconcile(before=datetime.utcnow() - timedelta(hours=1)) == 0
+    assert dispatcher.reconcile() == 2
+    dispatcher.shutdown()
+    
+    db.session.expire_all()
+    assert [image.status for image in images] == ['completed', 'completed']
+
+def test_local_backend_applies_backpressure():
+    """Test a full local submission queue raises QueueFullError after the timeout."""
+    import threading
+    from services.execution_backends import ThreadBackend, QueueFullError
+    
+    release = threading.Event()
+    
+    class BlockingBackend(ThreadBackend):
+        def _job(self, task_name, args):
+            return lambda timeout, dispatched_at: release.wait(timeout), 5
+    
+    backend = BlockingBackend(None, None, max_workers=1, max_pending=1, submit_timeout=0.05)
+    backend.submit("tasks.process_image", [1])
+    with pytest.raises(QueueFullError):
+        backend.submit("tasks.process_image", [2])
+    
+    release.set()
+    backend.shutdown()
+    backend.submit("tasks.process_image", [3])  # slot released once the first job finished
+    backend.shutdown()
+
+def test_task_dispatcher_fails_every_dropped_job(app):
+    """Test a full queue fails all of a dropped batch's images, whether flushed inline or by the timer."""
+    import threading
+    import time
+    from services.execution_backends import ThreadBackend, QueueFullError
+    from services.task_dispatcher import TaskDispatcher
+    
+    release = threading.Event()
+    
+    class BlockingBackend(ThreadBackend):
+        def _job(self, task_name, args):
+            return lambda timeout, dispatched_at: release.wait(timeout), 5
+    
+    db = app.extensions['sqlalchemy']
+    images = [ImageUpload(user_id=1, original_filename=f'{index}.png', upload_path=f'{index}.png', task_id=f'task-{index}')
+              for index in range(5)]
+    db.session.add_all(images)
+    db.session.commit()
+    ids = [image.id for image in images]
+    
+    backend = BlockingBackend(app, db, max_workers=1, max_pending=1, submit_timeout=0.01)
+    backend.submit("tasks.process_image", [0])  # holds the only slot
+    
+    dispatcher = TaskDispatcher(app, db, None, batch_size=2, batch_max_wait=10)
+    dispatcher._backend = backend
+    dispatcher.dispatch(ids[0], None)
+    with pytest.raises(QueueFullError) as raised:
+        dispatcher.dispatch(ids[1], None)  # fills the batch, which can't be queued
+    assert raised.value.image_ids == ids[:2]
+    
+    late = TaskDispatcher(app, db, None, batch_size=3, batch_max_wait=0.01)
+    late._backend = backend
+    late.dispatch(ids[2], None)  # flushed by the timer thread
+    
+    unbatched = TaskDispatcher(app, db, None)
+    unbatched._backend = backend
+    with pytest.raises(QueueFullError) as raised:
+        unbatched.dispatch_many([(ids[3], 'task-3'), (ids[4], 'task-4')])
+    assert raised.value.image_ids == ids[3:]
+    
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        db.session.expire_all()
+        if db.session.get(ImageUpload, ids[2]).status == 'failed':
+            break
+        time.sleep(0.01)
+    assert [db.session.get(ImageUpload, image_id).status for image_id in ids] == ['failed'] * 5
+    release.set()
+    backend.shutdown()
+
+def test_status_notifier_wakes_matching_waiters():
+    """Test StatusNotifier wakes waiters only for their own user's events."""
+    import threading
+    import time
+    from services.status_notifier import StatusNotifier
+    
+    notifier = StatusNotifier()
+    cursor = notifier.cursor()
+    notifier.publish(2, 7, 'completed')
+    events, cursor = notifier.wait(1, cursor, 0.05)
+    assert events == []
+    
+    threading.Timer(0.1, notifier.publish, args=(1, 8, 'processing')).start()
+    started = time.monotonic()
+    events, cursor = notifier.wait(1, cursor, 5)
+    assert time.monotonic() - started < 2
+    assert events == [{"user_id": 1, "image_id": 8, "status": "processing"}]
+    assert notifier.wait(1, cursor, 0)[0] == []
+
+def test_image_processor_publishes_status_changes(app, tmp_path):
+    """Test ImageProcessor publishes each committed status transition."""
+    from PIL import Image
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        source = tmp_path / 'source.png'
+        Image.new('RGB', (40, 30), 'red').save(source)
+        image = ImageUpload(user_id=1, original_filename='source.png', upload_path=str(source))
+        db.session.add(image)
+        db.session.commit()
+        
+        notifier = Mock()
+        ImageProcessor(str(tmp_path), notifier).process_image(image, db.session, app.logger)
+        
+        assert [c.args for c in notifier.publish.call_args_list] == [
+            (1, image.id, 'processing'), (1, image.id, 'completed')]
+
+def test_password_hasher_methods_and_rehash():
+    """Test PasswordHasher round-trips both methods and flags outdated hashes."""
+    from services.password_hasher import PasswordHasher
+    
+    pbkdf2 = PasswordHasher(pbkdf2_iterations=1000)
+    scrypt = PasswordHasher(method='scrypt', scrypt_n=2 ** 10)
+    for hasher in (pbkdf2, scrypt):
+        password_hash = hasher.hash('secret')
+        assert hasher.verify(password_hash, 'secret')
+        assert not hasher.verify(password_hash, 'wrong')
+        assert not hasher.needs_rehash(password_hash)
+    
+    assert pbkdf2.needs_rehash(scrypt.hash('secret'))
+    assert PasswordHasher(pbkdf2_iterations=2000).needs_rehash(pbkdf2.hash('secret'))
+    with pytest.raises(ValueError):
+        PasswordHasher(method='md5')
+
+def test_auth_service_upgrades_hash_on_login(app):
+    """Test AuthService rehashes a password made with older parameters on login."""
+    from services.password_hasher import PasswordHasher
+    
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        user, _ = AuthService(db.session, PasswordHasher(pbkdf2_iterations=1000)).register_user('old', 'secret')
+        assert user.password.startswith('pbkdf2:sha256:1000$')
+        
+        auth_service = AuthService(db.session, PasswordHasher(method='scrypt', scrypt_n=2 ** 10))
+        assert auth_service.authenticate_user('old', 'wrong') == (None, None)
+        assert user.password.startswith('pbkdf2:sha256:1000$')
+        
+        authenticated, token = auth_service.authenticate_user('old', 'secret')
+        assert token
+        assert authenticated.password.startswith('scrypt:1024:8:1$')
+        assert auth_service.authenticate_user('old', 'secret')[1]
+
+def test_processor_benchmark_case_and_compare(tmp_path):
+    """Test the processor benchmark times every stage and flags regressions."""
+    from benchmarks import bench_processor
+    
+    path = bench_processor.generate_input(str(tmp_path), 'png-palette', 'thumb')
+    case = bench_processor.run_case(path, None, repeat=1)
+    assert set(case['stages_ms']) == set(bench_processor.STAGES)
+    assert all(case['stages_ms'][stage] > 0 for stage in bench_processor.STAGES)
+    assert case['total_ms'] >= sum(case['stages_ms'].values())
+    assert case['throughput_mps'] > 0
+    assert case['peak_rss_mb'] > 0
+    
+    baseline = {'cases': {'png-thumb': {'throughput_mps': 10.0, 'peak_rss_mb': 100.0}}}
+    assert bench_processor.compare({'cases': {'png-thumb': {'throughput_mps': 9.5, 'peak_rss_mb': 105.0}}}, baseline) == []
+    regressions = bench_processor.compare(
+        {'cases': {'png-thumb': {'throughput_mps': 8.0, 'peak_rss_mb': 120.0}}}, baseline)
+    assert len(regressions) == 2
+
+def test_batch_kernel_benchmark():
+    """Test the batch kernel benchmark times both paths and compares their pixels."""
+    pytest.importorskip('numpy')
+    from benchmarks import bench_batch_kernel
+    
+    report = bench_batch_kernel.run(count=2, size=(64, 48), repeat=1)
+    assert report['pillow_ms_per_image'] > 0 and report['kernel_ms_per_image'] > 0
+    assert report['max_diff'] <= 3  # contrast 1.2 stretches resampling's rounding differences
+
+def test_load_harness_runs_through_celery(capsys):
+    """Test the load harness drives every upload through an in-process Celery worker."""
+    from argparse import Namespace
+    from benchmarks import bench_load
+    
+    report = bench_load.run(Namespace(
+        clients=1, workers=1, duration=1, mix='upload=1,status=2', image_size='64x48',
+        batch_size=1, password_iterations=1000, database_url=None, seed=1, drain_timeout=30
+    ))
+    
+    assert "still queued" not in capsys.readouterr().out
+    assert report['endpoints']['upload']['count'] > 0
+    assert report['endpoints']['upload']['errors'] == 0
+    # Uploads are unique and batches hold one, so each upload ran exactly one task
+    assert report['queue_wait']['count'] == report['endpoints']['upload']['count']
+    assert report['task_run']['count'] == report['queue_wait']['count']
+
+def test_image_utils_opens_only_registered_formats():
+    """Test ImageUtils.open only decodes the formats register_plugins was given."""
+    from io import BytesIO
+    from PIL import Image, UnidentifiedImageError
+    from utils.image_utils import ImageUtils
+    
+    jpeg = BytesIO()
+    Image.new('RGB', (10, 10)).save(jpeg, 'JPEG')
+    formats = ImageUtils.formats
+    try:
+        assert ImageUtils.register_plugins(['png', 'gif']) == ['GIF', 'PNG']
+        with pytest.raises(UnidentifiedImageError):
+            ImageUtils.open(BytesIO(jpeg.getvalue()))
+        assert ImageUtils.register_plugins(['jpg']) == ['JPEG']
+        assert ImageUtils.open(BytesIO(jpeg.getvalue())).format == 'JPEG'
+    finally:
+        ImageUtils.formats = formats
+
+def test_startup_benchmark_api_skips_celery_and_plugins():
+    """Test a fresh API process loads neither Celery nor Pillow plugins it doesn't need."""
+    from benchmarks import bench_startup
+    
+    report = bench_startup.run(targets=['api'], repeat=1)
+    assert report['api']['celery_loaded'] == False
+    # jpeg, png, gif and webp, plus the bmp and ppm that Image.preinit always loads
+    assert report['api']['pillow_plugins'] <= 6
+    assert report['api']['create_ms'] > 0
+
+def test_ingest_benchmark_writes_uploads_once():
+    """Test uploads parsed into the storage's spool are written and read once, not twice."""
+    from benchmarks import bench_ingest
+    
+    # Large enough that werkzeug spools it to disk rather than keeping it in memory
+    report = bench_ingest.run(count=2, size=(1000, 800))
+    assert report['spool']['upload_ms'] > 0
+    if report['spool']['written_per_upload'] is not None:
+        assert report['spool']['written_per_upload'] < 1.1
+        assert report['copy']['written_per_upload'] >= 1.9
+
+def test_serve_picks_workers_from_workload():
+    """Test serve.py picks threaded workers for inline processing and async ones otherwise."""
+    import serve
+    
+    assert serve.choose_workload({'PROCESSING_MODE': 'sync'}) == 'cpu'
+    assert serve.choose_workload({'PROCESSING_MODE': 'async', 'CELERY_BROKER_URL': 'memory://'}) == 'cpu'
+    assert serve.choose_workload({'PROCESSING_MODE': 'async', 'CELERY_BROKER_URL': 'redis://localhost:6379/0'}) == 'io'
+    assert serve.choose_workload({'PROCESSING_MODE': 'async', 'PROCESSING_BACKEND': 'process'}) == 'io'
+    
+    # Threads, so status streams and long polls neither miss heartbeats nor hold a whole worker
+    assert serve.worker_settings('cpu', 4) == {'worker_class': 'gthread', 'workers': 5, 'threads': 4}
+    assert serve.worker_settings('cpu', 4, workers=2)['workers'] == 2
+    io = serve.worker_settings('io', 4)
+    assert io['worker_class'] in ('eventlet', 'gthread') and io['workers'] == 4
+    
+    options = serve.serve_options({'SERVE_WORKLOAD': 'cpu', 'SERVE_MAX_REQUESTS': 50})
+    assert options['preload_app'] == True
+    assert options['max_requests'] == 50 and options['max_requests_jitter'] == 100
+    # eventlet patches after forking, so the app can't be preloaded under it
+    assert serve.serve_options({'SERVE_WORKLOAD': 'io'})['preload_app'] == (io['worker_class'] != 'eventlet')
+
+def test_serving_benchmark_serves_requests():
+    """Test serve.py boots, passes readiness and serves requests over HTTP."""
+    from benchmarks import bench_serving
+    
+    report = bench_serving.run(servers=['serve'], clients=2, duration=1, workload='cpu', workers=1)
+    assert report['serve']['requests'] > 0
+    assert report['serve']['errors'] == 0
+
+def test_metrics_endpoint_reports_requests_and_stages(tmp_path, create_test_image):
+    """Test /metrics exposes request, stage and status metrics when enabled."""
+    from app import create_app
+    from services.metrics import init_metrics, get_metrics
+    
+    class MetricsConfig:
+        TESTING = True
+        SECRET_KEY = 'test-secret-key-for-testing'
+        JWT_SECRET_KEY = 'test-jwt-secret-key-for-testing'
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'metrics.db'}"
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        PROCESSED_FOLDER = str(tmp_path / 'processed')
+        ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+        CELERY_BROKER_URL = 'memory://'
+        CELERY_RESULT_BACKEND = 'cache+memory://'
+        PASSWORD_PBKDF2_ITERATIONS = 1000
+        METRICS_ENABLED = True
+    
+    app = create_app(MetricsConfig)
+    try:
+        client = app.test_client()
+        token = client.post('/api/register', json={'name': 'metrics', 'password': 'secret123'}).get_json()['access_token']
+        response = client.post('/api/upload', headers={'Authorization': f'Bearer {token}'}, data={
+            'file': (create_test_image(), 'test.jpg')
+        }, content_type='multipart/form-data')
+        assert response.status_code == 200
+        
+        body = client.get('/metrics').get_data(as_text=True)
+        assert 'http_request_duration_seconds_count{endpoint="/api/upload",method="POST",status="200"}' in body
+        for stage in ('decode', 'transform', 'encode', 'commit'):
+            assert f'image_processing_stage_seconds_count{{stage="{stage}"}}' in body
+        assert 'image_status_transitions_total{status="completed"}' in body
+        assert 'image_input_megapixels_count' in body
+    finally:
+        init_metrics(False)
+        app.extensions['task_dispatcher'].shutdown()
+    
+    assert not get_metrics().enabled
+
+def test_metrics_endpoint_disabled(client):
+    """Test /metrics is not routed when metrics are disabled."""
+    assert client.get('/metrics').status_code == 404
+
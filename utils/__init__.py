@@ -1,4 +1,6 @@
 # utils/__init__.py
 from .file_utils import FileUtils
+from .image_utils import ImageUtils
+from .memory_utils import MemoryUtils
 
-__all__ = ['FileUtils']
\ No newline at end of file
+__all__ = ['FileUtils', 'ImageUtils', 'MemoryUtils']
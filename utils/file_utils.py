@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 from werkzeug.utils import secure_filename
 
@@ -19,6 +20,23 @@ class FileUtils:
         file.save(full_path)
         return full_path
     
+    @staticmethod
+    def file_extension(filename):
+        return filename.rsplit('.', 1)[1].lower()
+    
+    @staticmethod
+    def write_atomic(path, data):
+        """Write data to a temporary file beside path and rename it into place."""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
     @staticmethod
     def delete_file(file_path):
         try:
@@ -0,0 +1,60 @@
+import importlib
+from io import BytesIO
+from PIL import Image, UnidentifiedImageError
+
+# File extension -> (the Pillow plugin that reads and writes it, its format name)
+PLUGINS = {
+    'bmp': ('BmpImagePlugin', 'BMP'),
+    'gif': ('GifImagePlugin', 'GIF'),
+    'jpg': ('JpegImagePlugin', 'JPEG'),
+    'jpeg': ('JpegImagePlugin', 'JPEG'),
+    'png': ('PngImagePlugin', 'PNG'),
+    'tif': ('TiffImagePlugin', 'TIFF'),
+    'tiff': ('TiffImagePlugin', 'TIFF'),
+    'webp': ('WebPImagePlugin', 'WEBP'),
+}
+
+class ImageUtils:
+    """Process-wide Pillow setup"""
+
+    # Formats open() tries, set by register_plugins; None tries every plugin
+    formats = None
+
+    @staticmethod
+    def register_plugins(extensions):
+        """Register only the Pillow plugins for extensions, instead of all ~40 on first use.
+
+        Saves the plugin imports at startup, and open() then decodes a file
+        only as one of the formats uploads are allowed to be. Pillow loads
+        every plugin when open() or save() is asked for a format it hasn't
+        registered, so passing the formats along keeps the rest unloaded.
+        Falls back to every plugin when an extension has no known plugin.
+        Returns the registered format names.
+        """
+        plugins = {PLUGINS.get(extension.lower().lstrip('.')) for extension in extensions}
+        if None in plugins:
+            Image.init()
+            ImageUtils.formats = None
+            return sorted(Image.ID)
+        Image.preinit()
+        for module, _ in sorted(plugins):
+            importlib.import_module(f'PIL.{module}')
+        ImageUtils.formats = tuple(sorted({image_format for _, image_format in plugins}))
+        return list(ImageUtils.formats)
+
+    @staticmethod
+    def open(source):
+        """Image.open, limited to the registered formats"""
+        return Image.open(source, formats=ImageUtils.formats)
+
+    @staticmethod
+    def read_header(head):
+        """Format, size and mode from the first bytes of an image file, or None when no plugin recognizes them.
+
+        Only the header is parsed; no pixel data is decoded.
+        """
+        try:
+            with ImageUtils.open(BytesIO(head)) as img:
+                return {'format': img.format, 'width': img.width, 'height': img.height, 'mode': img.mode}
+        except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+            return None
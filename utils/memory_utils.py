@@ -0,0 +1,29 @@
+import resource
+import sys
+
+class MemoryUtils:
+    """Peak resident memory of the current process"""
+
+    @staticmethod
+    def reset_peak_rss():
+        """Restart peak tracking from the current RSS; returns False where unsupported (non-Linux)"""
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def peak_rss_bytes():
+        """Peak RSS since the last reset_peak_rss(), or since process start"""
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024